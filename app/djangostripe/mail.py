@@ -1,5 +1,11 @@
+import email
+from email.header import decode_header, make_header
+
 from django.conf import settings
+from django.core.mail import EmailMessage
+from django.core.mail.backends.base import BaseEmailBackend
 from django.core.mail.backends.smtp import EmailBackend
+from django.core.mail.message import MIMEMixin, forbid_multi_line_headers
 
 class CustomEmailBackend(EmailBackend):
     """ Custom Email backend used in the project """
@@ -16,6 +22,54 @@ class CustomEmailBackend(EmailBackend):
         return super(CustomEmailBackend, self).send_messages(messages)
 
 
+class StoredMIMEMessage(MIMEMixin, email.message.Message):
+    """ Parsed MIME message, serialized like the Django ones by the backends """
+
+
+class StoredEmailMessage(EmailMessage):
+    """
+    Email rebuilt from its MIME content, as stored by the QueuedEmailBackend.
+    `to` holds all the envelope recipients (To, Cc and Bcc). The backends may still change the
+    subject and the recipients before sending, as CustomEmailBackend does when DEBUG is enabled.
+    """
+    def __init__(self, mime_message, from_email, recipients):
+        self.mime_message = bytes(mime_message)
+        parsed = self.parse()
+        body = next((part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8', 'replace')
+            for part in parsed.walk() if part.get_content_type() == 'text/plain'), "")
+        super().__init__(subject=str(make_header(decode_header(parsed['Subject'] or ""))), body=body,
+            from_email=from_email, to=list(recipients))
+        self.stored_subject = self.subject
+        self.stored_recipients = list(self.to)
+
+    def parse(self):
+        return email.message_from_bytes(self.mime_message, _class=StoredMIMEMessage)
+
+    def message(self):
+        msg = self.parse()
+        if self.subject != self.stored_subject:
+            del msg['Subject']
+            msg['Subject'] = forbid_multi_line_headers('Subject', self.subject, self.encoding or settings.DEFAULT_CHARSET)[1]
+        if self.to != self.stored_recipients:
+            del msg['To']
+            del msg['Cc']
+            msg['To'] = forbid_multi_line_headers('To', ', '.join(self.to), self.encoding or settings.DEFAULT_CHARSET)[1]
+        return msg
+
+    def recipients(self):
+        return [recipient for recipient in self.to if recipient]
+
+
+class QueuedEmailBackend(BaseEmailBackend):
+    """
+    Store the e-mails in the database and return right away. The send_queued_emails command sends
+    them with settings.EMAIL_SEND_BACKEND, over one connection.
+    """
+    def send_messages(self, messages):
+        import shop.models
+        return shop.models.QueuedEmail.enqueue(messages)
+
+
 # Documentation
 # https://docs.djangoproject.com/fr/3.0/topics/email/
 
@@ -0,0 +1,70 @@
+"""
+Read replica routing.
+
+The catalog (products) and the sales reports are read from settings.DATABASE_REPLICA, everything
+else uses the primary. A client that writes is pinned to the primary: for the rest of the request,
+then for DATABASE_REPLICA_PIN_SECONDS with a cookie, so it never reads data older than its writes.
+"""
+import contextvars
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+PIN_COOKIE = 'db_primary'
+
+# Models read from the replica
+REPLICA_MODELS = {
+    'shop.product', 'shop.relatedproduct',
+    'shop.dailysales', 'shop.dailyvatsales', 'shop.dailyproductsales',
+}
+
+# Models written by every request (sessions, last login), their writes do not pin the client
+UNPINNED_MODELS = {'sessions.session', settings.AUTH_USER_MODEL.lower()}
+
+pinned = contextvars.ContextVar('pinned', default=False)
+
+
+def get_read_db():
+    """
+    Database alias for reads that tolerate a replication lag, as the invoice exports and reports.
+    """
+    if settings.DATABASE_REPLICA is None or pinned.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    return settings.DATABASE_REPLICA
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.label_lower in REPLICA_MODELS:
+            return get_read_db()
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if model._meta.label_lower not in UNPINNED_MODELS:
+            pinned.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica has the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaPinningMiddleware:
+    """ Pin the requests of a client to the primary for a few seconds after it writes """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = pinned.set(PIN_COOKIE in request.COOKIES)
+        try:
+            response = self.get_response(request)
+            if pinned.get() and settings.DATABASE_REPLICA is not None and PIN_COOKIE not in request.COOKIES:
+                response.set_cookie(PIN_COOKIE, '1', max_age=settings.DATABASE_REPLICA_PIN_SECONDS,
+                    httponly=True, samesite='Lax')
+        finally:
+            pinned.reset(token)
+        return response
@@ -52,10 +52,12 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'djangostripe.routers.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'shop.middleware.CartMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -90,17 +92,79 @@ WSGI_APPLICATION = 'djangostripe.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+def get_database(prefix, default=None):
+    """
+    Connection settings from the `prefix`* env vars, falling back on `default`.
+    """
+    default = default or {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'USER': 'user',
+        'PASSWORD': 'password',
+        'HOST': 'localhost',
+        'PORT': '5432',
+        'CONN_MAX_AGE': '0',
+    }
+    return {
+        'ENGINE': os.environ.get(prefix + 'ENGINE', default['ENGINE']),
+        'NAME': os.environ.get(prefix + 'DATABASE', default['NAME']),
+        'USER': os.environ.get(prefix + 'USER', default['USER']),
+        'PASSWORD': os.environ.get(prefix + 'PASSWORD', default['PASSWORD']),
+        'HOST': os.environ.get(prefix + 'HOST', default['HOST']),
+        'PORT': os.environ.get(prefix + 'PORT', default['PORT']),
+        # Seconds a connection is kept open between requests (0: closed after each request)
+        'CONN_MAX_AGE': int(os.environ.get(prefix + 'CONN_MAX_AGE', default['CONN_MAX_AGE'])),
+    }
+
+
 DATABASES = {
+    'default': get_database('SQL_'),
+}
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # A file test database lets the concurrency tests open several connections
+    DATABASES['default']['TEST'] = {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')}
+
+# Optional read replica (SQL_REPLICA_HOST), the other SQL_REPLICA_* env vars default to the SQL_* ones.
+# Product and reporting reads go to the replica, see djangostripe.routers.
+DATABASE_REPLICA = None
+if os.environ.get('SQL_REPLICA_HOST'):
+    DATABASE_REPLICA = 'replica'
+    DATABASES[DATABASE_REPLICA] = get_database('SQL_REPLICA_', DATABASES['default'])
+    DATABASES[DATABASE_REPLICA]['TEST'] = {'MIRROR': 'default'}
+DATABASE_ROUTERS = ['djangostripe.routers.ReplicaRouter']
+DATABASE_REPLICA_PIN_SECONDS = int(os.environ.get('SQL_REPLICA_PIN_SECONDS', '5'))  # reads of a client stay on the primary after a write
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+CACHE_URL = os.environ.get('CACHE_URL')  # redis://host:6379/0, needs the redis package
+CACHES = {
     'default': {
-        'ENGINE': os.environ.get('SQL_ENGINE', 'django.db.backends.sqlite3'),
-        'NAME': os.environ.get('SQL_DATABASE', os.path.join(BASE_DIR, 'db.sqlite3')),
-        'USER': os.environ.get('SQL_USER', 'user'),
-        'PASSWORD': os.environ.get('SQL_PASSWORD', 'password'),
-        'HOST': os.environ.get('SQL_HOST', 'localhost'),
-        'PORT': os.environ.get('SQL_PORT', '5432'),
-    }
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_URL,
+    } if CACHE_URL else {
+        # Local to each process: only for development or a single process server
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
 }
 
+# Sessions
+# https://docs.djangoproject.com/en/4.0/topics/http/sessions/
+
+if os.environ.get('SESSION_CACHE') == 'true':
+    # Read from the cache, written through to the database
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Carts
+# CART_CACHE=true keeps the anonymous carts in the cache until checkout or login
+CART_STORAGE = 'shop.carts.CacheCartStorage' if os.environ.get('CART_CACHE') == 'true' else 'shop.carts.DatabaseCartStorage'
+CART_CACHE_ALIAS = 'default'
+CART_CACHE_TIMEOUT = int(os.environ.get('CART_CACHE_TIMEOUT', 60 * 60 * 24 * 14))  # seconds since the last change
+
+# Catalog (products, catalog pages, related products), see shop.cache
+CATALOG_CACHE_ALIAS = 'default'
+CATALOG_CACHE_TIMEOUT = int(os.environ.get('CATALOG_CACHE_TIMEOUT', 60 * 60))  # seconds
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -164,14 +228,19 @@ LOGOUT_REDIRECT_URL = 'shop'
 
 DEBUG_EMAIL = os.environ.get('DEBUG_EMAIL')
 if DEBUG_EMAIL:
-    EMAIL_BACKEND = 'djangostripe.mail.CustomEmailBackend'
+    EMAIL_SEND_BACKEND = 'djangostripe.mail.CustomEmailBackend'
     EMAIL_HOST = 'smtp.mailgun.org'
     EMAIL_PORT = '587'
     EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
     EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
     EMAIL_USE_TLS = True
+    EMAIL_TIMEOUT = 30
 else:
-    EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'  # During development only
+    EMAIL_SEND_BACKEND = 'django.core.mail.backends.console.EmailBackend'  # During development only
+
+# E-mails are stored and sent by the send_queued_emails command, EMAIL_QUEUE=false sends them in the request
+EMAIL_QUEUE = os.environ.get('EMAIL_QUEUE', 'true') == 'true'
+EMAIL_BACKEND = 'djangostripe.mail.QueuedEmailBackend' if EMAIL_QUEUE else EMAIL_SEND_BACKEND
 
 
 # Webpack loader
@@ -192,4 +261,18 @@ WEBPACK_LOADER = {
 # Stripe
 STRIPE_PUBLISHABLE_KEY=os.environ.get('STRIPE_PUBLISHABLE_KEY')
 STRIPE_SECRET_KEY=os.environ.get('STRIPE_SECRET_KEY')
-STRIPE_SECRET_WEBHOOK=os.environ.get('STRIPE_SECRET_WEBHOOK')
\ No newline at end of file
+STRIPE_SECRET_WEBHOOK=os.environ.get('STRIPE_SECRET_WEBHOOK')
+STRIPE_MAX_NETWORK_RETRIES = int(os.environ.get('STRIPE_MAX_NETWORK_RETRIES', '2'))
+STRIPE_CONNECT_TIMEOUT = float(os.environ.get('STRIPE_CONNECT_TIMEOUT', '5'))  # seconds
+STRIPE_READ_TIMEOUT = float(os.environ.get('STRIPE_READ_TIMEOUT', '20'))  # seconds
+STRIPE_POOL_SIZE = int(os.environ.get('STRIPE_POOL_SIZE', '10'))  # keep-alive connections to the Stripe API
+
+# Stripe stand-in for offline load tests (shop.stripe_fake)
+STRIPE_FAKE = os.environ.get('STRIPE_FAKE') == 'true'
+STRIPE_FAKE_LATENCY = float(os.environ.get('STRIPE_FAKE_LATENCY', '0'))  # seconds per API call
+STRIPE_FAKE_ERROR_RATE = float(os.environ.get('STRIPE_FAKE_ERROR_RATE', '0'))  # between 0 and 1
+STRIPE_FAKE_WEBHOOK_URL = os.environ.get('STRIPE_FAKE_WEBHOOK_URL')  # webhooks are sent in-process if not set
+if STRIPE_FAKE:
+    STRIPE_PUBLISHABLE_KEY = STRIPE_PUBLISHABLE_KEY or 'pk_test_fake'
+    STRIPE_SECRET_KEY = STRIPE_SECRET_KEY or 'sk_test_fake'
+    STRIPE_SECRET_WEBHOOK = STRIPE_SECRET_WEBHOOK or 'whsec_fake'
\ No newline at end of file
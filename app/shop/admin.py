@@ -1,7 +1,21 @@
+from datetime import MAXYEAR, MINYEAR
+
 from django.contrib import admin
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
+from django.core.exceptions import PermissionDenied
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.html import format_html
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+import shop.exports
 import shop.models
+import shop.search
+import shop.views
 
 
 @admin.register(shop.models.Product)
@@ -11,6 +25,12 @@ class ProductAdmin(admin.ModelAdmin):
     search_fields = ('name', )
     readonly_fields = ('vat', )
 
+    def get_search_results(self, request, queryset, search_term):
+        # Prefix search, also used by the product autocomplete of the cart and invoice inlines
+        if not search_term:
+            return queryset, False
+        return shop.search.get_search_backend().autocomplete(queryset, search_term, limit=None), False
+
 class InvoiceItemInline(admin.TabularInline):
     model = shop.models.InvoiceItem
     verbose_name = _("Produit")
@@ -19,13 +39,39 @@ class InvoiceItemInline(admin.TabularInline):
     readonly_fields = ('product_vat', )
     autocomplete_fields = ['product', ]
 
+class InvoiceAmountFilter(admin.SimpleListFilter):
+    title = _("Montant (TVAC)")
+    parameter_name = 'amount'
+    RANGES = (
+        ('0-50', (0, 50)),
+        ('50-100', (50, 100)),
+        ('100-500', (100, 500)),
+        ('500-', (500, None)),
+    )
+
+    def lookups(self, request, model_admin):
+        return [
+            (key, "%s € - %s €" % (low, high) if high else "> %s €" % low)
+            for key, (low, high) in self.RANGES
+        ]
+
+    def queryset(self, request, queryset):
+        ranges = dict(self.RANGES)
+        if self.value() not in ranges:
+            return queryset
+        low, high = ranges[self.value()]
+        queryset = queryset.filter(incl_tax__gte=low)
+        if high is not None:
+            queryset = queryset.filter(incl_tax__lt=high)
+        return queryset
+
 @admin.register(shop.models.Invoice)
 class InvoiceAdmin(admin.ModelAdmin):
     model = shop.models.Invoice
 
-    list_display = ('invoice_number', 'invoice_date', 'get_total', 'invoice_status', )
+    list_display = ('invoice_number', 'invoice_date', 'incl_tax', 'invoice_status', 'get_pdf_link', )
     search_fields = ('invoice_number', )
-    list_filter = ('customer', 'invoice_status', )
+    list_filter = ('customer', 'invoice_status', InvoiceAmountFilter, )
     date_hierarchy = 'invoice_date'
 
     autocomplete_fields = ['customer', ]
@@ -48,8 +94,46 @@ class InvoiceAdmin(admin.ModelAdmin):
         (_("Stripe"), {'fields': (
             'stripe_payment_intent_id',
         )}),
+        (_("Montants"), {'fields': (
+            ('excl_tax', 'incl_tax', ),
+            'vat',
+        )}),
     )
+    readonly_fields = ('excl_tax', 'vat', 'incl_tax', )
     inlines = [InvoiceItemInline, ]
+    actions = ['export_csv', 'export_jsonl', ]
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        form.instance.update_totals()
+
+    def export_response(self, queryset, export_format):
+        export, content_type = shop.exports.EXPORT_FORMATS[export_format]
+        response = StreamingHttpResponse(export(queryset), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="invoices.%s"' % export_format
+        return response
+
+    @admin.action(description=_("Exporter en CSV (comptabilité)"))
+    def export_csv(self, request, queryset):
+        return self.export_response(queryset, 'csv')
+
+    @admin.action(description=_("Exporter en JSONL (comptabilité)"))
+    def export_jsonl(self, request, queryset):
+        return self.export_response(queryset, 'jsonl')
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/pdf/', self.admin_site.admin_view(self.pdf_view), name='shop_invoice_pdf'),
+        ] + super().get_urls()
+
+    def pdf_view(self, request, pk):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        return shop.views.invoice_pdf_response(get_object_or_404(shop.models.Invoice, pk=pk))
+
+    @admin.display(description=_("PDF"))
+    def get_pdf_link(self, obj):
+        return format_html('<a href="{}">PDF</a>', reverse('admin:shop_invoice_pdf', args=[obj.pk]))
 
     def has_change_permission(self, request, obj=None):
         return False
@@ -71,7 +155,7 @@ class CartAdmin(admin.ModelAdmin):
 
     autocomplete_fields = ['customer', ]
     fieldsets = (
-        (None, {'fields': ('is_active', )}),
+        (None, {'fields': ('is_active', ('created_at', 'updated_at', ), )}),
         (_("Client"), {'fields': (
             ('customer', ),
         )}),
@@ -85,6 +169,121 @@ class CartAdmin(admin.ModelAdmin):
         )}),
         (_("Stripe"), {'fields': (
             'stripe_payment_intent_id',
+            ('stripe_amount', 'stripe_currency', ),
+        )}),
+        (_("Montants"), {'fields': (
+            'items_count',
+            ('excl_tax', 'incl_tax', ),
+            'vat',
         )}),
     )
-    inlines = [CartItemInline, ]
\ No newline at end of file
+    readonly_fields = ('created_at', 'updated_at', 'stripe_amount', 'stripe_currency', 'items_count', 'excl_tax', 'vat', 'incl_tax', )
+    inlines = [CartItemInline, ]
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        form.instance.update_totals()
+
+@admin.register(shop.models.WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    model = shop.models.WebhookEvent
+
+    list_display = ('stripe_event_id', 'event_type', 'created_at', 'status', 'attempts', 'next_attempt_at', )
+    search_fields = ('stripe_event_id', )
+    list_filter = ('status', 'event_type', )
+    date_hierarchy = 'created_at'
+    readonly_fields = ('stripe_event_id', 'event_type', 'payload', 'created_at', 'attempts', 'claimed_at', 'processed_at', 'last_error', )
+    actions = ['retry_events', ]
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description=_("Relancer les événements sélectionnés"))
+    def retry_events(self, request, queryset):
+        queryset.exclude(status='done').update(status='pending', attempts=0, next_attempt_at=timezone.now())
+
+@admin.register(shop.models.QueuedEmail)
+class QueuedEmailAdmin(admin.ModelAdmin):
+    model = shop.models.QueuedEmail
+
+    list_display = ('subject', 'created_at', 'status', 'attempts', 'next_attempt_at', 'processed_at', )
+    search_fields = ('subject', )
+    list_filter = ('status', )
+    date_hierarchy = 'created_at'
+    fields = ('subject', 'recipients', 'created_at', 'status', 'attempts', 'next_attempt_at', 'processed_at', 'last_error', )
+    readonly_fields = fields
+    actions = ['retry_emails', ]
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description=_("Renvoyer les e-mails sélectionnés"))
+    def retry_emails(self, request, queryset):
+        queryset.exclude(status='done').update(status='pending', attempts=0, next_attempt_at=timezone.now())
+
+@admin.register(shop.models.ProductImageTask)
+class ProductImageTaskAdmin(admin.ModelAdmin):
+    model = shop.models.ProductImageTask
+
+    list_display = ('product', 'created_at', 'status', 'attempts', 'next_attempt_at', 'processed_at', )
+    list_filter = ('status', )
+    date_hierarchy = 'created_at'
+    fields = ('product', 'created_at', 'status', 'attempts', 'next_attempt_at', 'processed_at', 'last_error', )
+    readonly_fields = fields
+    actions = ['retry_tasks', ]
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description=_("Relancer les générations sélectionnées"))
+    def retry_tasks(self, request, queryset):
+        queryset.exclude(status='done').update(status='pending', attempts=0, next_attempt_at=timezone.now())
+
+@admin.register(shop.models.DailySales)
+class SalesDashboardAdmin(admin.ModelAdmin):
+    """ Monthly sales and VAT of a year, read from the daily rollups """
+    model = shop.models.DailySales
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        try:
+            year = int(request.GET['year'])
+            if not MINYEAR <= year <= MAXYEAR:
+                raise ValueError("Year out of range.")
+        except (KeyError, ValueError):
+            year = timezone.localdate().year
+        sums = {field: Sum(field) for field in shop.models.DailySales.SUM_FIELDS}
+
+        months = list(shop.models.DailySales.objects.filter(date__year=year).annotate(
+            month=TruncMonth('date')).values('month').annotate(**sums).order_by('month'))
+        max_incl_tax = max([month['incl_tax'] for month in months], default=0)
+        for month in months:
+            month['vat_rates'] = []
+            month['chart_width'] = round(month['incl_tax'] * 100 / max_incl_tax) if max_incl_tax else 0
+        months_by_date = {month['month']: month for month in months}
+        for vat_month in shop.models.DailyVatSales.objects.filter(date__year=year).annotate(
+                month=TruncMonth('date')).values('month', 'vat').annotate(**sums).order_by('month', 'vat'):
+            months_by_date[vat_month['month']]['vat_rates'].append(vat_month)
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': _("Ventes %s") % year,
+            'opts': self.model._meta,
+            'year': year,
+            'months': months,
+            'totals': shop.models.DailySales.objects.filter(date__year=year).aggregate(**sums),
+            'top_products': shop.models.DailyProductSales.objects.filter(date__year=year, product__isnull=False).values(
+                'product__name').annotate(quantity=Sum('quantity'), excl_tax=Sum('excl_tax')).order_by('-excl_tax')[:10],
+            **(extra_context or {}),
+        }
+        return TemplateResponse(request, "admin/shop/sales_dashboard.html", context)
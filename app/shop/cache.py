@@ -0,0 +1,122 @@
+"""
+Read-through cache of the catalog: products, catalog pages and related products.
+
+The keys contain a global catalog version, bumped by shop.signals when a product is saved or
+deleted, so outdated entries are never read again and expire on their own. A missing entry is
+computed by a single process at a time, the others wait for its result (stampede protection).
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+import shop.models
+
+
+VERSION_KEY = 'catalog:version'
+STATS_KEYS = {'hits': 'catalog:hits', 'misses': 'catalog:misses'}
+LOCK_TIMEOUT = 10  # seconds a computation may take before another process computes the entry too
+WAIT_INTERVAL = 0.05  # seconds between two reads while another process computes the entry
+
+
+def get_cache():
+    return caches[settings.CATALOG_CACHE_ALIAS]
+
+
+def get_version():
+    cache = get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Start from the current time rather than 1, so a lost version never goes back to the one of old entries
+        cache.add(VERSION_KEY, int(time.time()), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_version():
+    """
+    Invalidate the whole catalog cache.
+    """
+    cache = get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, int(time.time()), timeout=None)
+
+
+def get_key(name):
+    return "catalog:%s:%s" % (get_version(), name)
+
+
+def increment(key):
+    cache = get_cache()
+    if not cache.add(key, 1, timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            pass  # evicted meanwhile, the count is lost
+
+
+def get_or_compute(name, compute, timeout=None):
+    """
+    Return the cached value of `name` for the current catalog version, computed by `compute` when missing.
+    """
+    cache = get_cache()
+    key = get_key(name)
+    lock_key = "%s:lock" % key
+    locked = False
+    deadline = None
+    while True:
+        cached = cache.get(key)
+        if cached is not None:
+            increment(STATS_KEYS['hits'])
+            return cached[0]  # wrapped, so a cached None is a hit
+        locked = cache.add(lock_key, 1, LOCK_TIMEOUT)
+        if locked:
+            break
+        deadline = deadline or time.monotonic() + LOCK_TIMEOUT
+        if time.monotonic() >= deadline:
+            break  # the computing process is stuck or dead
+        time.sleep(WAIT_INTERVAL)
+
+    increment(STATS_KEYS['misses'])
+    try:
+        value = compute()
+        cache.set(key, (value, ), settings.CATALOG_CACHE_TIMEOUT if timeout is None else timeout)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return value
+
+
+def get_product(pk):
+    """
+    Return the product `pk`, or None if it does not exist.
+    """
+    return get_or_compute("product:%s" % pk, lambda: shop.models.Product.objects.filter(pk=pk).first())
+
+
+def get_related_products(product_instance, count=4):
+    """
+    Products displayed with `product_instance`: its recommendations, or any products until it has some.
+    """
+    return get_or_compute("related:%s:%s" % (product_instance.pk, count), lambda: list(
+        product_instance.get_related_products(count)) or list(shop.models.Product.objects.exclude(pk=product_instance.pk)[:count]))
+
+
+def get_page_name(filters, page_size):
+    """
+    Cache name of a catalog page, from the cleaned data of the filter form.
+    """
+    params = "&".join("%s=%s" % (field, filters[field]) for field in sorted(filters) if filters[field] is not None)
+    return "page:%s:%s" % (page_size, hashlib.sha256(params.encode()).hexdigest()[:32])
+
+
+def get_stats():
+    values = get_cache().get_many(list(STATS_KEYS.values()))
+    return {name: values.get(key, 0) for name, key in STATS_KEYS.items()}
+
+
+def reset_stats():
+    get_cache().delete_many(list(STATS_KEYS.values()))
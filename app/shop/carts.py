@@ -0,0 +1,151 @@
+"""
+Storage of the session carts, selected by CART_STORAGE.
+
+DatabaseCartStorage saves a cart in the database at its first change. CacheCartStorage keeps the
+anonymous carts in the cache (CART_CACHE_ALIAS), so browsing and filling a cart do not touch the
+Cart and CartItem tables: a cart is only written to the database at checkout or login.
+"""
+import secrets
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+import shop.models
+
+
+CART_ITEM_FIELDS = ('product_id', 'product_name', 'product_description', 'product_quantity', 'product_vat', 'product_price', )
+
+
+def set_session_value(request, key, value):
+    # Only modify the session when the value changes, so it is not saved by every request
+    if request.session.get(key) != value:
+        request.session[key] = value
+
+
+class DatabaseCartStorage:
+    """ Carts saved in the database at their first change """
+    def load(self, request):
+        """
+        Return the active cart of the session, or None.
+        """
+        if request.session.get('cart_pk'):
+            return shop.models.Cart.objects.filter(pk=request.session['cart_pk'], is_active=True).first()
+        return None
+
+    def persist(self, request, cart_instance, database=False):
+        if cart_instance.pk is None:
+            cart_instance.save()
+        self.save_session(request, cart_instance)
+
+    def save_session(self, request, cart_instance):
+        set_session_value(request, 'cart_pk', cart_instance.pk)
+        if cart_instance.pk is not None and 'cart_key' in request.session:
+            del request.session['cart_key']
+
+
+class CacheCartStorage(DatabaseCartStorage):
+    """
+    Anonymous carts kept in the cache, under a random key stored in the session.
+    The carts of the connected users and the carts being paid are in the database.
+    """
+    def __init__(self):
+        self.cache = caches[settings.CART_CACHE_ALIAS]
+
+    def get_cache_key(self, cart_key):
+        return "cart:%s" % cart_key
+
+    def get_cached_items(self, cart_instance):
+        data = self.cache.get(self.get_cache_key(cart_instance.cart_key))
+        if data is None:
+            return None
+        return [shop.models.CartItem(cart=cart_instance, **item) for item in data]
+
+    def store(self, cart_instance):
+        self.cache.set(self.get_cache_key(cart_instance.cart_key), [
+            {field: getattr(cartitem_instance, field) for field in CART_ITEM_FIELDS}
+            for cartitem_instance in cart_instance.cached_items
+        ], settings.CART_CACHE_TIMEOUT)
+
+    def set_cached_items(self, cart_instance, cartitem_instances):
+        cart_instance.cached_items = cartitem_instances
+        for field, value in cart_instance.compute_totals().items():
+            setattr(cart_instance, field, value)
+
+    def load(self, request):
+        if request.session.get('cart_key'):
+            cart_instance = shop.models.Cart()
+            cart_instance.cart_key = request.session['cart_key']
+            cartitem_instances = self.get_cached_items(cart_instance)
+            if cartitem_instances is not None:
+                self.set_cached_items(cart_instance, cartitem_instances)
+                return cart_instance
+        return super().load(request)
+
+    def persist(self, request, cart_instance, database=False):
+        if cart_instance.pk is None and (database or cart_instance.customer_id is not None):
+            self.write(cart_instance)
+        elif cart_instance.pk is None and cart_instance.cart_key is None:
+            cart_instance.cart_key = secrets.token_urlsafe(16)
+            self.set_cached_items(cart_instance, [])
+            self.store(cart_instance)
+        self.save_session(request, cart_instance)
+
+    def save_session(self, request, cart_instance):
+        if cart_instance.cart_key is None:
+            return super().save_session(request, cart_instance)
+        set_session_value(request, 'cart_key', cart_instance.cart_key)
+
+    def write(self, cart_instance):
+        """
+        Save a cart and its cached items in the database, then remove it from the cache.
+        """
+        cartitem_instances = list(cart_instance.get_cartitems())
+        with transaction.atomic():
+            cart_instance.save()
+            # Items of products deleted meanwhile are kept, like the CartItem.product SET_NULL
+            product_pks = set(shop.models.Product.objects.filter(pk__in=[
+                cartitem_instance.product_id for cartitem_instance in cartitem_instances]).values_list('pk', flat=True))
+            for cartitem_instance in cartitem_instances:
+                cartitem_instance.cart = cart_instance
+                if cartitem_instance.product_id not in product_pks:
+                    cartitem_instance.product_id = None
+            shop.models.CartItem.objects.bulk_create(cartitem_instances)
+        if cart_instance.cart_key is not None:
+            self.delete(cart_instance)
+
+    def delete(self, cart_instance):
+        self.cache.delete(self.get_cache_key(cart_instance.cart_key))
+        cart_instance.cart_key = None
+        cart_instance.cached_items = None
+
+    def set_products_quantities(self, cart_instance, quantities, replace_quantity=True):
+        """
+        Same as Cart.set_products_quantities, for a cached cart. The items are read again from the cache
+        just before the change, but concurrent changes of a same cart may be lost.
+        """
+        product_instances = shop.models.Product.objects.in_bulk(list(quantities))
+        if len(product_instances) != len(quantities):
+            raise shop.models.Product.DoesNotExist("Unknown products: %s" % sorted(set(quantities) - set(product_instances)))
+
+        cartitem_instances = self.get_cached_items(cart_instance)
+        if cartitem_instances is None:
+            cartitem_instances = cart_instance.get_cartitems()  # expired meanwhile
+        cartitems = {cartitem_instance.product_id: cartitem_instance for cartitem_instance in cartitem_instances}
+        for product_pk, quantity in quantities.items():
+            product_instance = product_instances[product_pk]
+            cartitem_instance = cartitems.setdefault(product_pk, shop.models.CartItem(
+                cart=cart_instance, product_id=product_pk, product_quantity=0))
+            cartitem_instance.product_quantity = max(quantity if replace_quantity else cartitem_instance.product_quantity + quantity, 0)
+            cartitem_instance.product_name = product_instance.name
+            cartitem_instance.product_description = product_instance.description
+            cartitem_instance.product_vat = product_instance.vat
+            cartitem_instance.product_price = product_instance.price
+        self.set_cached_items(cart_instance, [
+            cartitem_instance for cartitem_instance in cartitems.values() if cartitem_instance.product_quantity >= 1])
+        self.store(cart_instance)
+
+
+def get_cart_storage():
+    return import_string(settings.CART_STORAGE)()
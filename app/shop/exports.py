@@ -0,0 +1,88 @@
+"""
+Accounting export of the invoices, as CSV (one row per invoice and VAT rate) or JSONL (one
+object per invoice with its items).
+
+The invoices are read with a server-side cursor and their items are fetched per chunk, so the
+memory used does not depend on the number of exported invoices. They are read from the replica
+when there is one.
+"""
+import csv
+import itertools
+import json
+
+import djangostripe.routers
+import shop.models
+
+
+CSV_COLUMNS = (
+    'invoice_number', 'invoice_date', 'invoice_status', 'customer_email',
+    'vat_rate', 'excl_tax', 'vat', 'incl_tax',
+)
+
+
+def iter_invoices(queryset, chunk_size=1000):
+    """
+    Yield (invoice, invoice items) for the invoices of `queryset`, in invoice_date order.
+    """
+    db = djangostripe.routers.get_read_db()
+    invoices = queryset.using(db).order_by('invoice_date', 'pk').iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(itertools.islice(invoices, chunk_size))
+        if not chunk:
+            return
+        invoiceitems = {}
+        for invoiceitem_instance in shop.models.InvoiceItem.objects.using(db).filter(invoice__in=[
+                invoice_instance.pk for invoice_instance in chunk]).order_by('pk').iterator():
+            invoiceitems.setdefault(invoiceitem_instance.invoice_id, []).append(invoiceitem_instance)
+        for invoice_instance in chunk:
+            yield invoice_instance, invoiceitems.get(invoice_instance.pk, [])
+
+
+class Echo:
+    """ File-like object returning what is written, for csv.writer """
+    def write(self, value):
+        return value
+
+
+def export_csv(queryset, chunk_size=1000):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for invoice_instance, invoiceitems in iter_invoices(queryset, chunk_size):
+        for vat, totals in shop.models.compute_vat_totals(invoiceitems).items():
+            yield writer.writerow([
+                invoice_instance.invoice_number,
+                invoice_instance.invoice_date.isoformat(),
+                invoice_instance.invoice_status,
+                invoice_instance.contact_email or "",
+                vat,
+                totals['excl_tax'],
+                totals['vat'],
+                totals['incl_tax'],
+            ])
+
+
+def export_jsonl(queryset, chunk_size=1000):
+    for invoice_instance, invoiceitems in iter_invoices(queryset, chunk_size):
+        prices = shop.models.compute_prices(invoiceitems)
+        yield json.dumps({
+            'invoice_number': invoice_instance.invoice_number,
+            'invoice_date': invoice_instance.invoice_date.isoformat(),
+            'invoice_status': invoice_instance.invoice_status,
+            'customer_email': invoice_instance.contact_email,
+            'items': [{
+                'product_name': invoiceitem_instance.product_name,
+                'product_quantity': invoiceitem_instance.product_quantity,
+                'product_vat': invoiceitem_instance.product_vat,
+                'product_price': str(invoiceitem_instance.product_price),
+                'total': str(invoiceitem_instance.get_total()),
+            } for invoiceitem_instance in invoiceitems],
+            'vat': {vat: {key: str(value) for key, value in totals.items()} for vat, totals in shop.models.compute_vat_totals(invoiceitems).items()},
+            'excl_tax': str(prices['excl_tax']),
+            'incl_tax': str(prices['incl_tax']),
+        }) + "\n"
+
+
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv'),
+    'jsonl': (export_jsonl, 'application/x-ndjson'),
+}
@@ -0,0 +1,99 @@
+"""
+Product picture variants, generated by the process_product_images worker.
+
+Each variant is cropped to a fixed size, in JPEG and WebP, at 1x and 2x when the uploaded picture
+is large enough. The files are named after their product and their content, so they never change
+and are served with far-future cache headers by shop.views.product_image, and the variants of a
+product can be deleted without checking the other products.
+"""
+import hashlib
+import io
+import os
+import re
+
+from PIL import Image, ImageOps
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+
+
+VARIANTS = {
+    'card': (450, 300),
+    'detail': (600, 700),
+}
+DENSITIES = (1, 2)
+FORMATS = {
+    'jpeg': ('JPEG', 'jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 6}),
+}
+VARIANTS_DIR = 'product/variants'
+VARIANT_NAME_RE = re.compile(r'^\d+-[0-9a-f]{16}-\d+x\d+\.(jpg|webp)$')
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+def open_image(picture_file):
+    with picture_file.open('rb'):
+        image = ImageOps.exif_transpose(Image.open(picture_file))
+        image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    return image
+
+
+def save_variant(image, image_format, owner, storage):
+    pil_format, extension, options = FORMATS[image_format]
+    content = io.BytesIO()
+    image.save(content, pil_format, **options)
+    name = "%s-%s-%sx%s.%s" % (owner, hashlib.sha256(content.getvalue()).hexdigest()[:16], image.width, image.height, extension)
+    path = os.path.join(VARIANTS_DIR, name)
+    if not storage.exists(path):
+        storage.save(path, ContentFile(content.getvalue()))
+    return {
+        'name': name,
+        'url': reverse('product_image', args=[name]),
+        'width': image.width,
+        'height': image.height,
+    }
+
+
+def generate_variants(picture_file, owner, storage=default_storage):
+    """
+    Create the variants of a picture of the product `owner` (pk) and return their informations.
+    """
+    image = open_image(picture_file)
+    variants = {'source': picture_file.name}
+    for variant_name, (width, height) in VARIANTS.items():
+        variants[variant_name] = {image_format: [] for image_format in FORMATS}
+        for density in DENSITIES:
+            # 1x is always generated, larger densities only from a large enough picture
+            if density > 1 and (image.width < width * density or image.height < height * density):
+                continue
+            variant = ImageOps.fit(image, (width * density, height * density), Image.LANCZOS)
+            for image_format in FORMATS:
+                variants[variant_name][image_format].append(save_variant(variant, image_format, owner, storage))
+    return variants
+
+
+def get_variant_names(variants):
+    return {
+        variant['name']
+        for variant_name in VARIANTS if variant_name in variants
+        for images in variants[variant_name].values()
+        for variant in images
+    }
+
+
+def delete_variants(variants, keep=None, storage=default_storage):
+    """
+    Delete the files of `variants`, except the ones also in `keep`.
+    """
+    for name in get_variant_names(variants) - get_variant_names(keep or {}):
+        storage.delete(os.path.join(VARIANTS_DIR, name))
+
+
+def get_srcset(images):
+    return ", ".join("%s %sw" % (image['url'], image['width']) for image in images)
@@ -0,0 +1,183 @@
+"""
+Invoice PDF rendering, cached on disk under MEDIA_ROOT/invoices.
+
+Paid invoices never change, so a PDF is only rendered once. The file name is the hash of the
+data printed on it (and of RENDERER_VERSION), so changing the layout renders new files instead
+of serving outdated ones.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.utils import formats
+
+
+RENDERER_VERSION = 1
+CACHE_DIR = 'invoices'
+
+
+class PdfDocument:
+    """
+    Minimal PDF writer: text in the standard Helvetica fonts and lines, on A4 pages.
+    """
+    WIDTH = 595
+    HEIGHT = 842
+    # Helvetica widths (1/1000 of the font size) of the characters used in amounts, others use the digit width
+    CHAR_WIDTHS = {' ': 278, '.': 278, ',': 278, '-': 333, '%': 889, '(': 333, ')': 333}
+
+    def __init__(self):
+        self.pages = []
+
+    def add_page(self):
+        self.pages.append([])
+
+    def get_text_width(self, value, size):
+        return sum(self.CHAR_WIDTHS.get(char, 556) for char in value) * size / 1000
+
+    def text(self, x, y, value, size=10, bold=False, align='left'):
+        value = str(value)
+        if align == 'right':
+            x -= self.get_text_width(value, size)
+        encoded = value.encode('cp1252', 'replace').replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+        self.pages[-1].append(b'BT /%s %d Tf %.2f %.2f Td (%s) Tj ET' % (
+            b'F2' if bold else b'F1', size, x, self.HEIGHT - y, encoded))
+
+    def line(self, x1, y1, x2, y2):
+        self.pages[-1].append(b'%.2f %.2f m %.2f %.2f l S' % (x1, self.HEIGHT - y1, x2, self.HEIGHT - y2))
+
+    def render(self):
+        objects = [
+            b'<< /Type /Catalog /Pages 2 0 R >>',
+            b'',  # pages, once the page objects are numbered
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>',
+        ]
+        page_numbers = []
+        for page in self.pages:
+            content = b'\n'.join(page)
+            objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content))
+            objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R '
+                b'/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> >>' % (self.WIDTH, self.HEIGHT, len(objects)))
+            page_numbers.append(len(objects))
+        objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            b' '.join(b'%d 0 R' % number for number in page_numbers), len(page_numbers))
+
+        output = b'%PDF-1.4\n'
+        offsets = []
+        for number, obj in enumerate(objects, start=1):
+            offsets.append(len(output))
+            output += b'%d 0 obj\n%s\nendobj\n' % (number, obj)
+        xref = len(output)
+        output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        output += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+        output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+        return output
+
+
+def get_invoice_data(invoice_instance):
+    """
+    Data printed on the invoice, also used to build the cache key.
+    """
+    prices = invoice_instance.get_prices()
+    return {
+        'invoice_number': invoice_instance.invoice_number,
+        'invoice_date': formats.date_format(invoice_instance.invoice_date, 'd/m/Y'),
+        'contact': [value for value in (
+            " ".join(filter(None, [invoice_instance.contact_first_name, invoice_instance.contact_last_name])),
+            invoice_instance.address,
+            " ".join(filter(None, [invoice_instance.address_zipcode, invoice_instance.address_city])),
+            invoice_instance.contact_email,
+            invoice_instance.contact_phone,
+        ) if value],
+        'items': [[
+            invoiceitem_instance.product_name,
+            str(invoiceitem_instance.product_quantity),
+            "%s%%" % invoiceitem_instance.product_vat,
+            str(invoiceitem_instance.product_price),
+            str(invoiceitem_instance.get_total()),
+        ] for invoiceitem_instance in invoice_instance.invoiceitem_set.order_by('pk')],
+        'excl_tax': str(prices['excl_tax']),
+        'vat': [[vat, str(val)] for vat, val in sorted(prices['vat'].items(), key=lambda item: int(item[0]))],
+        'incl_tax': str(prices['incl_tax']),
+    }
+
+
+def get_cache_key(invoice_data):
+    content = json.dumps([RENDERER_VERSION, invoice_data], sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def render_invoice_pdf(invoice_data):
+    """
+    Render the invoice data as PDF bytes.
+    """
+    items_per_page = 30
+    pages = [invoice_data['items'][i:i + items_per_page] for i in range(0, len(invoice_data['items']), items_per_page)] or [[]]
+    columns = (
+        (50, 'left', "Product"),
+        (280, 'right', "Qty"),
+        (330, 'right', "VAT"),
+        (445, 'right', "Unit price (excl.)"),
+        (545, 'right', "Total (excl.)"),
+    )
+
+    document = PdfDocument()
+    for page_number, items in enumerate(pages, start=1):
+        document.add_page()
+        if len(pages) > 1:
+            document.text(545, 800, "%s / %s" % (page_number, len(pages)), size=8, align='right')
+        document.text(50, 60, "Django Stripe", size=16, bold=True)
+        document.text(545, 60, "Invoice %s" % invoice_data['invoice_number'], size=14, bold=True, align='right')
+        document.text(545, 78, invoice_data['invoice_date'], align='right')
+        for i, value in enumerate(invoice_data['contact']):
+            document.text(350, 120 + i * 14, value)
+
+        y = 220
+        for x, align, title in columns:
+            document.text(x, y, title, bold=True, align=align)
+        document.line(50, y + 6, 545, y + 6)
+        for item in items:
+            y += 18
+            document.text(50, y, item[0][:40])
+            for (x, align, title), value in zip(columns[1:], item[1:]):
+                document.text(x, y, value, align=align)
+
+        if page_number < len(pages):
+            continue
+        document.line(50, y + 10, 545, y + 10)
+        y += 28
+        document.text(445, y, "Total (excl. VAT)", align='right')
+        document.text(545, y, "%s €" % invoice_data['excl_tax'], align='right')
+        for vat, val in invoice_data['vat']:
+            y += 16
+            document.text(445, y, "VAT %s%%" % vat, align='right')
+            document.text(545, y, "%s €" % val, align='right')
+        y += 20
+        document.text(445, y, "Total (incl. VAT)", bold=True, align='right')
+        document.text(545, y, "%s €" % invoice_data['incl_tax'], bold=True, align='right')
+    return document.render()
+
+
+def get_invoice_pdf(invoice_instance):
+    """
+    Return the path of the invoice PDF, rendering it if it is not cached yet.
+    """
+    invoice_data = get_invoice_data(invoice_instance)
+    key = get_cache_key(invoice_data)
+    path = os.path.join(settings.MEDIA_ROOT, CACHE_DIR, key[:2], "%s.pdf" % key)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename, so concurrent renderers never serve a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(render_invoice_pdf(invoice_data))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+import shop.models
+
+
+class Command(BaseCommand):
+    help = "Store the totals on the invoices created before they were stored."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Number of invoices updated per transaction.")
+        parser.add_argument('--sleep', type=float, default=0.1, help="Seconds to wait between two chunks.")
+
+    def handle(self, *args, **options):
+        queryset = shop.models.Invoice.objects.filter(incl_tax__isnull=True).order_by('pk')
+        updated, last_pk = 0, 0
+        while True:
+            invoices = list(queryset.filter(pk__gt=last_pk).prefetch_related('invoiceitem_set')[:options['chunk_size']])
+            if not invoices:
+                break
+            for invoice_instance in invoices:
+                for field, value in invoice_instance.compute_totals().items():
+                    setattr(invoice_instance, field, value)
+            with transaction.atomic():
+                shop.models.Invoice.objects.bulk_update(invoices, shop.models.Invoice.TOTALS_FIELDS)
+            updated += len(invoices)
+            last_pk = invoices[-1].pk
+            time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS("%s invoice(s) updated." % updated))
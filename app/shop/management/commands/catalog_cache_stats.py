@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+import shop.cache
+
+
+class Command(BaseCommand):
+    help = "Show the hits and misses of the catalog cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Reset the counters after showing them.")
+
+    def handle(self, *args, **options):
+        stats = shop.cache.get_stats()
+        total = stats['hits'] + stats['misses']
+        self.stdout.write("Version %s: %s hit(s), %s miss(es), hit ratio %s%%." % (
+            shop.cache.get_version(), stats['hits'], stats['misses'], round(100 * stats['hits'] / total) if total else 0))
+        if options['reset']:
+            shop.cache.reset_stats()
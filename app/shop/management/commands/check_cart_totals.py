@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+import shop.models
+
+
+class Command(BaseCommand):
+    help = "Check the totals stored on the carts against their cart items."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help="Store the recomputed totals on inconsistent carts.")
+        parser.add_argument('--all', action='store_true', help="Also check inactive carts.")
+
+    def handle(self, *args, **options):
+        queryset = shop.models.Cart.objects.all()
+        if not options['all']:
+            queryset = queryset.filter(is_active=True)
+
+        checked, inconsistent = 0, 0
+        for cart_instance in queryset.iterator():
+            checked += 1
+            totals = cart_instance.compute_totals()
+            stored = {field: getattr(cart_instance, field) for field in totals}
+            if stored == totals:
+                continue
+            inconsistent += 1
+            self.stdout.write("Cart %s: stored %s, expected %s" % (cart_instance.pk, stored, totals))
+            if options['fix']:
+                cart_instance.update_totals()
+
+        self.stdout.write(self.style.SUCCESS("%s cart(s) checked, %s inconsistent%s." % (
+            checked, inconsistent, " (fixed)" if options['fix'] and inconsistent else "")))
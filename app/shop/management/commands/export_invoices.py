@@ -0,0 +1,33 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+import shop.exports
+import shop.models
+
+
+class Command(BaseCommand):
+    help = "Export the invoices of an invoice_date range for the accounting, with the totals foreach VAT rate."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from', type=date.fromisoformat, help="First invoice date (YYYY-MM-DD).")
+        parser.add_argument('--to', dest='date_to', type=date.fromisoformat, help="Last invoice date (YYYY-MM-DD), included.")
+        parser.add_argument('--format', choices=shop.exports.EXPORT_FORMATS, default='csv', help="Export format.")
+        parser.add_argument('--output', help="Output file, the standard output by default.")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Number of invoices read at once.")
+
+    def handle(self, *args, **options):
+        queryset = shop.models.Invoice.objects.all()
+        if options['date_from']:
+            queryset = queryset.filter(invoice_date__gte=options['date_from'])
+        if options['date_to']:
+            queryset = queryset.filter(invoice_date__lte=options['date_to'])
+
+        export = shop.exports.EXPORT_FORMATS[options['format']][0]
+        lines = export(queryset, options['chunk_size'])
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        with open(options['output'], 'w', newline='') as output:
+            output.writelines(lines)
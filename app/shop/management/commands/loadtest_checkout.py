@@ -0,0 +1,71 @@
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+import shop.models
+
+
+class Command(BaseCommand):
+    help = "Run full checkouts against the Stripe stand-in (STRIPE_FAKE=true) and report the throughput."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=100, help="Number of checkouts.")
+        parser.add_argument('--concurrency', type=int, default=8, help="Number of concurrent customers.")
+
+    def handle(self, *args, **options):
+        if not settings.STRIPE_FAKE:
+            raise CommandError("The load test only runs against the Stripe stand-in, set STRIPE_FAKE=true.")
+        product_pks = list(shop.models.Product.objects.values_list('pk', flat=True))
+        if not product_pks:
+            raise CommandError("Create at least one product first.")
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(lambda i: self.checkout(product_pks), range(options['checkouts'])))
+        elapsed = time.monotonic() - start
+
+        durations = [duration for duration, error in results if error is None]
+        errors = [error for duration, error in results if error is not None]
+        self.stdout.write("%s checkouts in %.2fs: %.1f checkouts/s, %s error(s)" % (
+            len(durations), elapsed, len(durations) / elapsed, len(errors)))
+        if durations:
+            self.stdout.write("Checkout duration: mean %.3fs, median %.3fs, max %.3fs" % (
+                statistics.mean(durations), statistics.median(durations), max(durations)))
+        for error in set(errors):
+            self.stderr.write(error)
+        self.stdout.write("Webhook events pending: %s" % shop.models.WebhookEvent.objects.filter(status='pending').count())
+
+    def checkout(self, product_pks):
+        client = Client(HTTP_HOST=settings.ALLOWED_HOSTS[0])
+        start = time.monotonic()
+        try:
+            product_pk = random.choice(product_pks)
+            client.post(reverse('shop_item', args=[product_pk]), {'product': product_pk, 'quantity': random.randint(1, 3)})
+            client.post(reverse('checkout'), {
+                'contact_first_name': "Load",
+                'contact_last_name': "Test",
+                'contact_email': "loadtest@example.com",
+                'contact_phone': "0000000000",
+                'address': "Rue du Test 1",
+                'address_zipcode': "1000",
+                'address_city': "Bruxelles",
+            })
+            response = client.get(reverse('stripe_create_payment')).json()
+            if 'clientSecret' not in response:
+                return time.monotonic() - start, response.get('error')
+            # The browser confirms the payment with Stripe.js, Stripe then calls the webhook
+            stripe.PaymentIntent.confirm(response['clientSecret'].split('_secret_')[0], api_key=settings.STRIPE_SECRET_KEY)
+        except Exception as e:
+            return time.monotonic() - start, "%s: %s" % (e.__class__.__name__, e)
+        finally:
+            connection.close()
+        return time.monotonic() - start, None
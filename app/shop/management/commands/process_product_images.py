@@ -0,0 +1,45 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+
+import shop.models
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Generate the responsive variants of the uploaded product pictures."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10, help="Number of pictures claimed at once.")
+        parser.add_argument('--sleep', type=float, default=1.0, help="Seconds to wait when there is no picture to process.")
+        parser.add_argument('--once', action='store_true', help="Stop when there is no picture left to process.")
+
+    def handle(self, *args, **options):
+        processed = 0
+        try:
+            while True:
+                try:
+                    tasks = shop.models.ProductImageTask.claim_batch(options['batch_size'])
+                except DatabaseError:
+                    logger.exception("Unable to claim product pictures")
+                    time.sleep(options['sleep'])
+                    continue
+                if not tasks:
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+                    continue
+
+                for task in tasks:
+                    task.process()
+                    if task.status == 'done':
+                        processed += 1
+                    elif task.status == 'dead':
+                        logger.error("Picture of product %s abandoned: %s", task.product_id, task.last_error)
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS("%s picture(s) processed." % processed))
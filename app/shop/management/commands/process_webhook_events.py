@@ -0,0 +1,60 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+
+import shop.models
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Process the Stripe webhook events stored by the stripe_webhook view."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help="Number of worker threads.")
+        parser.add_argument('--batch-size', type=int, default=10, help="Number of events claimed at once by a worker.")
+        parser.add_argument('--sleep', type=float, default=1.0, help="Seconds to wait when there is no event to process.")
+        parser.add_argument('--once', action='store_true', help="Stop when there is no event left to process.")
+
+    def handle(self, *args, **options):
+        self.stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = [
+                executor.submit(self.work, options['batch_size'], options['sleep'], options['once'])
+                for i in range(options['workers'])
+            ]
+            try:
+                processed = sum(future.result() for future in futures)
+            except KeyboardInterrupt:
+                self.stop.set()
+                processed = sum(future.result() for future in futures)
+        self.stdout.write(self.style.SUCCESS("%s event(s) processed." % processed))
+
+    def work(self, batch_size, sleep, once):
+        processed = 0
+        try:
+            while not self.stop.is_set():
+                try:
+                    events = shop.models.WebhookEvent.claim_batch(batch_size)
+                except DatabaseError:
+                    # Another worker holds the lock (sqlite does not support skip_locked)
+                    logger.exception("Unable to claim webhook events")
+                    time.sleep(sleep)
+                    continue
+                for event in events:
+                    event.process()
+                    if event.status == 'dead':
+                        logger.error("Webhook event %s abandoned: %s", event.stripe_event_id, event.last_error)
+                processed += len(events)
+                if not events:
+                    if once:
+                        break
+                    time.sleep(sleep)
+        finally:
+            connection.close()
+        return processed
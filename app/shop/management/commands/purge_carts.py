@@ -0,0 +1,65 @@
+import time
+from datetime import timedelta
+
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+import shop.models
+
+
+class Command(BaseCommand):
+    help = "Delete inactive and abandoned anonymous carts, with their items, and expired sessions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help="Delete carts not modified for this number of days.")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Number of rows deleted per transaction.")
+        parser.add_argument('--sleep', type=float, default=0.1, help="Seconds to wait between two chunks.")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the rows to delete.")
+
+    def handle(self, *args, **options):
+        carts = shop.models.Cart.objects.filter(
+            Q(is_active=False) | Q(customer__isnull=True),
+            updated_at__lt=timezone.now() - timedelta(days=options['days']),
+        )
+        sessions = Session.objects.filter(expire_date__lt=timezone.now())
+
+        if options['dry_run']:
+            self.stdout.write("%s cart(s), %s cart item(s) and %s session(s) to delete." % (
+                carts.count(), shop.models.CartItem.objects.filter(cart__in=carts).count(), sessions.count()))
+            return
+
+        deleted_carts = self.purge(carts, options['chunk_size'], options['sleep'])
+        deleted_sessions = self.purge(sessions, options['chunk_size'], options['sleep'])
+        self.stdout.write(self.style.SUCCESS("%s cart(s) and %s session(s) deleted." % (deleted_carts, deleted_sessions)))
+
+    def purge(self, queryset, chunk_size, sleep):
+        deleted = 0
+        while True:
+            pks = list(queryset.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return deleted
+            chunk = queryset.filter(pk__in=pks)  # rows changed meanwhile are kept
+            with transaction.atomic():
+                if queryset.model is shop.models.Cart:
+                    # The cart items first, so deleting the carts has nothing to cascade
+                    shop.models.CartItem.objects.filter(cart__in=chunk.values('pk')).delete()
+                deleted += self.delete_rows(chunk)
+            time.sleep(sleep)
+
+    def delete_rows(self, queryset):
+        """
+        Delete the rows of `queryset` with a single DELETE. QuerySet.delete would load every cart to
+        collect its items, because of the CartItem foreign key.
+        """
+        connection = connections[queryset.db]
+        sql, params = queryset.values('pk').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                connection.ops.quote_name(queryset.model._meta.db_table),
+                connection.ops.quote_name(queryset.model._meta.pk.column),
+                sql,
+            ), params)
+            return cursor.rowcount
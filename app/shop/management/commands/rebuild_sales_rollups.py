@@ -0,0 +1,41 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+import shop.exports
+import shop.models
+
+
+class Command(BaseCommand):
+    help = "Recompute the daily sales rollups from the invoices."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from', type=date.fromisoformat, help="First day (YYYY-MM-DD).")
+        parser.add_argument('--to', dest='date_to', type=date.fromisoformat, help="Last day (YYYY-MM-DD), included.")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Number of invoices read at once.")
+
+    def handle(self, *args, **options):
+        invoices = shop.models.Invoice.objects.all()
+        rollups = [model.objects.all() for model in shop.models.SalesRollup.MODELS]
+        if options['date_from']:
+            invoices = invoices.filter(invoice_date__gte=options['date_from'])
+            rollups = [queryset.filter(date__gte=options['date_from']) for queryset in rollups]
+        if options['date_to']:
+            invoices = invoices.filter(invoice_date__lte=options['date_to'])
+            rollups = [queryset.filter(date__lte=options['date_to']) for queryset in rollups]
+
+        days = 0
+        with transaction.atomic():
+            for queryset in rollups:
+                queryset.delete()
+            # Invoices come in invoice_date order, the rows of a day are written once the day is complete
+            sales_rollup, current_date = shop.models.SalesRollup(), None
+            for invoice_instance, invoiceitems in shop.exports.iter_invoices(invoices, options['chunk_size']):
+                if invoice_instance.invoice_date != current_date:
+                    sales_rollup.create()
+                    sales_rollup, current_date = shop.models.SalesRollup(), invoice_instance.invoice_date
+                    days += 1
+                sales_rollup.add_invoice(invoice_instance.invoice_date, invoiceitems)
+            sales_rollup.create()
+        self.stdout.write(self.style.SUCCESS("Sales of %s day(s) rebuilt." % days))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+import shop.search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product full-text search index (only needed on sqlite, PostgreSQL keeps its index up to date)."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            shop.search.get_search_backend().rebuild()
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt."))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+import shop.models
+
+
+class Command(BaseCommand):
+    help = "Add the new invoices to the \"customers also bought\" recommendations of the product pages."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of invoices processed per transaction.")
+        parser.add_argument('--rebuild', action='store_true', help="Recompute the recommendations from all the invoices.")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            with transaction.atomic():
+                shop.models.RelatedProduct.objects.all().delete()
+                shop.models.ProductPair.objects.all().delete()
+                shop.models.Invoice.objects.filter(related_products_indexed=True).update(related_products_indexed=False)
+        processed = shop.models.refresh_related_products(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS("%s invoice(s) processed." % processed))
@@ -0,0 +1,50 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+import djangostripe.routers
+import shop.invoice_pdf
+import shop.models
+
+
+def init_worker():
+    # Needed when the processes are spawned instead of forked
+    django.setup()
+
+
+def render_invoice(invoice_pk):
+    # Paid invoices do not change, they can be read from the replica
+    invoice_instance = shop.models.Invoice.objects.using(djangostripe.routers.get_read_db()).get(pk=invoice_pk)
+    return shop.invoice_pdf.get_invoice_pdf(invoice_instance)
+
+
+class Command(BaseCommand):
+    help = "Render the PDF of the invoices of a month, with a pool of processes. Cached PDFs are not rendered again."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help="Month to render (YYYY-MM), the previous month by default.")
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help="Number of worker processes.")
+
+    def handle(self, *args, **options):
+        if options['month']:
+            try:
+                month = datetime.strptime(options['month'], '%Y-%m').date()
+            except ValueError:
+                raise CommandError("The month must be formatted as YYYY-MM.")
+        else:
+            month = (timezone.localdate().replace(day=1) - timedelta(days=1)).replace(day=1)
+
+        invoice_pks = list(shop.models.Invoice.objects.using(djangostripe.routers.get_read_db()).filter(
+            invoice_date__year=month.year, invoice_date__month=month.month).order_by('pk').values_list('pk', flat=True))
+        # The worker processes open their own connections, they must not share the ones of this process
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['processes'], initializer=init_worker) as executor:
+            paths = list(executor.map(render_invoice, invoice_pks, chunksize=16))
+        self.stdout.write(self.style.SUCCESS("%s invoice PDF(s) of %s ready in %s." % (
+            len(paths), month.strftime('%Y-%m'), os.path.join(settings.MEDIA_ROOT, shop.invoice_pdf.CACHE_DIR))))
@@ -0,0 +1,55 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+
+import shop.models
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Send the e-mails stored by the queued e-mail backend, over one connection to the mail server."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help="Number of e-mails claimed at once.")
+        parser.add_argument('--sleep', type=float, default=1.0, help="Seconds to wait when there is no e-mail to send.")
+        parser.add_argument('--once', action='store_true', help="Stop when there is no e-mail left to send.")
+
+    def handle(self, *args, **options):
+        connection = get_connection(settings.EMAIL_SEND_BACKEND)
+        sent = 0
+        try:
+            while True:
+                try:
+                    emails = shop.models.QueuedEmail.claim_batch(options['batch_size'])
+                except DatabaseError:
+                    logger.exception("Unable to claim e-mails")
+                    time.sleep(options['sleep'])
+                    continue
+                if not emails:
+                    # Do not keep the connection open while idle, the server would drop it
+                    connection.close()
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+                    continue
+
+                for email in emails:
+                    email.process(connection)
+                    if email.status == 'done':
+                        sent += 1
+                        continue
+                    # The connection may be broken, the next e-mail opens a new one
+                    connection.close()
+                    if email.status == 'dead':
+                        logger.error("E-mail %s abandoned: %s", email.pk, email.last_error)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            connection.close()
+        self.stdout.write(self.style.SUCCESS("%s e-mail(s) sent." % sent))
@@ -0,0 +1,22 @@
+from django.utils.functional import SimpleLazyObject
+
+import shop.models
+
+
+def get_cart(request):
+    """
+    Return the session cart of the request. The cart is resolved at most once per request.
+    """
+    if not hasattr(request, '_cached_cart'):
+        request._cached_cart = shop.models.Cart.get_session_cart(request)
+    return request._cached_cart
+
+
+class CartMiddleware:
+    """ Add a lazy `request.cart` shared by the views and the template tags """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.cart = SimpleLazyObject(lambda: get_cart(request))
+        return self.get_response(request)
@@ -0,0 +1,52 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:01
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def update_cart_totals(apps, schema_editor):
+    Cart = apps.get_model('shop', 'Cart')
+    for cart in Cart.objects.all().iterator():
+        excl_tax_vat = {}
+        items_count = 0
+        for cartitem in cart.cartitem_set.all():
+            vat_key = str(cartitem.product_vat)
+            excl_tax_vat[vat_key] = excl_tax_vat.get(vat_key, Decimal('0.00')) + round(cartitem.product_quantity * cartitem.product_price, 2)
+            items_count += cartitem.product_quantity
+        vat_val = {vat: round(val * Decimal(vat) / 100, 2) for vat, val in excl_tax_vat.items()}
+        cart.items_count = items_count
+        cart.excl_tax = round(sum(excl_tax_vat.values()), 2)
+        cart.vat = {vat: str(val) for vat, val in vat_val.items()}
+        cart.incl_tax = cart.excl_tax + round(sum(vat_val.values()), 2)
+        cart.save(update_fields=['items_count', 'excl_tax', 'vat', 'incl_tax'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='excl_tax',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=15, verbose_name='Montant (HTVA)'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='incl_tax',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=15, verbose_name='Montant (TVAC)'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='items_count',
+            field=models.PositiveIntegerField(default=0, verbose_name="Nombre d'articles"),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='vat',
+            field=models.JSONField(blank=True, default=dict, verbose_name='TVA'),
+        ),
+        migrations.RunPython(update_cart_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0002_cart_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(max_length=6, unique=True, verbose_name='Période')),
+                ('last_number', models.PositiveIntegerField(default=0, verbose_name='Dernier numéro')),
+            ],
+            options={
+                'verbose_name': 'Séquence de facturation',
+                'verbose_name_plural': 'Séquences de facturation',
+            },
+        ),
+        migrations.AlterField(
+            model_name='invoice',
+            name='invoice_number',
+            field=models.CharField(blank=True, max_length=255, unique=True, verbose_name='Numéro'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:04
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0003_invoicesequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe_event_id', models.CharField(max_length=255, unique=True, verbose_name='STRIPE Event ID')),
+                ('event_type', models.CharField(max_length=255, verbose_name='Type')),
+                ('payload', models.JSONField(verbose_name='Contenu')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Reçu le')),
+                ('status', models.CharField(choices=[('pending', 'En attente'), ('processing', 'En cours'), ('done', 'Traité'), ('dead', 'Abandonné')], default='pending', max_length=25, verbose_name='Statut')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Tentatives')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Prochaine tentative')),
+                ('claimed_at', models.DateTimeField(blank=True, null=True, verbose_name='Pris en charge le')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Traité le')),
+                ('last_error', models.TextField(blank=True, verbose_name='Dernière erreur')),
+            ],
+            options={
+                'verbose_name': 'Événement Stripe',
+                'verbose_name_plural': 'Événements Stripe',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='webhookevent',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='shop_webhoo_status_990916_idx'),
+        ),
+    ]
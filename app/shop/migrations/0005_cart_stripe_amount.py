@@ -0,0 +1,28 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0004_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='stripe_amount',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='STRIPE Montant (cents)'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='stripe_client_secret',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='STRIPE Client secret'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='stripe_currency',
+            field=models.CharField(blank=True, max_length=3, null=True, verbose_name='STRIPE Devise'),
+        ),
+    ]
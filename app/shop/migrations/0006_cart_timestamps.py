@@ -0,0 +1,29 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:08
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_cart_stripe_amount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, verbose_name='Créé le'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='Modifié le'),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['is_active', 'updated_at'], name='shop_cart_is_acti_8ce7bc_idx'),
+        ),
+    ]
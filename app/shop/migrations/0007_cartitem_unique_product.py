@@ -0,0 +1,29 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:10
+
+from django.db import migrations, models
+
+
+def merge_duplicate_cartitems(apps, schema_editor):
+    CartItem = apps.get_model('shop', 'CartItem')
+    duplicates = CartItem.objects.filter(product__isnull=False).values('cart', 'product').annotate(
+        count=models.Count('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        cartitems = list(CartItem.objects.filter(cart=duplicate['cart'], product=duplicate['product']).order_by('pk'))
+        cartitems[0].product_quantity = sum(cartitem.product_quantity for cartitem in cartitems)
+        cartitems[0].save(update_fields=['product_quantity'])
+        CartItem.objects.filter(pk__in=[cartitem.pk for cartitem in cartitems[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0006_cart_timestamps'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_cartitems, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='shop_cartitem_unique_product'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_cartitem_unique_product'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['vat', 'id'], name='shop_produc_vat_19c9ed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['price', 'id'], name='shop_produc_price_5e650a_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+import shop.search
+
+
+def setup_search(apps, schema_editor):
+    shop.search.get_search_backend(schema_editor.connection.vendor).setup(schema_editor, apps.get_model('shop', 'Product'))
+
+
+def teardown_search(apps, schema_editor):
+    shop.search.get_search_backend(schema_editor.connection.vendor).teardown(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_product_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(setup_search, teardown_search),
+    ]
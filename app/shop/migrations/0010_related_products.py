@@ -0,0 +1,58 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_product_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='related_products_indexed',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='Pris en compte dans les recommandations'),
+        ),
+        migrations.CreateModel(
+            name='RelatedProduct',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveIntegerField(verbose_name='Rang')),
+                ('invoices_count', models.PositiveIntegerField(default=0, verbose_name='Nombre de factures')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shop.product', verbose_name='Produit')),
+                ('related_product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommended_by', to='shop.product', verbose_name='Produit associé')),
+            ],
+            options={
+                'verbose_name': 'Produit associé',
+                'verbose_name_plural': 'Produits associés',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductPair',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('invoices_count', models.PositiveIntegerField(default=0, verbose_name='Nombre de factures')),
+                ('other_product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shop.product', verbose_name='Autre produit')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shop.product', verbose_name='Produit')),
+            ],
+            options={
+                'verbose_name': 'Paire de produits',
+                'verbose_name_plural': 'Paires de produits',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='relatedproduct',
+            constraint=models.UniqueConstraint(fields=('product', 'rank'), name='shop_relatedproduct_unique_rank'),
+        ),
+        migrations.AddIndex(
+            model_name='productpair',
+            index=models.Index(fields=['product', '-invoices_count'], name='shop_produc_product_dad61b_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='productpair',
+            constraint=models.UniqueConstraint(fields=('product', 'other_product'), name='shop_productpair_unique'),
+        ),
+    ]
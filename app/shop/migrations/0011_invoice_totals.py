@@ -0,0 +1,32 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_related_products'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='excl_tax',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=15, null=True, verbose_name='Montant (HTVA)'),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='incl_tax',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=15, null=True, verbose_name='Montant (TVAC)'),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='vat',
+            field=models.JSONField(blank=True, default=dict, verbose_name='TVA'),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['incl_tax'], name='shop_invoic_incl_ta_23a6d6_idx'),
+        ),
+    ]
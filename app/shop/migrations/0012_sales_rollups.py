@@ -0,0 +1,72 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:21
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_invoice_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyProductSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Date')),
+                ('quantity', models.PositiveIntegerField(default=0, verbose_name='Quantité')),
+                ('excl_tax', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=15, verbose_name='Montant (HTVA)')),
+            ],
+            options={
+                'verbose_name': 'Ventes journalières (Produit)',
+                'verbose_name_plural': 'Ventes journalières (Produits)',
+            },
+        ),
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True, verbose_name='Date')),
+                ('invoices_count', models.PositiveIntegerField(default=0, verbose_name='Nombre de factures')),
+                ('excl_tax', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=15, verbose_name='Montant (HTVA)')),
+                ('vat_amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=15, verbose_name='Montant TVA')),
+                ('incl_tax', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=15, verbose_name='Montant (TVAC)')),
+            ],
+            options={
+                'verbose_name': 'Ventes journalières',
+                'verbose_name_plural': 'Ventes journalières',
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyVatSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Date')),
+                ('vat', models.PositiveIntegerField(verbose_name='TVA (%)')),
+                ('invoices_count', models.PositiveIntegerField(default=0, verbose_name='Nombre de factures')),
+                ('excl_tax', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=15, verbose_name='Montant (HTVA)')),
+                ('vat_amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=15, verbose_name='Montant TVA')),
+                ('incl_tax', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=15, verbose_name='Montant (TVAC)')),
+            ],
+            options={
+                'verbose_name': 'Ventes journalières (TVA)',
+                'verbose_name_plural': 'Ventes journalières (TVA)',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailyvatsales',
+            constraint=models.UniqueConstraint(fields=('date', 'vat'), name='shop_dailyvatsales_unique'),
+        ),
+        migrations.AddField(
+            model_name='dailyproductsales',
+            name='product',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='shop.product', verbose_name='Produit'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyproductsales',
+            constraint=models.UniqueConstraint(fields=('date', 'product'), name='shop_dailyproductsales_unique'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:23
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0012_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'En attente'), ('processing', 'En cours'), ('done', 'Traité'), ('dead', 'Abandonné')], default='pending', max_length=25, verbose_name='Statut')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Tentatives')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Prochaine tentative')),
+                ('claimed_at', models.DateTimeField(blank=True, null=True, verbose_name='Pris en charge le')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Traité le')),
+                ('last_error', models.TextField(blank=True, verbose_name='Dernière erreur')),
+                ('subject', models.CharField(max_length=255, verbose_name='Sujet')),
+                ('recipients', models.JSONField(default=list, verbose_name='Destinataires')),
+                ('from_email', models.CharField(blank=True, max_length=255, verbose_name='Expéditeur')),
+                ('message', models.BinaryField(verbose_name='Message')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Créé le')),
+            ],
+            options={
+                'verbose_name': 'E-mail en attente',
+                'verbose_name_plural': 'E-mails en attente',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='queuedemail',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='shop_queued_status_ed571c_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0013_queuedemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='picture',
+            field=models.ImageField(blank=True, null=True, upload_to='product', verbose_name='Image'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='picture_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name="Variantes de l'image"),
+        ),
+        migrations.CreateModel(
+            name='ProductImageTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'En attente'), ('processing', 'En cours'), ('done', 'Traité'), ('dead', 'Abandonné')], default='pending', max_length=25, verbose_name='Statut')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Tentatives')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Prochaine tentative')),
+                ('claimed_at', models.DateTimeField(blank=True, null=True, verbose_name='Pris en charge le')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Traité le')),
+                ('last_error', models.TextField(blank=True, verbose_name='Dernière erreur')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Créé le')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='shop.product', verbose_name='Produit')),
+            ],
+            options={
+                'verbose_name': "Génération d'image",
+                'verbose_name_plural': "Générations d'images",
+            },
+        ),
+        migrations.AddIndex(
+            model_name='productimagetask',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='shop_produc_status_a8393f_idx'),
+        ),
+    ]
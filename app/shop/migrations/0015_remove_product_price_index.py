@@ -0,0 +1,17 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:45
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0014_product_picture'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='product',
+            name='shop_produc_price_5e650a_idx',
+        ),
+    ]
@@ -1,10 +1,28 @@
+import functools
+import itertools
+import logging
+import operator
+from collections import Counter
+from datetime import timedelta
 from decimal import Decimal
 
 from django.contrib.sessions.models import Session
-from django.db import models
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.mail import EmailMessage, get_connection
+from django.db import models, transaction
+from django.db.models.functions import Greatest
+from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+import djangostripe.mail
+import shop.cache
+import shop.carts
+import shop.images
+
+
+logger = logging.getLogger(__name__)
+
 
 # Product Model
 class Product(models.Model):
@@ -13,10 +31,16 @@ class Product(models.Model):
     description = models.TextField(verbose_name=_("Description"))
     vat = models.PositiveIntegerField(verbose_name=_("TVA (%)"), default=21)
     price = models.DecimalField(verbose_name=_("Prix (HTVA)"), max_digits=15, decimal_places=2, default=Decimal("0.00"))
+    picture = models.ImageField(verbose_name=_("Image"), upload_to='product', blank=True, null=True)
+    picture_variants = models.JSONField(verbose_name=_("Variantes de l'image"), default=dict, blank=True, editable=False)  # Generated by ProductImageTask
 
     class Meta:
         verbose_name = _("Produit")
         verbose_name_plural = _("Produits")
+        indexes = [
+            # The VAT filter, in the pk order of the catalog pages
+            models.Index(fields=['vat', 'id']),
+        ]
 
     def __str__(self):
         return self.name
@@ -29,25 +53,139 @@ class Product(models.Model):
     def get_incl_tax(self):
         return round(self.price * (1+Decimal(self.vat) / 100), 2)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # The variants are generated in the background when a new picture is uploaded
+        if (self.picture.name or None) != self.picture_variants.get('source'):
+            # A pending task reads the picture when it runs, it also covers this one
+            if not ProductImageTask.objects.filter(product=self, status='pending').exists():
+                ProductImageTask.objects.create(product=self)
+
+    def get_picture(self, variant_name):
+        """
+        Informations to display the picture variant: src, srcset, webp_srcset, width and height.
+        """
+        variant = self.picture_variants.get(variant_name)
+        if not variant:
+            width, height = shop.images.VARIANTS[variant_name]
+            return {'src': staticfiles_storage.url('img/product.svg'), 'width': width, 'height': height}
+        return {
+            'src': variant['jpeg'][0]['url'],
+            'srcset': shop.images.get_srcset(variant['jpeg']),
+            'webp_srcset': shop.images.get_srcset(variant['webp']),
+            'width': variant['jpeg'][0]['width'],
+            'height': variant['jpeg'][0]['height'],
+        }
+
+    def get_card_picture(self):
+        return self.get_picture('card')
+
+    def get_detail_picture(self):
+        return self.get_picture('detail')
+
     def get_picture_url(self):
-        return "https://dummyimage.com/450x300/dee2e6/6c757d.jpg"
-    
+        return self.get_card_picture()['src']
+
     def get_large_picture_url(self):
-        return "https://dummyimage.com/600x700/dee2e6/6c757d.jpg"
+        return self.get_detail_picture()['src']
+
+    def get_related_products(self, count=4):
+        """
+        Products most often bought with this one, precomputed by refresh_related_products.
+        """
+        return Product.objects.filter(recommended_by__product=self).order_by('recommended_by__rank')[:count]
+
+
+# Prices
+def compute_excl_tax_vat(items):
+    """
+    Compute the excl_tax amount foreach vat of InvoiceItem or CartItem instances.
+    """
+    excl_tax_vat = {}
+    for item_instance in items:
+        # Vat
+        vat_key = str(item_instance.product_vat)
+        if vat_key not in excl_tax_vat:
+            excl_tax_vat[vat_key] = Decimal('0.00')
+        # Price
+        excl_tax_vat[vat_key] += item_instance.get_total()
+    return excl_tax_vat
+
+
+def compute_prices(items):
+    """
+    Compute excl_tax, vat and incl_tax amounts of InvoiceItem or CartItem instances.
+    """
+    excl_tax_vat = compute_excl_tax_vat(items)
+    excl_tax = round(sum(excl_tax_vat.values()), 2)
+
+    vat_val = {}
+    for vat, val in excl_tax_vat.items():
+        vat_val[vat] = round(val * Decimal(vat) / 100, 2)
+
+    return {
+        'excl_tax': excl_tax,
+        'vat': vat_val,
+        'incl_tax': excl_tax + round(sum(vat_val.values()), 2),
+    }
+
+
+def compute_vat_totals(items):
+    """
+    Compute the excl_tax, vat and incl_tax amounts foreach vat, rounded like compute_prices so that
+    they add up to its totals.
+    """
+    vat_totals = {}
+    for vat, excl_tax in sorted(compute_excl_tax_vat(items).items(), key=lambda item: int(item[0])):
+        vat_amount = round(excl_tax * Decimal(vat) / 100, 2)
+        vat_totals[vat] = {'excl_tax': round(excl_tax, 2), 'vat': vat_amount, 'incl_tax': round(excl_tax, 2) + vat_amount}
+    return vat_totals
 
 
 # Invoice Models
+class InvoiceSequence(models.Model):
+    """
+    Last invoice number handed out for a month. The row is locked while numbers are allocated.
+    """
+    period = models.CharField(verbose_name=_("Période"), max_length=6, unique=True)  # YYYYMM
+    last_number = models.PositiveIntegerField(verbose_name=_("Dernier numéro"), default=0)
+
+    class Meta:
+        verbose_name = _("Séquence de facturation")
+        verbose_name_plural = _("Séquences de facturation")
+
+    def __str__(self):
+        return "%s (%s)" % (self.period, self.last_number)
+
+
+def allocate_invoice_numbers(count=1):
+    """
+    Reserve `count` consecutive invoice numbers (YYYYMMNNNN) of the current month.
+    The numbers are released if the surrounding transaction is rolled back, so there are no gaps.
+    """
+    code_prefix = timezone.now().strftime("%Y%m")
+    with transaction.atomic():
+        # The update locks the sequence row until the end of the transaction
+        updated = InvoiceSequence.objects.filter(period=code_prefix).update(last_number=models.F('last_number') + count)
+        if not updated:
+            # First invoice of the month: start after the invoices created before the sequence existed
+            last_invoice_number = Invoice.objects.filter(invoice_number__startswith=code_prefix).aggregate(
+                last=models.Max('invoice_number'))['last']
+            InvoiceSequence.objects.get_or_create(period=code_prefix, defaults={
+                'last_number': int(last_invoice_number[-4:]) if last_invoice_number else 0})
+            InvoiceSequence.objects.filter(period=code_prefix).update(last_number=models.F('last_number') + count)
+        last_number = InvoiceSequence.objects.filter(period=code_prefix).values_list('last_number', flat=True).get()
+    return [
+        "{code_prefix}{code}".format(code_prefix=code_prefix, code=format(number, '04d'))
+        for number in range(last_number - count + 1, last_number + 1)
+    ]
+
+
 def generate_invoice_number():
     """
     Generate invoice_number for the Invoice. The number should follow each other.
     """
-    code_prefix = timezone.now().strftime("%Y%m")
-    last_invoices = Invoice.objects.filter(invoice_number__startswith=code_prefix).values_list('invoice_number', flat=True)
-    if len(last_invoices) == 0:
-        return "{code_prefix}{code}".format(code_prefix=code_prefix, code=format(1, '04d'))
-    else:
-        next_code = max(map(int, [i[-4:] for i in last_invoices])) + 1
-        return "{code_prefix}{code}".format(code_prefix=code_prefix, code=format(next_code, '04d'))
+    return allocate_invoice_numbers()[0]
 
 
 class Invoice(models.Model):
@@ -57,7 +195,7 @@ class Invoice(models.Model):
     )
 
     # Invoice informations
-    invoice_number = models.CharField(verbose_name=_("Numéro"), max_length=255, unique=True, default=generate_invoice_number)
+    invoice_number = models.CharField(verbose_name=_("Numéro"), max_length=255, unique=True, blank=True)  # Generated on first save
     invoice_date = models.DateField(verbose_name=_("Date de facturation"), default=timezone.now)
     invoice_status = models.CharField(verbose_name=_("Statut"), max_length=25, choices=STATUS_CHOICES, default='waiting')
     
@@ -79,38 +217,74 @@ class Invoice(models.Model):
     # STRIPE Informations
     stripe_payment_intent_id = models.CharField(verbose_name=_('STRIPE PaymentIntent ID'), max_length=30, unique=True, null=True, blank=True)  # Needed when payment via stripe
 
+    # Totals, frozen when the invoice is created (NULL until backfilled for older invoices)
+    excl_tax = models.DecimalField(verbose_name=_("Montant (HTVA)"), max_digits=15, decimal_places=2, blank=True, null=True)
+    vat = models.JSONField(verbose_name=_("TVA"), default=dict, blank=True)
+    incl_tax = models.DecimalField(verbose_name=_("Montant (TVAC)"), max_digits=15, decimal_places=2, blank=True, null=True)
+
+    # Recommendations
+    related_products_indexed = models.BooleanField(verbose_name=_("Pris en compte dans les recommandations"), default=False, db_index=True)
+
+    TOTALS_FIELDS = ('excl_tax', 'vat', 'incl_tax', )
+
     class Meta:
         verbose_name = _("Facture")
         verbose_name_plural = _("Factures")
+        indexes = [
+            models.Index(fields=['incl_tax']),
+        ]
 
     def __str__(self):
         return self.invoice_number
 
+    def save(self, *args, **kwargs):
+        if self.invoice_number:
+            return super().save(*args, **kwargs)
+        # Allocate the number in the same transaction as the invoice, so a failed save does not leave a gap
+        with transaction.atomic():
+            self.invoice_number = generate_invoice_number()
+            return super().save(*args, **kwargs)
+
     def get_prices(self):
-        excl_tax_vat = {}  # calculate excl_tax foreach vat
-        for invoiceitem_instance in self.invoiceitem_set.all():
-            # Vat
-            vat_key = str(invoiceitem_instance.product_vat)
-            if vat_key not in excl_tax_vat:
-                excl_tax_vat[vat_key] = Decimal('0.00')
-            # Price
-            excl_tax_vat[vat_key] += invoiceitem_instance.get_total()
-        excl_tax = round(sum(excl_tax_vat.values()), 2)
-
-        vat_val = {}
-        for vat, val in excl_tax_vat.items():
-            vat_val[vat] = round(val * Decimal(vat) / 100, 2)
+        if self.incl_tax is None:
+            return compute_prices(self.invoiceitem_set.all())
+        return {
+            'excl_tax': self.excl_tax,
+            'vat': {vat: Decimal(val) for vat, val in self.vat.items()},
+            'incl_tax': self.incl_tax,
+        }
 
+    def compute_totals(self, invoiceitems=None):
+        prices = compute_prices(self.invoiceitem_set.all() if invoiceitems is None else invoiceitems)
         return {
-            'excl_tax': excl_tax,
-            'vat': vat_val,
-            'incl_tax': excl_tax + round(sum(vat_val.values()), 2),
+            'excl_tax': prices['excl_tax'],
+            'vat': {vat: str(val) for vat, val in prices['vat'].items()},
+            'incl_tax': prices['incl_tax'],
         }
 
+    def update_totals(self):
+        """
+        Store the totals of the invoice items on the invoice.
+        """
+        for field, value in self.compute_totals().items():
+            setattr(self, field, value)
+        self.save(update_fields=self.TOTALS_FIELDS)
+
     def get_total(self):
         return self.get_prices().get('incl_tax')
     get_total.short_description = _("Montant (TVAC)")
 
+    def get_confirmation_email(self, invoiceitems=None):
+        recipient = self.contact_email or (self.customer.email if self.customer else None)
+        return EmailMessage(
+            subject="Order confirmation %s" % self.invoice_number,
+            body=render_to_string("shop/emails/order_confirmation.txt", {
+                'invoice': self,
+                'invoiceitems': self.invoiceitem_set.all() if invoiceitems is None else invoiceitems,
+            }),
+            to=[recipient] if recipient else [],
+        )
+
 
 class InvoiceItem(models.Model):
     # Main information
@@ -141,6 +315,230 @@ class InvoiceItem(models.Model):
         return round(self.product_quantity * self.product_price, 2)
 
 
+# Recommendation Models
+class ProductPair(models.Model):
+    """
+    Number of invoices containing both products. Each pair is stored in both directions.
+    """
+    product = models.ForeignKey('Product', verbose_name=_("Produit"), on_delete=models.CASCADE, related_name='+')
+    other_product = models.ForeignKey('Product', verbose_name=_("Autre produit"), on_delete=models.CASCADE, related_name='+')
+    invoices_count = models.PositiveIntegerField(verbose_name=_("Nombre de factures"), default=0)
+
+    class Meta:
+        verbose_name = _("Paire de produits")
+        verbose_name_plural = _("Paires de produits")
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'other_product'], name='shop_productpair_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['product', '-invoices_count']),
+        ]
+
+
+class RelatedProduct(models.Model):
+    """
+    Top products bought with a product, read by the product page.
+    """
+    MAX_RANK = 10
+
+    product = models.ForeignKey('Product', verbose_name=_("Produit"), on_delete=models.CASCADE, related_name='+')
+    related_product = models.ForeignKey('Product', verbose_name=_("Produit associé"), on_delete=models.CASCADE,
+        related_name='recommended_by')
+    rank = models.PositiveIntegerField(verbose_name=_("Rang"))
+    invoices_count = models.PositiveIntegerField(verbose_name=_("Nombre de factures"), default=0)
+
+    class Meta:
+        verbose_name = _("Produit associé")
+        verbose_name_plural = _("Produits associés")
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'rank'], name='shop_relatedproduct_unique_rank'),
+        ]
+
+
+def refresh_related_products(batch_size=1000):
+    """
+    Add the invoices not processed yet to the product pairs, then recompute the related products
+    of the products they contain. Returns the number of invoices processed.
+    """
+    processed = 0
+    while True:
+        with transaction.atomic():
+            # Locked so that concurrent runs do not count an invoice twice
+            invoice_pks = list(Invoice.objects.select_for_update().filter(related_products_indexed=False).order_by(
+                'pk').values_list('pk', flat=True)[:batch_size])
+            if not invoice_pks:
+                return processed
+
+            baskets = {}
+            for invoice_pk, product_pk in InvoiceItem.objects.filter(
+                    invoice__in=invoice_pks, product__isnull=False).values_list('invoice', 'product').distinct():
+                baskets.setdefault(invoice_pk, set()).add(product_pk)
+            pair_counts = Counter()
+            for product_pks in baskets.values():
+                pair_counts.update(itertools.permutations(product_pks, 2))
+
+            if pair_counts:
+                add_product_pairs(pair_counts)
+                update_related_products({product_pk for product_pk, other_product_pk in pair_counts})
+            Invoice.objects.filter(pk__in=invoice_pks).update(related_products_indexed=True)
+        processed += len(invoice_pks)
+
+
+def add_product_pairs(pair_counts):
+    """
+    Add `pair_counts` ({(product_pk, other_product_pk): invoices_count}) to the ProductPair rows.
+    """
+    product_pks = {product_pk for product_pk, other_product_pk in pair_counts}
+    other_product_pks = {other_product_pk for product_pk, other_product_pk in pair_counts}
+    pair_instances = {
+        (pair_instance.product_id, pair_instance.other_product_id): pair_instance
+        for pair_instance in ProductPair.objects.select_for_update().filter(
+            product__in=product_pks, other_product__in=other_product_pks)
+    }
+    updated, created = [], []
+    for (product_pk, other_product_pk), invoices_count in pair_counts.items():
+        pair_instance = pair_instances.get((product_pk, other_product_pk))
+        if pair_instance is None:
+            created.append(ProductPair(product_id=product_pk, other_product_id=other_product_pk, invoices_count=invoices_count))
+        else:
+            pair_instance.invoices_count += invoices_count
+            updated.append(pair_instance)
+    ProductPair.objects.bulk_update(updated, ['invoices_count'], batch_size=500)
+    ProductPair.objects.bulk_create(created, batch_size=500)
+
+
+def update_related_products(product_pks):
+    """
+    Recompute the top RelatedProduct.MAX_RANK related products of `product_pks`.
+    """
+    related_product_instances = []
+    for product_pk in product_pks:
+        related_product_instances += [
+            RelatedProduct(product_id=product_pk, related_product_id=other_product_pk, rank=rank, invoices_count=invoices_count)
+            for rank, (other_product_pk, invoices_count) in enumerate(ProductPair.objects.filter(product=product_pk).order_by(
+                '-invoices_count', 'other_product').values_list('other_product', 'invoices_count')[:RelatedProduct.MAX_RANK])
+        ]
+    RelatedProduct.objects.filter(product__in=product_pks).delete()
+    RelatedProduct.objects.bulk_create(related_product_instances, batch_size=500)
+    transaction.on_commit(shop.cache.bump_version)
+
+
+# Sales Models
+class DailySales(models.Model):
+    """
+    Sales of a day, updated when an invoice is created.
+    """
+    date = models.DateField(verbose_name=_("Date"), unique=True)
+    invoices_count = models.PositiveIntegerField(verbose_name=_("Nombre de factures"), default=0)
+    excl_tax = models.DecimalField(verbose_name=_("Montant (HTVA)"), max_digits=15, decimal_places=2, default=Decimal("0.00"))
+    vat_amount = models.DecimalField(verbose_name=_("Montant TVA"), max_digits=15, decimal_places=2, default=Decimal("0.00"))
+    incl_tax = models.DecimalField(verbose_name=_("Montant (TVAC)"), max_digits=15, decimal_places=2, default=Decimal("0.00"))
+
+    KEY_FIELDS = ('date', )
+    SUM_FIELDS = ('invoices_count', 'excl_tax', 'vat_amount', 'incl_tax', )
+
+    class Meta:
+        verbose_name = _("Ventes journalières")
+        verbose_name_plural = _("Ventes journalières")
+
+
+class DailyVatSales(models.Model):
+    """
+    Sales of a day foreach vat rate, updated when an invoice is created.
+    """
+    date = models.DateField(verbose_name=_("Date"))
+    vat = models.PositiveIntegerField(verbose_name=_("TVA (%)"))
+    invoices_count = models.PositiveIntegerField(verbose_name=_("Nombre de factures"), default=0)
+    excl_tax = models.DecimalField(verbose_name=_("Montant (HTVA)"), max_digits=15, decimal_places=2, default=Decimal("0.00"))
+    vat_amount = models.DecimalField(verbose_name=_("Montant TVA"), max_digits=15, decimal_places=2, default=Decimal("0.00"))
+    incl_tax = models.DecimalField(verbose_name=_("Montant (TVAC)"), max_digits=15, decimal_places=2, default=Decimal("0.00"))
+
+    KEY_FIELDS = ('date', 'vat', )
+    SUM_FIELDS = ('invoices_count', 'excl_tax', 'vat_amount', 'incl_tax', )
+
+    class Meta:
+        verbose_name = _("Ventes journalières (TVA)")
+        verbose_name_plural = _("Ventes journalières (TVA)")
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'vat'], name='shop_dailyvatsales_unique'),
+        ]
+
+
+class DailyProductSales(models.Model):
+    """
+    Quantity and amount sold of a product in a day, updated when an invoice is created.
+    """
+    date = models.DateField(verbose_name=_("Date"))
+    product = models.ForeignKey('Product', verbose_name=_("Produit"), on_delete=models.SET_NULL, blank=True, null=True)
+    quantity = models.PositiveIntegerField(verbose_name=_("Quantité"), default=0)
+    excl_tax = models.DecimalField(verbose_name=_("Montant (HTVA)"), max_digits=15, decimal_places=2, default=Decimal("0.00"))
+
+    KEY_FIELDS = ('date', 'product_id', )
+    SUM_FIELDS = ('quantity', 'excl_tax', )
+
+    class Meta:
+        verbose_name = _("Ventes journalières (Produit)")
+        verbose_name_plural = _("Ventes journalières (Produits)")
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'product'], name='shop_dailyproductsales_unique'),
+        ]
+
+
+class SalesRollup:
+    """
+    Sales of invoices summed in the DailySales, DailyVatSales and DailyProductSales rows.
+    Lines of deleted products are not counted per product.
+    """
+    MODELS = (DailySales, DailyVatSales, DailyProductSales, )
+
+    def __init__(self):
+        self.rows = {model: {} for model in self.MODELS}
+
+    def get_row(self, model, *key):
+        return self.rows[model].setdefault(key, dict.fromkeys(model.SUM_FIELDS, 0))
+
+    def add_invoice(self, invoice_date, invoiceitems):
+        for vat, totals in compute_vat_totals(invoiceitems).items():
+            for row in (self.get_row(DailySales, invoice_date), self.get_row(DailyVatSales, invoice_date, int(vat))):
+                row['excl_tax'] += totals['excl_tax']
+                row['vat_amount'] += totals['vat']
+                row['incl_tax'] += totals['incl_tax']
+            self.get_row(DailyVatSales, invoice_date, int(vat))['invoices_count'] += 1
+        self.get_row(DailySales, invoice_date)['invoices_count'] += 1
+        for item_instance in invoiceitems:
+            if item_instance.product_id is None:
+                continue
+            row = self.get_row(DailyProductSales, invoice_date, item_instance.product_id)
+            row['quantity'] += item_instance.product_quantity
+            row['excl_tax'] += item_instance.get_total()
+
+    def create(self):
+        """
+        Create the rollup rows, when rebuilding a period without rows.
+        """
+        for model, rows in self.rows.items():
+            model.objects.bulk_create([
+                model(**dict(zip(model.KEY_FIELDS, key)), **row) for key, row in rows.items()
+            ], batch_size=500)
+
+    def add(self):
+        """
+        Add the sales to the existing rollup rows, with one UPDATE per model.
+        """
+        for model, rows in self.rows.items():
+            if not rows:
+                continue
+            # Missing rows are created empty, then every row is incremented
+            model.objects.bulk_create([model(**dict(zip(model.KEY_FIELDS, key))) for key in rows], ignore_conflicts=True)
+            conditions = {key: models.Q(**dict(zip(model.KEY_FIELDS, key))) for key in rows}
+            model.objects.filter(functools.reduce(operator.or_, conditions.values())).update(**{
+                field: models.F(field) + models.Case(*[
+                    models.When(conditions[key], then=models.Value(row[field])) for key, row in rows.items()
+                ], default=models.Value(0), output_field=model._meta.get_field(field).clone())
+                for field in model.SUM_FIELDS
+            })
+
+
 # Cart Models
 class Cart(models.Model):
     class Meta:
@@ -164,84 +562,169 @@ class Cart(models.Model):
 
     # Stripe
     stripe_payment_intent_id = models.CharField(verbose_name=_('STRIPE PaymentIntent ID'), max_length=30, unique=True, null=True, blank=True)  # Needed when payment via stripe
+    stripe_client_secret = models.CharField(verbose_name=_('STRIPE Client secret'), max_length=255, null=True, blank=True)
+    stripe_amount = models.PositiveIntegerField(verbose_name=_('STRIPE Montant (cents)'), null=True, blank=True)  # Last amount sent to stripe
+    stripe_currency = models.CharField(verbose_name=_('STRIPE Devise'), max_length=3, null=True, blank=True)  # Last currency sent to stripe
+
+    # Totals (kept up to date by update_totals)
+    items_count = models.PositiveIntegerField(verbose_name=_("Nombre d'articles"), default=0)
+    excl_tax = models.DecimalField(verbose_name=_("Montant (HTVA)"), max_digits=15, decimal_places=2, default=Decimal("0.00"))
+    vat = models.JSONField(verbose_name=_("TVA"), default=dict, blank=True)
+    incl_tax = models.DecimalField(verbose_name=_("Montant (TVAC)"), max_digits=15, decimal_places=2, default=Decimal("0.00"))
 
     # Active
     is_active = models.BooleanField(verbose_name=_("Est actif?"), default=True)
+    created_at = models.DateTimeField(verbose_name=_("Créé le"), auto_now_add=True)
+    updated_at = models.DateTimeField(verbose_name=_("Modifié le"), auto_now=True)
+
+    TOTALS_FIELDS = ('items_count', 'excl_tax', 'vat', 'incl_tax', )
 
     class Meta:
         verbose_name = _("Panier")
         verbose_name_plural = _("Paniers")
+        indexes = [
+            models.Index(fields=['is_active', 'updated_at']),
+        ]
+
+    # Carts kept in the cache by shop.carts.CacheCartStorage, until they are written to the database
+    cart_key = None
+    cached_items = None
 
     @classmethod
     def get_session_cart(cls, request):
+        """
+        Return the cart of the session or of the connected user.
+        When there is no cart yet, an unsaved cart is returned: it is only stored by `persist`,
+        before its first change, so read-only visits do not create carts.
+        """
         # Accesss current session cart
-        session_cart_instance = None
-        if 'cart_pk' in request.session and request.session['cart_pk']:
-            session_cart_instance = cls.objects.filter(pk=request.session['cart_pk'], is_active=True).first()
-        if session_cart_instance is None:
-            session_cart_instance = cls.objects.create()
+        storage = shop.carts.get_cart_storage()
+        session_cart_instance = storage.load(request)
 
         # If user is connected, check if session cart is user cart.
         cart_instance = session_cart_instance
-        if request.user.is_authenticated:
-            cart_instance, created = cls.objects.get_or_create(is_active=True, customer=request.user)
-            if session_cart_instance.pk != cart_instance.pk:
-                # Copy session cart into user cart
-                for session_cartitem_instance in session_cart_instance.cartitem_set.all():
-                    cartitem_instance = cart_instance.cartitem_set.filter(product=session_cartitem_instance.product).first() if session_cartitem_instance.product else None
-                    if cartitem_instance:
-                        cartitem_instance.product_quantity = cartitem_instance.product_quantity + session_cartitem_instance.product_quantity
-                        cartitem_instance.save()
+        if request.user.is_authenticated and (session_cart_instance is None or session_cart_instance.customer_id != request.user.pk):
+            cart_instance = cls.objects.filter(is_active=True, customer=request.user).first()
+            if session_cart_instance is not None and session_cart_instance.customer_id is None:
+                if cart_instance is None:
+                    # The anonymous session cart becomes the user cart
+                    session_cart_instance.customer = request.user
+                    if session_cart_instance.pk is None:
+                        storage.write(session_cart_instance)
                     else:
-                        cart_instance.cartitem_set.create(
-                            product=session_cartitem_instance.product,
-                            product_name=session_cartitem_instance.product_name,
-                            product_description=session_cartitem_instance.product_description,
-                            product_quantity=session_cartitem_instance.product_quantity,
-                            product_vat=session_cartitem_instance.product_vat,
-                            product_price=session_cartitem_instance.product_price)
-                session_cart_instance.is_active = False
-                session_cart_instance.save()
-
-        # Save cart intoi session
-        request.session['cart_pk'] = cart_instance.pk
+                        session_cart_instance.save(update_fields=['customer', 'updated_at'])
+                    cart_instance = session_cart_instance
+                else:
+                    # Copy session cart into user cart
+                    cart_instance.merge_cart(session_cart_instance)
+
+        if cart_instance is None:
+            # Ephemeral cart, stored on first change
+            cart_instance = cls(customer=request.user if request.user.is_authenticated else None)
+
+        # Save cart into session, only when it changes
+        storage.save_session(request, cart_instance)
         return cart_instance
 
+    def persist(self, request, database=False):
+        """
+        Store an ephemeral cart and save it into the session. Must be called before changing the cart.
+        `database` also writes a cart kept in the cache to the database, as needed by the checkout and the payment.
+        """
+        shop.carts.get_cart_storage().persist(request, self, database=database)
+
+    def merge_cart(self, cart_instance):
+        """
+        Move the items of `cart_instance` into this cart, then deactivate `cart_instance`.
+        """
+        if cart_instance.cart_key is not None:
+            # Cart kept in the cache: its items are added without writing it to the database
+            quantities = {cartitem_instance.product_id: cartitem_instance.product_quantity
+                for cartitem_instance in cart_instance.get_cartitems()}
+            quantities = {product_pk: quantities[product_pk]
+                for product_pk in Product.objects.filter(pk__in=list(quantities)).values_list('pk', flat=True)}
+            shop.carts.get_cart_storage().delete(cart_instance)
+            cart_instance.is_active = False
+            self.set_products_quantities(quantities, replace_quantity=False)
+            return
+
+        with transaction.atomic():
+            # Lock both carts, a parallel merge waits and then finds `cart_instance` inactive
+            carts = {c.pk: c for c in Cart.objects.select_for_update().filter(pk__in=[self.pk, cart_instance.pk]).order_by('pk')}
+            if not carts[cart_instance.pk].is_active:
+                return
+
+            # Items of deleted products are moved as they are
+            cart_instance.cartitem_set.filter(product__isnull=True).update(cart=self)
+            quantities = {}
+            for product_pk, quantity in cart_instance.cartitem_set.values_list('product_id', 'product_quantity'):
+                quantities[product_pk] = quantities.get(product_pk, 0) + quantity
+
+            Cart.objects.filter(pk=cart_instance.pk).update(is_active=False, updated_at=timezone.now())
+            cart_instance.is_active = False
+            self.set_products_quantities(quantities, replace_quantity=False)
+
+    def get_cartitems(self):
+        if self.cached_items is not None:
+            return self.cached_items
+        if self.pk is None:
+            return CartItem.objects.none()
+        return self.cartitem_set.all()
+
     def get_items_count(self):
-        return sum(self.cartitem_set.values_list('product_quantity', flat=True))
+        return self.items_count
 
     def is_empty(self):
-        return self.get_items_count() == 0
+        return self.items_count == 0
 
     def get_prices(self):
-        excl_tax_vat = {}  # calculate excl_tax foreach vat
-        for cartitem_instance in self.cartitem_set.all():
-            # Vat
-            vat_key = str(cartitem_instance.product_vat)
-            if vat_key not in excl_tax_vat:
-                excl_tax_vat[vat_key] = Decimal('0.00')
-            # Price
-            excl_tax_vat[vat_key] += cartitem_instance.get_total()
-        excl_tax = round(sum(excl_tax_vat.values()), 2)
-
-        vat_val = {}
-        for vat, val in excl_tax_vat.items():
-            vat_val[vat] = round(val * Decimal(vat) / 100, 2)
+        return {
+            'excl_tax': self.excl_tax,
+            'vat': {vat: Decimal(val) for vat, val in self.vat.items()},
+            'incl_tax': self.incl_tax,
+        }
 
+    def compute_totals(self):
+        cartitems = list(self.get_cartitems())
+        prices = compute_prices(cartitems)
         return {
-            'excl_tax': excl_tax,
-            'vat': vat_val,
-            'incl_tax': excl_tax + round(sum(vat_val.values()), 2),
+            'items_count': sum(cartitem_instance.product_quantity for cartitem_instance in cartitems),
+            'excl_tax': prices['excl_tax'],
+            'vat': {vat: str(val) for vat, val in prices['vat'].items()},
+            'incl_tax': prices['incl_tax'],
         }
-    
+
+    def lock(self):
+        """
+        Lock the cart row until the end of the transaction, so concurrent changes of its items
+        compute and store the totals one after another.
+        An UPDATE rather than a SELECT FOR UPDATE: it also takes the write lock on sqlite, where a
+        transaction that starts by reading cannot write after a concurrent writer.
+        """
+        Cart.objects.filter(pk=self.pk).update(updated_at=timezone.now())
+
+    def store_totals(self):
+        for field, value in self.compute_totals().items():
+            setattr(self, field, value)
+        self.save(update_fields=[*self.TOTALS_FIELDS, 'updated_at'])
+
+    def update_totals(self):
+        """
+        Store the totals of the cart items on the cart. Must be called after every CartItem change.
+        """
+        with transaction.atomic():
+            self.lock()
+            self.store_totals()
+
     def get_total(self):
         return self.get_prices().get('incl_tax')
     get_total.short_description = _("Montant (TVAC)")
 
     def get_billing_informations(self):
         billing_cart = self.get_prices()
+        billing_cart['items_count'] = self.items_count
         billing_cart['cartitems'] = []
-        for cartitem_instance in self.cartitem_set.all():
+        for cartitem_instance in self.get_cartitems():
             billing_cart['cartitems'].append({
                 'pk': cartitem_instance.pk,
                 'product_quantity': cartitem_instance.product_quantity,
@@ -252,54 +735,103 @@ class Cart(models.Model):
         return billing_cart
 
     def set_product_quantity(self, product_pk, quantity, replace_quantity=True):
-        product_instance = Product.objects.get(pk=product_pk)
-        cartitem_instance = self.cartitem_set.filter(product=product_instance).first()
-        if cartitem_instance:
-            cartitem_instance.product_name = product_instance.name
-            cartitem_instance.product_description = product_instance.description
-            cartitem_instance.product_quantity = quantity if replace_quantity else cartitem_instance.product_quantity + quantity
-            cartitem_instance.product_vat = product_instance.vat
-            cartitem_instance.product_price = product_instance.price
-            cartitem_instance.save()
-            if cartitem_instance.product_quantity <= 1:
-                cartitem_instance.delete()
-        elif quantity >= 1:
-            self.cartitem_set.create(
-                product=product_instance,
-                product_name=product_instance.name,
-                product_description=product_instance.description,
-                product_quantity=quantity,
-                product_vat=product_instance.vat,
-                product_price=product_instance.price)
+        self.set_products_quantities({int(product_pk): quantity}, replace_quantity=replace_quantity)
         # billing cart informations
         return self.get_billing_informations()
 
+    def set_products_quantities(self, quantities, replace_quantity=True):
+        """
+        Change the quantity of several products in one transaction. `quantities` maps product pks to quantities.
+        The quantities are updated in the database and the cart is locked first, so concurrent changes of a
+        same cart are not lost and its stored totals match its items.
+        A cart item is removed when its quantity drops below 1.
+        """
+        if self.cart_key is not None:
+            return shop.carts.get_cart_storage().set_products_quantities(self, quantities, replace_quantity=replace_quantity)
+        with transaction.atomic():
+            self.lock()
+            if quantities:
+                # Create the missing cart items, the unique (cart, product) constraint drops concurrent duplicates
+                CartItem.objects.bulk_create([
+                    CartItem(cart=self, product_id=product_pk, product_quantity=0)
+                    for product_pk, quantity in sorted(quantities.items())
+                    if quantity >= 1 or not replace_quantity
+                ], ignore_conflicts=True)
+                product_instances = Product.objects.in_bulk(list(quantities))
+                if len(product_instances) != len(quantities):
+                    raise Product.DoesNotExist("Unknown products: %s" % sorted(set(quantities) - set(product_instances)))
+
+                def case(values, output_field):
+                    return models.Case(*[
+                        models.When(product_id=product_pk, then=value) for product_pk, value in values.items()
+                    ], output_field=output_field)
+
+                self.cartitem_set.filter(product__in=list(quantities)).update(
+                    product_quantity=Greatest(case({
+                        product_pk: models.Value(quantity) if replace_quantity else models.F('product_quantity') + quantity
+                        for product_pk, quantity in quantities.items()
+                    }, models.IntegerField()), 0),
+                    product_name=case({p.pk: models.Value(p.name) for p in product_instances.values()}, models.CharField()),
+                    product_description=case({p.pk: models.Value(p.description) for p in product_instances.values()}, models.TextField()),
+                    product_vat=case({p.pk: models.Value(p.vat) for p in product_instances.values()}, models.PositiveIntegerField()),
+                    product_price=case({p.pk: models.Value(p.price) for p in product_instances.values()}, models.DecimalField()),
+                )
+                self.cartitem_set.filter(product_quantity__lt=1).delete()
+            self.store_totals()
+
     def payment_succeeded(self):
-        # Create Invoice
-        invoice_instance = Invoice.objects.create(
-            invoice_status='done',
-            customer=self.customer,
-            contact_first_name=self.contact_first_name,
-            contact_last_name=self.contact_last_name,
-            contact_email=self.contact_email,
-            contact_phone=self.contact_phone,
-            address=self.address,
-            address_zipcode=self.address_zipcode,
-            address_city=self.address_city,
-            stripe_payment_intent_id=self.stripe_payment_intent_id,
-        )
-        for cartitem_instance in self.cartitem_set.all():
-            InvoiceItem.objects.create(
-                invoice=invoice_instance,
-                product=cartitem_instance.product,
-                product_name=cartitem_instance.product_name,
-                product_description=cartitem_instance.product_description,
-                product_quantity=cartitem_instance.product_quantity,
-                product_vat=cartitem_instance.product_vat,
-                product_price=cartitem_instance.product_price,
+        """
+        Create the invoice of the cart in one transaction.
+        Calling it again for the same PaymentIntent returns the existing invoice.
+        """
+        with transaction.atomic():
+            # Lock the cart, concurrent calls wait until the invoice is created
+            cart_instance = Cart.objects.select_for_update().get(pk=self.pk)
+            if cart_instance.stripe_payment_intent_id:
+                invoice_instance = Invoice.objects.filter(stripe_payment_intent_id=cart_instance.stripe_payment_intent_id).first()
+                if invoice_instance:
+                    return invoice_instance
+
+            # Create Invoice
+            invoiceitem_instances = [
+                InvoiceItem(
+                    product_id=cartitem_instance.product_id,
+                    product_name=cartitem_instance.product_name,
+                    product_description=cartitem_instance.product_description,
+                    product_quantity=cartitem_instance.product_quantity,
+                    product_vat=cartitem_instance.product_vat,
+                    product_price=cartitem_instance.product_price,
+                )
+                for cartitem_instance in cart_instance.cartitem_set.all()
+            ]
+            invoice_instance = Invoice(
+                invoice_date=timezone.localdate(),
+                invoice_status='done',
+                customer=cart_instance.customer,
+                contact_first_name=cart_instance.contact_first_name,
+                contact_last_name=cart_instance.contact_last_name,
+                contact_email=cart_instance.contact_email,
+                contact_phone=cart_instance.contact_phone,
+                address=cart_instance.address,
+                address_zipcode=cart_instance.address_zipcode,
+                address_city=cart_instance.address_city,
+                stripe_payment_intent_id=cart_instance.stripe_payment_intent_id,
             )
+            for field, value in invoice_instance.compute_totals(invoiceitem_instances).items():
+                setattr(invoice_instance, field, value)
+            invoice_instance.save()
+            for invoiceitem_instance in invoiceitem_instances:
+                invoiceitem_instance.invoice = invoice_instance
+            InvoiceItem.objects.bulk_create(invoiceitem_instances)
+            sales_rollup = SalesRollup()
+            sales_rollup.add_invoice(invoice_instance.invoice_date, invoiceitem_instances)
+            sales_rollup.add()
+            send_confirmation_email(invoice_instance.get_confirmation_email(invoiceitem_instances))
+            cart_instance.is_active = False
+            cart_instance.save(update_fields=['is_active', 'updated_at'])
         self.is_active = False
-        self.save()
+        return invoice_instance
+
 
 class CartItem(models.Model):
     # Main information
@@ -317,6 +849,9 @@ class CartItem(models.Model):
     class Meta:
         verbose_name = _("Panier (Produit)")
         verbose_name_plural = _("Panier (Produits)")
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='shop_cartitem_unique_product'),
+        ]
 
     def __str__(self):
         return "%s - %s" % (self.cart, self.product_description)
@@ -328,3 +863,212 @@ class CartItem(models.Model):
 
     def get_total(self):
         return round(self.product_quantity * self.product_price, 2)
+
+
+# Queued jobs
+class QueuedJob(models.Model):
+    """
+    Row processed by a worker, retried with an exponential backoff until it succeeds.
+    """
+    STATUS_CHOICES = (
+        ('pending', _("En attente")),
+        ('processing', _("En cours")),
+        ('done', _("Traité")),
+        ('dead', _("Abandonné")),
+    )
+    MAX_ATTEMPTS = 8
+    RETRY_DELAY = 30  # seconds, doubled after each failed attempt
+    PROCESSING_TIMEOUT = 600  # seconds before a row claimed by a crashed worker is claimed again
+
+    # Processing informations
+    status = models.CharField(verbose_name=_("Statut"), max_length=25, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(verbose_name=_("Tentatives"), default=0)
+    next_attempt_at = models.DateTimeField(verbose_name=_("Prochaine tentative"), default=timezone.now)
+    claimed_at = models.DateTimeField(verbose_name=_("Pris en charge le"), blank=True, null=True)
+    processed_at = models.DateTimeField(verbose_name=_("Traité le"), blank=True, null=True)
+    last_error = models.TextField(verbose_name=_("Dernière erreur"), blank=True)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def claim_batch(cls, batch_size):
+        """
+        Claim rows ready to be processed. Rows claimed by another worker are skipped.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            jobs = list(cls.objects.select_for_update(skip_locked=True).filter(
+                models.Q(status='pending', next_attempt_at__lte=now) |
+                models.Q(status='processing', claimed_at__lte=now - timedelta(seconds=cls.PROCESSING_TIMEOUT))
+            ).order_by('next_attempt_at')[:batch_size])
+            cls.objects.filter(pk__in=[job.pk for job in jobs]).update(status='processing', claimed_at=now)
+        return jobs
+
+    def process(self, *args):
+        try:
+            self.handle(*args)
+        except Exception as e:
+            self.attempts += 1
+            self.last_error = "%s: %s" % (e.__class__.__name__, e)
+            if self.attempts >= self.MAX_ATTEMPTS:
+                self.status = 'dead'
+            else:
+                self.status = 'pending'
+                self.next_attempt_at = timezone.now() + timedelta(seconds=self.RETRY_DELAY * 2 ** (self.attempts - 1))
+        else:
+            self.attempts += 1
+            self.status = 'done'
+            self.processed_at = timezone.now()
+        self.save(update_fields=['status', 'attempts', 'next_attempt_at', 'processed_at', 'last_error'])
+
+    def handle(self, *args):
+        """
+        Process the job with the arguments given to `process`. Implemented by each job type, an exception
+        schedules a new attempt.
+        """
+        raise NotImplementedError("%s must implement handle()." % self.__class__.__name__)
+
+
+# Stripe Models
+class WebhookEvent(QueuedJob):
+    HANDLED_EVENT_TYPES = ('charge.succeeded', )
+
+    # Event informations
+    stripe_event_id = models.CharField(verbose_name=_("STRIPE Event ID"), max_length=255, unique=True)
+    event_type = models.CharField(verbose_name=_("Type"), max_length=255)
+    payload = models.JSONField(verbose_name=_("Contenu"))
+    created_at = models.DateTimeField(verbose_name=_("Reçu le"), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("Événement Stripe")
+        verbose_name_plural = _("Événements Stripe")
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return "%s (%s)" % (self.stripe_event_id, self.event_type)
+
+    @classmethod
+    def store(cls, event):
+        """
+        Store a verified Stripe event. Events already received are dropped.
+        """
+        cls.objects.bulk_create([
+            cls(stripe_event_id=event['id'], event_type=event['type'], payload=event),
+        ], ignore_conflicts=True)
+
+    def handle(self):
+        """ Apply the event: a succeeded charge creates the invoice of its cart """
+        if self.event_type == 'charge.succeeded':
+            with transaction.atomic():
+                cart_instance = Cart.objects.get(stripe_payment_intent_id=self.payload['data']['object']['payment_intent'])
+                cart_instance.payment_succeeded()
+
+
+# Email Models
+def send_confirmation_email(email_message):
+    """
+    Send an e-mail only if the current transaction is committed.
+    Queued in the transaction when EMAIL_QUEUE is enabled, else sent once it is committed: a failure
+    is logged and does not cancel the transaction.
+    """
+    connection = get_connection()
+    if isinstance(connection, djangostripe.mail.QueuedEmailBackend):
+        connection.send_messages([email_message])
+        return
+
+    def send():
+        try:
+            connection.send_messages([email_message])
+        except Exception:
+            logger.exception("Unable to send the e-mail to %s", ", ".join(email_message.recipients()))
+    transaction.on_commit(send)
+
+
+class QueuedEmail(QueuedJob):
+    """
+    Email stored by djangostripe.mail.QueuedEmailBackend, sent by the send_queued_emails command.
+    """
+    MAX_ATTEMPTS = 6
+    RETRY_DELAY = 60
+
+    subject = models.CharField(verbose_name=_("Sujet"), max_length=255)
+    recipients = models.JSONField(verbose_name=_("Destinataires"), default=list)
+    from_email = models.CharField(verbose_name=_("Expéditeur"), max_length=255, blank=True)
+    message = models.BinaryField(verbose_name=_("Message"))  # MIME content, as sent
+    created_at = models.DateTimeField(verbose_name=_("Créé le"), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("E-mail en attente")
+        verbose_name_plural = _("E-mails en attente")
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return self.subject
+
+    @classmethod
+    def enqueue(cls, email_messages):
+        """
+        Store EmailMessage instances to be sent by the worker. Returns the number of emails stored.
+        """
+        queued_emails = []
+        for email_message in email_messages:
+            if not email_message.recipients():
+                continue
+            queued_emails.append(cls(
+                subject=str(email_message.subject)[:255],
+                from_email=email_message.from_email,
+                recipients=email_message.recipients(),
+                message=email_message.message().as_bytes(),
+            ))
+        cls.objects.bulk_create(queued_emails)
+        return len(queued_emails)
+
+    def get_message(self):
+        return djangostripe.mail.StoredEmailMessage(self.message, self.from_email, self.recipients)
+
+    def handle(self, connection):
+        """ Send the email over `connection`, shared by the emails of a batch """
+        connection.open()  # no-op while the connection is open
+        if not connection.send_messages([self.get_message()]):
+            raise RuntimeError("The email was not sent.")
+
+
+# Image Models
+class ProductImageTask(QueuedJob):
+    """
+    Generation of the picture variants of a product, by the process_product_images command.
+    """
+    MAX_ATTEMPTS = 3
+
+    product = models.ForeignKey('Product', verbose_name=_("Produit"), on_delete=models.CASCADE)
+    created_at = models.DateTimeField(verbose_name=_("Créé le"), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("Génération d'image")
+        verbose_name_plural = _("Générations d'images")
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return str(self.product)
+
+    def handle(self):
+        """ Generate the variants of the current picture, then delete the previous ones """
+        product_instance = Product.objects.get(pk=self.product_id)
+        picture_name = product_instance.picture.name or None
+        if picture_name == product_instance.picture_variants.get('source'):
+            return  # already generated by a previous task
+        queryset = Product.objects.filter(pk=product_instance.pk)
+        variants = {}
+        if picture_name:
+            variants = shop.images.generate_variants(product_instance.picture, product_instance.pk)
+            queryset = queryset.filter(picture=picture_name)  # not stored if the picture changed meanwhile
+        if queryset.update(picture_variants=variants):
+            transaction.on_commit(shop.cache.bump_version)
+            shop.images.delete_variants(product_instance.picture_variants, keep=variants)
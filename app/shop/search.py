@@ -0,0 +1,152 @@
+"""
+Full-text search over Product.name and Product.description.
+
+The backend depends on the database (SQL_ENGINE): a FTS5 table on sqlite, a GIN index on a
+tsvector expression on PostgreSQL. Other databases fall back to an unindexed icontains scan.
+"""
+import re
+
+from django.db import connection, models
+from django.db.models.expressions import RawSQL
+
+import shop.models
+
+
+FTS_TABLE = 'shop_product_fts'
+GIN_INDEX = 'shop_product_search_idx'
+
+
+def get_terms(query):
+    """
+    Split a user query into words, dropping the characters used by the search syntaxes.
+    """
+    return re.findall(r'\w+', query.lower())
+
+
+class SearchBackend:
+    """ Fallback backend, used when the database has no full-text search """
+    def setup(self, schema_editor, product_model):
+        pass
+
+    def teardown(self, schema_editor):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def index(self, product_instances):
+        pass
+
+    def remove(self, product_pks):
+        pass
+
+    def search(self, queryset, query):
+        terms = get_terms(query)
+        if not terms:
+            return queryset.none()
+        condition = models.Q()
+        for term in terms:
+            condition &= models.Q(name__icontains=term) | models.Q(description__icontains=term)
+        return queryset.filter(condition)
+
+    def autocomplete(self, queryset, prefix, limit=10):
+        return self.search(queryset, prefix)[:limit]
+
+
+class SqliteSearchBackend(SearchBackend):
+    """ FTS5 table indexed with the product pk as rowid, kept in sync by shop.signals """
+    def setup(self, schema_editor, product_model):
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(name, description, tokenize='unicode61 remove_diacritics 2')" % FTS_TABLE)
+        schema_editor.execute(self.get_populate_sql(product_model))
+
+    def teardown(self, schema_editor):
+        schema_editor.execute("DROP TABLE IF EXISTS %s" % FTS_TABLE)
+
+    def get_populate_sql(self, product_model):
+        return "INSERT INTO %s (rowid, name, description) SELECT id, name, description FROM %s" % (
+            FTS_TABLE, product_model._meta.db_table)
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s" % FTS_TABLE)
+            cursor.execute(self.get_populate_sql(shop.models.Product))
+
+    def index(self, product_instances):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO %s (rowid, name, description) VALUES (%%s, %%s, %%s)" % FTS_TABLE,
+                [(p.pk, p.name, p.description) for p in product_instances])
+
+    def remove(self, product_pks):
+        with connection.cursor() as cursor:
+            cursor.executemany("DELETE FROM %s WHERE rowid = %%s" % FTS_TABLE, [(pk, ) for pk in product_pks])
+
+    def match(self, queryset, match):
+        """
+        Filter `queryset` on the FTS5 `match` expression, best matches first. Ranked and filtered in
+        the database, so slicing the queryset limits the query.
+        """
+        opts = queryset.model._meta
+        # Name matches weigh more than description matches
+        rank_sql = "SELECT bm25(%s, 10.0, 1.0) FROM %s WHERE %s MATCH %%s AND rowid = %s.%s" % (
+            FTS_TABLE, FTS_TABLE, FTS_TABLE, connection.ops.quote_name(opts.db_table), connection.ops.quote_name(opts.pk.column))
+        return queryset.filter(
+            pk__in=RawSQL("SELECT rowid FROM %s WHERE %s MATCH %%s" % (FTS_TABLE, FTS_TABLE), [match]),
+        ).annotate(
+            search_rank=RawSQL(rank_sql, [match], output_field=models.FloatField()),
+        ).order_by('search_rank', 'pk')
+
+    def search(self, queryset, query):
+        terms = get_terms(query)
+        if not terms:
+            return queryset.none()
+        return self.match(queryset, " ".join('"%s"' % term for term in terms))
+
+    def autocomplete(self, queryset, prefix, limit=10):
+        terms = get_terms(prefix)
+        if not terms:
+            return queryset.none()
+        return self.match(queryset, " ".join('"%s"*' % term for term in terms))[:limit]
+
+
+class PostgresSearchBackend(SearchBackend):
+    """ GIN index on the tsvector expression, PostgreSQL keeps it in sync """
+    def get_vector(self):
+        from django.contrib.postgres.search import SearchVector
+        return SearchVector('name', weight='A', config='simple') + SearchVector('description', weight='B', config='simple')
+
+    def setup(self, schema_editor, product_model):
+        from django.contrib.postgres.indexes import GinIndex
+        schema_editor.add_index(product_model, GinIndex(self.get_vector(), name=GIN_INDEX))
+
+    def teardown(self, schema_editor):
+        schema_editor.execute("DROP INDEX IF EXISTS %s" % GIN_INDEX)
+
+    def match(self, queryset, search_query):
+        from django.contrib.postgres.search import SearchRank
+        # Same expression as the GIN index, so the index is used
+        return queryset.annotate(search_vector=self.get_vector()).filter(search_vector=search_query).annotate(
+            search_rank=SearchRank(self.get_vector(), search_query)).order_by('-search_rank', 'pk')
+
+    def search(self, queryset, query):
+        from django.contrib.postgres.search import SearchQuery
+        if not get_terms(query):
+            return queryset.none()
+        return self.match(queryset, SearchQuery(query, config='simple', search_type='websearch'))
+
+    def autocomplete(self, queryset, prefix, limit=10):
+        from django.contrib.postgres.search import SearchQuery
+        terms = get_terms(prefix)
+        if not terms:
+            return queryset.none()
+        return self.match(queryset, SearchQuery(" & ".join("%s:*" % term for term in terms), config='simple', search_type='raw'))[:limit]
+
+
+def get_search_backend(vendor=None):
+    vendor = vendor or connection.vendor
+    if vendor == 'sqlite':
+        return SqliteSearchBackend()
+    if vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return SearchBackend()
@@ -0,0 +1,25 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+import shop.cache
+import shop.models
+import shop.search
+
+
+@receiver(post_save, sender=shop.models.Product)
+def index_product(sender, instance, raw=False, **kwargs):
+    if not raw:
+        shop.search.get_search_backend().index([instance])
+
+
+@receiver(post_delete, sender=shop.models.Product)
+def unindex_product(sender, instance, **kwargs):
+    shop.search.get_search_backend().remove([instance.pk])
+
+
+@receiver(post_save, sender=shop.models.Product)
+@receiver(post_delete, sender=shop.models.Product)
+def invalidate_catalog_cache(sender, **kwargs):
+    # After the commit, so the catalog is not computed again from the data being changed
+    transaction.on_commit(shop.cache.bump_version)
@@ -0,0 +1,31 @@
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from stripe.http_client import RequestsClient
+
+from django.conf import settings
+
+
+def configure():
+    """
+    Configure the stripe library once per process: API key, retries and a pooled keep-alive HTTP client.
+    """
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    stripe.max_network_retries = settings.STRIPE_MAX_NETWORK_RETRIES  # POST requests get an idempotency key
+
+    if settings.STRIPE_FAKE:
+        import shop.stripe_fake
+        stripe.default_http_client = shop.stripe_fake.FakeStripeClient(
+            latency=settings.STRIPE_FAKE_LATENCY,
+            error_rate=settings.STRIPE_FAKE_ERROR_RATE,
+            webhook_url=settings.STRIPE_FAKE_WEBHOOK_URL,
+            webhook_secret=settings.STRIPE_SECRET_WEBHOOK,
+        )
+        return
+
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=settings.STRIPE_POOL_SIZE))
+    stripe.default_http_client = RequestsClient(
+        timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT),
+        session=session,
+    )
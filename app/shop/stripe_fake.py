@@ -0,0 +1,136 @@
+"""
+In-process stand-in for the Stripe API, used to load-test the checkout without network.
+
+Enabled with STRIPE_FAKE=true, it replaces the HTTP client of the stripe library and implements
+the PaymentIntent endpoints used by the shop. Confirming a PaymentIntent sends a signed
+`charge.succeeded` event to the stripe_webhook view, like Stripe does.
+"""
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+from stripe.http_client import HTTPClient
+
+from django.conf import settings
+from django.test import Client
+from django.urls import reverse
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """
+    Return the Stripe-Signature header of a webhook payload.
+    """
+    timestamp = timestamp or int(time.time())
+    signature = hmac.new(secret.encode(), ("%s.%s" % (timestamp, payload)).encode(), hashlib.sha256).hexdigest()
+    return "t=%s,v1=%s" % (timestamp, signature)
+
+
+class FakeStripeClient(HTTPClient):
+    name = 'fake'
+
+    def __init__(self, latency=0, error_rate=0, webhook_url=None, webhook_secret=None):
+        super().__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.payment_intents = {}
+        self.lock = threading.Lock()
+
+    def request(self, method, url, headers, post_data=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return self.response({'error': {'type': 'api_error', 'message': "Injected error."}}, 500)
+
+        path = urlsplit(url).path.rstrip('/').split('/')[2:]  # without /v1
+        params = dict(parse_qsl(post_data or ''))
+        if path[:1] != ['payment_intents']:
+            return self.not_found(url)
+        if len(path) == 1 and method == 'post':
+            return self.response(self.create_payment_intent(params))
+
+        with self.lock:
+            payment_intent = self.payment_intents.get(path[1]) if len(path) > 1 else None
+        if payment_intent is None:
+            return self.not_found(url)
+        if len(path) == 2 and method == 'get':
+            return self.response(payment_intent)
+        if len(path) == 2 and method == 'post':
+            return self.response(self.modify_payment_intent(payment_intent, params))
+        if len(path) == 3 and path[2] == 'confirm' and method == 'post':
+            return self.response(self.confirm_payment_intent(payment_intent))
+        return self.not_found(url)
+
+    def close(self):
+        pass
+
+    def response(self, content, status=200):
+        return json.dumps(content), status, {'request-id': "req_%s" % uuid.uuid4().hex[:14]}
+
+    def not_found(self, url):
+        return self.response({'error': {'type': 'invalid_request_error', 'message': "Unrecognized request URL (%s)." % url}}, 404)
+
+    # PaymentIntent endpoints
+    def create_payment_intent(self, params):
+        payment_intent_id = "pi_%s" % uuid.uuid4().hex[:24]
+        payment_intent = {
+            'id': payment_intent_id,
+            'object': 'payment_intent',
+            'amount': int(params.get('amount', 0)),
+            'currency': params.get('currency'),
+            'status': 'requires_payment_method',
+            'client_secret': "%s_secret_%s" % (payment_intent_id, uuid.uuid4().hex[:24]),
+            'created': int(time.time()),
+            'livemode': False,
+        }
+        with self.lock:
+            self.payment_intents[payment_intent_id] = payment_intent
+        return payment_intent
+
+    def modify_payment_intent(self, payment_intent, params):
+        with self.lock:
+            if 'amount' in params:
+                payment_intent['amount'] = int(params['amount'])
+            if 'currency' in params:
+                payment_intent['currency'] = params['currency']
+            return dict(payment_intent)
+
+    def confirm_payment_intent(self, payment_intent):
+        with self.lock:
+            payment_intent['status'] = 'succeeded'
+            payment_intent = dict(payment_intent)
+        self.send_webhook('charge.succeeded', {
+            'id': "ch_%s" % uuid.uuid4().hex[:24],
+            'object': 'charge',
+            'amount': payment_intent['amount'],
+            'currency': payment_intent['currency'],
+            'paid': True,
+            'payment_intent': payment_intent['id'],
+            'status': 'succeeded',
+        })
+        return payment_intent
+
+    # Webhooks
+    def send_webhook(self, event_type, data_object):
+        payload = json.dumps({
+            'id': "evt_%s" % uuid.uuid4().hex[:24],
+            'object': 'event',
+            'type': event_type,
+            'created': int(time.time()),
+            'livemode': False,
+            'data': {'object': data_object},
+        })
+        signature = sign_payload(payload, self.webhook_secret)
+        if self.webhook_url:
+            requests.post(self.webhook_url, data=payload, timeout=10, headers={
+                'Content-Type': 'application/json', 'Stripe-Signature': signature})
+        else:
+            Client(HTTP_HOST=settings.ALLOWED_HOSTS[0]).post(
+                reverse('stripe_webhook'), payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=signature)
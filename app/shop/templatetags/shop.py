@@ -1,10 +1,10 @@
 from django import template
 
-import shop.models
+import shop.middleware
 
 
 register = template.Library()
 
 @register.simple_tag
 def shop_cart(request):
-    return shop.models.Cart.get_session_cart(request)
\ No newline at end of file
+    return shop.middleware.get_cart(request)
\ No newline at end of file
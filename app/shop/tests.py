@@ -1,3 +1,1228 @@
-from django.test import TestCase
+import csv
+import email
+import io
+import json
+import os
+import shutil
+import smtplib
+import tempfile
+import threading
+from urllib.parse import urlencode
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from PIL import Image
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core import mail
+from django.core.mail import EmailMultiAlternatives, send_mail
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+import djangostripe.routers
+import shop.cache
+import shop.images
+import shop.invoice_pdf
+import shop.models
+import shop.search
+import shop.stripe_fake
+import shop.views
+import user.models
+
+
+def run_in_threads(target, threads_count):
+    """
+    Run `target` in `threads_count` threads, each one with its own database connection.
+    """
+    errors = []
+
+    def run():
+        try:
+            target()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run) for i in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+class CartSessionTestCase(TestCase):
+    def setUp(self):
+        self.product = shop.models.Product.objects.create(name="Product", description="Description", price="10.00")
+        self.user = user.models.User.objects.create_user("customer@example.com", "password")
+
+    def get_request(self, session=None, authenticated=False):
+        request = RequestFactory().get('/')
+        request.session = session if session is not None else SessionStore()
+        request.user = self.user if authenticated else AnonymousUser()
+        return request
+
+    def test_ephemeral_cart(self):
+        request = self.get_request()
+        cart = shop.models.Cart.get_session_cart(request)
+        self.assertIsNone(cart.pk)
+        self.assertTrue(cart.is_empty())
+        self.assertEqual(list(cart.get_cartitems()), [])
+        self.assertFalse(shop.models.Cart.objects.exists())
+        self.assertFalse(request.session.modified)
+
+        cart.persist(request)
+        cart.set_product_quantity(self.product.pk, 2)
+        self.assertEqual(request.session['cart_pk'], cart.pk)
+        self.assertEqual(shop.models.Cart.get_session_cart(self.get_request(request.session)), cart)
+
+    def test_anonymous_cart_becomes_user_cart(self):
+        request = self.get_request()
+        cart = shop.models.Cart.get_session_cart(request)
+        cart.persist(request)
+        cart.set_product_quantity(self.product.pk, 2)
+
+        user_cart = shop.models.Cart.get_session_cart(self.get_request(request.session, authenticated=True))
+        self.assertEqual(user_cart, cart)
+        self.assertEqual(user_cart.customer, self.user)
+
+    def test_anonymous_cart_is_merged_into_user_cart(self):
+        user_cart = shop.models.Cart.objects.create(customer=self.user)
+        user_cart.set_product_quantity(self.product.pk, 3)
+        request = self.get_request()
+        cart = shop.models.Cart.get_session_cart(request)
+        cart.persist(request)
+        cart.set_product_quantity(self.product.pk, 2)
+
+        self.assertEqual(shop.models.Cart.get_session_cart(self.get_request(request.session, authenticated=True)), user_cart)
+        user_cart.refresh_from_db()
+        cart.refresh_from_db()
+        self.assertEqual(list(user_cart.cartitem_set.values_list('product_quantity', flat=True)), [5])
+        self.assertEqual(user_cart.items_count, 5)
+        self.assertFalse(cart.is_active)
+
+
+    def test_merge_cart(self):
+        products = [shop.models.Product.objects.create(name="Product %s" % i, description="Description", price="1.00") for i in range(10)]
+        user_cart = shop.models.Cart.objects.create(customer=self.user)
+        cart = shop.models.Cart.objects.create()
+        for product in products[:5]:
+            user_cart.set_product_quantity(product.pk, 2)
+        for product in products:
+            cart.set_product_quantity(product.pk, 3)
+
+        with self.assertNumQueries(15):
+            user_cart.merge_cart(cart)
+        self.assertEqual(sorted(user_cart.cartitem_set.values_list('product_quantity', flat=True)), [3] * 5 + [5] * 5)
+        self.assertEqual(user_cart.items_count, 40)
+        self.assertFalse(shop.models.Cart.objects.get(pk=cart.pk).is_active)
+
+        # A second merge of the same cart does nothing
+        user_cart.merge_cart(cart)
+        self.assertEqual(user_cart.items_count, 40)
+
+
+@override_settings(CART_STORAGE='shop.carts.CacheCartStorage')
+class CacheCartTestCase(CartSessionTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def get_anonymous_cart(self, quantity=2):
+        request = self.get_request()
+        cart = shop.models.Cart.get_session_cart(request)
+        cart.persist(request)
+        cart.set_product_quantity(self.product.pk, quantity)
+        request.session.save()
+        return cart, request
+
+    def test_ephemeral_cart(self):
+        request = self.get_request()
+        cart = shop.models.Cart.get_session_cart(request)
+        self.assertIsNone(cart.cart_key)
+        self.assertFalse(request.session.modified)
+        cart.persist(request)
+        self.assertEqual(request.session['cart_key'], cart.cart_key)
+
+    def test_cached_cart(self):
+        cart, request = self.get_anonymous_cart()
+        self.assertIsNone(cart.pk)
+        self.assertFalse(shop.models.Cart.objects.exists())
+        self.assertFalse(shop.models.CartItem.objects.exists())
+
+        request = self.get_request(SessionStore(request.session.session_key))
+        self.assertIn('cart_key', request.session)  # loads the session
+        with self.assertNumQueries(0):
+            cart = shop.models.Cart.get_session_cart(request)
+        self.assertEqual(cart.get_items_count(), 2)
+        self.assertEqual(cart.get_total(), Decimal("24.20"))
+        self.assertEqual([item.product_name for item in cart.get_cartitems()], ["Product"])
+        self.assertFalse(request.session.modified)
+
+    def test_checkout_writes_cart(self):
+        cart, request = self.get_anonymous_cart()
+        cart_key = cart.cart_key
+        cart.contact_first_name = "Jean"
+        cart.persist(request, database=True)
+        self.assertIsNone(cache.get("cart:%s" % cart_key))
+        self.assertEqual(request.session['cart_pk'], cart.pk)
+        self.assertNotIn('cart_key', request.session)
+
+        cart = shop.models.Cart.get_session_cart(self.get_request(request.session))
+        self.assertEqual((cart.contact_first_name, cart.items_count, cart.get_total()), ("Jean", 2, Decimal("24.20")))
+        self.assertEqual(list(cart.cartitem_set.values_list('product_quantity', flat=True)), [2])
+
+    def test_anonymous_cart_becomes_user_cart(self):
+        cart, request = self.get_anonymous_cart()
+        user_cart = shop.models.Cart.get_session_cart(self.get_request(request.session, authenticated=True))
+        self.assertEqual(shop.models.Cart.objects.get(), user_cart)
+        self.assertEqual((user_cart.customer, user_cart.items_count), (self.user, 2))
+        self.assertEqual(request.session['cart_pk'], user_cart.pk)
+
+    def test_anonymous_cart_is_merged_into_user_cart(self):
+        user_cart = shop.models.Cart.objects.create(customer=self.user)
+        user_cart.set_product_quantity(self.product.pk, 3)
+        cart, request = self.get_anonymous_cart()
+
+        self.assertEqual(shop.models.Cart.get_session_cart(self.get_request(request.session, authenticated=True)), user_cart)
+        user_cart.refresh_from_db()
+        self.assertEqual(user_cart.items_count, 5)
+        self.assertEqual(shop.models.Cart.objects.count(), 1)
+        self.assertIsNone(cache.get("cart:%s" % cart.cart_key))
+
+
+@mock.patch('webpack_loader.loader.WebpackLoader.get_bundle', return_value=[])
+class CartMiddlewareTestCase(TestCase):
+    def setUp(self):
+        self.product = shop.models.Product.objects.create(name="Product", description="Description", price="10.00")
+
+    def test_cart_resolved_once(self, get_bundle):
+        self.client.post(reverse('cart_update'), json.dumps({'items': [{'product': self.product.pk, 'quantity': 2}]}),
+            content_type="application/json")
+        # Session, cart, then the items listed by the page and by the billing frag: the view and
+        # both cart tags share the cart of the request
+        with CaptureQueriesContext(connection) as queries, self.assertNumQueries(4):
+            response = self.client.get(reverse('cart'))
+        self.assertContains(response, "Product")
+        self.assertEqual(len([query for query in queries if 'FROM "shop_cart" ' in query['sql']]), 1)
+
+    def test_anonymous_requests_without_cart(self, get_bundle):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(reverse('shop_json')).status_code, 200)
+            self.assertEqual(self.client.get(reverse('cart')).status_code, 200)
+        self.assertFalse([query for query in queries if 'shop_cart' in query['sql']])
+        self.assertFalse(shop.models.Cart.objects.exists())
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+
+
+class CartTotalsTestCase(TestCase):
+    def setUp(self):
+        self.products = [
+            shop.models.Product.objects.create(name="Product %s" % i, description="Description", price=price, vat=vat)
+            for i, (price, vat) in enumerate([(Decimal("10.00"), 21), (Decimal("3.50"), 6)])
+        ]
+        self.cart = shop.models.Cart.objects.create()
+
+    def assertTotals(self, cart, items_count):
+        cart.refresh_from_db()
+        self.assertEqual({field: getattr(cart, field) for field in cart.TOTALS_FIELDS}, cart.compute_totals())
+        self.assertEqual(cart.items_count, items_count)
+
+    def test_add_and_remove(self):
+        self.cart.set_product_quantity(self.products[0].pk, 2)
+        self.cart.set_product_quantity(self.products[1].pk, 3, replace_quantity=False)
+        self.assertTotals(self.cart, 5)
+        self.assertEqual(self.cart.get_prices(), {
+            'excl_tax': Decimal("30.50"), 'vat': {'21': Decimal("4.20"), '6': Decimal("0.63")}, 'incl_tax': Decimal("35.33")})
+
+        self.cart.set_product_quantity(self.products[0].pk, 0)
+        self.assertTotals(self.cart, 3)
+        self.cart.set_product_quantity(self.products[1].pk, -3, replace_quantity=False)
+        self.assertTotals(self.cart, 0)
+        self.assertEqual(self.cart.incl_tax, Decimal("0.00"))
+
+    def test_merge(self):
+        other_cart = shop.models.Cart.objects.create()
+        self.cart.set_product_quantity(self.products[0].pk, 1)
+        other_cart.set_products_quantities({self.products[0].pk: 2, self.products[1].pk: 1})
+        self.cart.merge_cart(other_cart)
+        self.assertTotals(self.cart, 4)
+
+    def test_admin_inline(self):
+        self.cart.set_product_quantity(self.products[0].pk, 1)
+        cartitem = self.cart.cartitem_set.get()
+        self.client.force_login(user.models.User.objects.create_superuser(email="admin@example.com", password="password"))
+        response = self.client.post(reverse('admin:shop_cart_change', args=[self.cart.pk]), {
+            'is_active': 'on',
+            'cartitem_set-TOTAL_FORMS': '2',
+            'cartitem_set-INITIAL_FORMS': '1',
+            'cartitem_set-0-id': cartitem.pk,
+            'cartitem_set-0-cart': self.cart.pk,
+            'cartitem_set-0-product': self.products[0].pk,
+            'cartitem_set-0-product_name': "Product 0",
+            'cartitem_set-0-product_description': "Description",
+            'cartitem_set-0-product_quantity': '4',
+            'cartitem_set-0-product_price': '10.00',
+            'cartitem_set-1-cart': self.cart.pk,
+            'cartitem_set-1-product': self.products[1].pk,
+            'cartitem_set-1-product_name': "Product 1",
+            'cartitem_set-1-product_description': "Description",
+            'cartitem_set-1-product_quantity': '2',
+            'cartitem_set-1-product_price': '3.50',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertTotals(self.cart, 6)
+
+    def test_check_cart_totals_command(self):
+        self.cart.set_product_quantity(self.products[0].pk, 2)
+        consistent_cart = shop.models.Cart.objects.create()
+        consistent_cart.set_product_quantity(self.products[1].pk, 1)
+        # Corrupted by a change that bypassed update_totals
+        shop.models.CartItem.objects.filter(cart=self.cart).update(product_quantity=5)
+
+        stdout = io.StringIO()
+        call_command('check_cart_totals', stdout=stdout)
+        self.assertIn("Cart %s:" % self.cart.pk, stdout.getvalue())
+        self.assertNotIn("Cart %s:" % consistent_cart.pk, stdout.getvalue())
+        self.assertIn("2 cart(s) checked, 1 inconsistent.", stdout.getvalue())
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.items_count, 2)  # only reported
+
+        stdout = io.StringIO()
+        call_command('check_cart_totals', '--fix', stdout=stdout)
+        self.assertIn("1 inconsistent (fixed).", stdout.getvalue())
+        self.assertTotals(self.cart, 5)
+        stdout = io.StringIO()
+        call_command('check_cart_totals', stdout=stdout)
+        self.assertIn("0 inconsistent.", stdout.getvalue())
+
+
+class CartConcurrencyTestCase(TransactionTestCase):
+    threads_count = 8
+    updates_per_thread = 10
+
+    def test_concurrent_increments(self):
+        products = [shop.models.Product.objects.create(name="Product %s" % i, description="Description", price="1.00") for i in range(3)]
+        cart = shop.models.Cart.objects.create()
+
+        def add_products():
+            cart_instance = shop.models.Cart.objects.get(pk=cart.pk)
+            for i in range(self.updates_per_thread):
+                cart_instance.set_products_quantities({product.pk: 1 for product in products}, replace_quantity=False)
+
+        errors = run_in_threads(add_products, self.threads_count)
+        self.assertEqual(errors, [])
+
+        total = self.threads_count * self.updates_per_thread
+        # One line per product, no lost update
+        self.assertEqual(sorted(cart.cartitem_set.values_list('product_id', 'product_quantity')), [(product.pk, total) for product in products])
+        cart.refresh_from_db()
+        self.assertEqual(cart.items_count, total * len(products))
+
+    def test_concurrent_updates_of_different_products(self):
+        products = [shop.models.Product.objects.create(name="Product %s" % i, description="Description", price="1.%s0" % i)
+            for i in range(self.threads_count)]
+        cart = shop.models.Cart.objects.create()
+        products_iterator = iter(products)
+
+        def add_product():
+            product = next(products_iterator)
+            cart_instance = shop.models.Cart.objects.get(pk=cart.pk)
+            for i in range(self.updates_per_thread):
+                cart_instance.set_products_quantities({product.pk: 1}, replace_quantity=False)
+
+        errors = run_in_threads(add_product, self.threads_count)
+        self.assertEqual(errors, [])
+
+        # The stored totals are the ones of the items
+        cart.refresh_from_db()
+        self.assertEqual({field: getattr(cart, field) for field in cart.TOTALS_FIELDS}, cart.compute_totals())
+        self.assertEqual(cart.items_count, self.threads_count * self.updates_per_thread)
+
+
+class InvoiceNumberTestCase(TestCase):
+    def test_format(self):
+        code_prefix = timezone.now().strftime("%Y%m")
+        self.assertEqual(shop.models.generate_invoice_number(), "%s0001" % code_prefix)
+        self.assertEqual(shop.models.generate_invoice_number(), "%s0002" % code_prefix)
+
+    def test_allocate_block(self):
+        code_prefix = timezone.now().strftime("%Y%m")
+        shop.models.generate_invoice_number()
+        self.assertEqual(shop.models.allocate_invoice_numbers(3), [
+            "%s0002" % code_prefix, "%s0003" % code_prefix, "%s0004" % code_prefix])
+        self.assertEqual(shop.models.generate_invoice_number(), "%s0005" % code_prefix)
+
+    def test_sequence_starts_after_existing_invoices(self):
+        code_prefix = timezone.now().strftime("%Y%m")
+        shop.models.Invoice.objects.create(invoice_number="%s0041" % code_prefix)
+        self.assertEqual(shop.models.Invoice.objects.create().invoice_number, "%s0042" % code_prefix)
+
+
+class InvoiceNumberConcurrencyTestCase(TransactionTestCase):
+    threads_count = 8
+    invoices_per_thread = 25
+
+    def test_concurrent_invoices(self):
+        def create_invoices():
+            for i in range(self.invoices_per_thread):
+                shop.models.Invoice.objects.create()
+
+        errors = run_in_threads(create_invoices, self.threads_count)
+        self.assertEqual(errors, [])
+
+        code_prefix = timezone.now().strftime("%Y%m")
+        invoice_numbers = sorted(shop.models.Invoice.objects.values_list('invoice_number', flat=True))
+        total = self.threads_count * self.invoices_per_thread
+        # No duplicates and no gaps
+        self.assertEqual(invoice_numbers, ["%s%04d" % (code_prefix, number) for number in range(1, total + 1)])
+
+    def test_concurrent_blocks(self):
+        allocated = []
+
+        def allocate_blocks():
+            for i in range(self.invoices_per_thread):
+                allocated.extend(shop.models.allocate_invoice_numbers(4))
+
+        errors = run_in_threads(allocate_blocks, self.threads_count)
+        self.assertEqual(errors, [])
+
+        code_prefix = timezone.now().strftime("%Y%m")
+        total = self.threads_count * self.invoices_per_thread * 4
+        self.assertEqual(sorted(allocated), ["%s%04d" % (code_prefix, number) for number in range(1, total + 1)])
+
+
+class CartPaymentTestCase(TestCase):
+    def setUp(self):
+        self.product = shop.models.Product.objects.create(name="Product", description="Description", price="10.00")
+        self.cart = shop.models.Cart.objects.create(stripe_payment_intent_id="pi_test")
+        self.cart.set_product_quantity(self.product.pk, 3)
+
+    def test_payment_succeeded(self):
+        invoice = self.cart.payment_succeeded()
+        self.assertEqual(invoice.invoice_status, 'done')
+        self.assertEqual(invoice.stripe_payment_intent_id, "pi_test")
+        self.assertEqual(list(invoice.invoiceitem_set.values_list('product_name', 'product_quantity')), [("Product", 3)])
+        self.assertEqual(invoice.get_total(), self.cart.get_total())
+        self.cart.refresh_from_db()
+        self.assertFalse(self.cart.is_active)
+
+    def test_payment_succeeded_is_idempotent(self):
+        invoice = self.cart.payment_succeeded()
+        self.assertEqual(self.cart.payment_succeeded(), invoice)
+        self.assertEqual(shop.models.Invoice.objects.count(), 1)
+        self.assertEqual(shop.models.InvoiceItem.objects.count(), 1)
+
+    def test_invoice_totals(self):
+        invoice = shop.models.Invoice.objects.get(pk=self.cart.payment_succeeded().pk)
+        self.assertEqual(invoice.incl_tax, Decimal("36.30"))
+        with self.assertNumQueries(0):
+            self.assertEqual(invoice.get_prices(), {
+                'excl_tax': Decimal("30.00"), 'vat': {'21': Decimal("6.30")}, 'incl_tax': Decimal("36.30")})
+
+        # Invoices created before the totals were stored
+        shop.models.Invoice.objects.update(excl_tax=None, vat={}, incl_tax=None)
+        call_command('backfill_invoice_totals', '--sleep', '0', stdout=io.StringIO())
+        invoice.refresh_from_db()
+        self.assertEqual((invoice.excl_tax, invoice.vat, invoice.incl_tax), (Decimal("30.00"), {'21': "6.30"}, Decimal("36.30")))
+
+
+@override_settings(STRIPE_SECRET_WEBHOOK="whsec_test")
+class WebhookEventTestCase(TransactionTestCase):
+    def setUp(self):
+        self.product = shop.models.Product.objects.create(name="Product", description="Description", price="10.00")
+        self.cart = shop.models.Cart.objects.create(stripe_payment_intent_id="pi_test")
+        self.cart.set_product_quantity(self.product.pk, 2)
+
+    def post_event(self, event):
+        payload = json.dumps(event)
+        return self.client.post(reverse('stripe_webhook'), payload, content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=shop.stripe_fake.sign_payload(payload, "whsec_test"))
+
+    def charge_succeeded(self, payment_intent):
+        return {
+            'id': "evt_%s" % payment_intent, 'object': "event", 'type': "charge.succeeded",
+            'data': {'object': {'object': "charge", 'payment_intent': payment_intent}},
+        }
+
+    def test_webhook_stores_event_once(self):
+        self.assertEqual(self.post_event(self.charge_succeeded("pi_test")).status_code, 200)
+        self.assertEqual(self.post_event(self.charge_succeeded("pi_test")).status_code, 200)
+        self.assertEqual(shop.models.WebhookEvent.objects.filter(status='pending').count(), 1)
+        self.assertFalse(shop.models.Invoice.objects.exists())
+
+        call_command('process_webhook_events', '--once', '--workers=1', stdout=io.StringIO())
+        self.assertEqual(shop.models.WebhookEvent.objects.get().status, 'done')
+        self.assertEqual(shop.models.Invoice.objects.get().stripe_payment_intent_id, "pi_test")
+
+    def test_webhook_rejects_invalid_signature(self):
+        response = self.client.post(reverse('stripe_webhook'), "{}", content_type="application/json",
+            HTTP_STRIPE_SIGNATURE="t=1,v1=invalid")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(shop.models.WebhookEvent.objects.exists())
+
+    def test_failed_event_is_retried_then_abandoned(self):
+        self.post_event(self.charge_succeeded("pi_unknown"))
+        event = shop.models.WebhookEvent.objects.get()
+        event.process()
+        self.assertEqual((event.status, event.attempts), ('pending', 1))
+        self.assertGreater(event.next_attempt_at, timezone.now())
+        self.assertEqual(shop.models.WebhookEvent.claim_batch(10), [])
+
+        event.attempts = shop.models.WebhookEvent.MAX_ATTEMPTS - 1
+        event.process()
+        self.assertEqual(event.status, 'dead')
+
+
+@override_settings(STRIPE_SECRET_WEBHOOK="whsec_test")
+class FakeStripeTestCase(TestCase):
+    def setUp(self):
+        self.client_backup = stripe.default_http_client
+        stripe.default_http_client = shop.stripe_fake.FakeStripeClient(webhook_secret="whsec_test")
+
+    def tearDown(self):
+        stripe.default_http_client = self.client_backup
+
+    def test_payment_intent(self):
+        intent = stripe.PaymentIntent.create(amount=1000, currency='eur', api_key="sk_test_fake")
+        self.assertEqual(intent['status'], 'requires_payment_method')
+        intent = stripe.PaymentIntent.modify(intent['id'], amount=2500, api_key="sk_test_fake")
+        self.assertEqual(intent['amount'], 2500)
+
+        intent = stripe.PaymentIntent.confirm(intent['id'], api_key="sk_test_fake")
+        self.assertEqual(intent['status'], 'succeeded')
+        event = shop.models.WebhookEvent.objects.get()
+        self.assertEqual(event.event_type, 'charge.succeeded')
+        self.assertEqual(event.payload['data']['object']['payment_intent'], intent['id'])
+
+    def test_create_payment_skips_unchanged_cart(self):
+        product = shop.models.Product.objects.create(name="Product", description="Description", price="10.00")
+        cart = shop.models.Cart.objects.create()
+        cart.set_product_quantity(product.pk, 2)
+        session = self.client.session
+        session['cart_pk'] = cart.pk
+        session.save()
+
+        with mock.patch.object(stripe, 'api_key', "sk_test_fake"), \
+                mock.patch.object(stripe.default_http_client, 'request', wraps=stripe.default_http_client.request) as request:
+            client_secret = self.client.get(reverse('stripe_create_payment')).json()['clientSecret']
+            self.assertEqual(self.client.get(reverse('stripe_create_payment')).json()['clientSecret'], client_secret)
+            self.assertEqual(request.call_count, 1)
+
+            cart.set_product_quantity(product.pk, 3)
+            self.assertEqual(self.client.get(reverse('stripe_create_payment')).json()['clientSecret'], client_secret)
+            self.assertEqual(request.call_count, 2)
+        cart.refresh_from_db()
+        self.assertEqual((cart.stripe_amount, cart.stripe_currency), (3630, 'eur'))
+
+    def test_unknown_payment_intent(self):
+        with self.assertRaises(stripe.error.InvalidRequestError):
+            stripe.PaymentIntent.retrieve("pi_unknown", api_key="sk_test_fake")
+
+
+class PurgeCartsTestCase(TestCase):
+    def setUp(self):
+        self.product = shop.models.Product.objects.create(name="Product", description="Description", price="10.00")
+        self.user = user.models.User.objects.create_user("customer@example.com", "password")
+        old = timezone.now() - timedelta(days=40)
+        self.old_carts = [self.create_cart(updated_at=old) for i in range(5)]
+        self.old_inactive_user_cart = self.create_cart(updated_at=old, customer=self.user, is_active=False)
+        self.old_user_cart = self.create_cart(updated_at=old, customer=self.user)
+        self.recent_cart = self.create_cart()
+
+    def create_cart(self, updated_at=None, **kwargs):
+        cart = shop.models.Cart.objects.create(**kwargs)
+        cart.set_product_quantity(self.product.pk, 1)
+        if updated_at:
+            shop.models.Cart.objects.filter(pk=cart.pk).update(updated_at=updated_at)
+        return cart
+
+    def purge(self, *args):
+        stdout = io.StringIO()
+        with mock.patch('time.sleep'):
+            call_command('purge_carts', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_dry_run(self):
+        self.assertIn("6 cart(s), 6 cart item(s) and 0 session(s) to delete.", self.purge('--dry-run'))
+        self.assertEqual(shop.models.Cart.objects.count(), 8)
+
+    def test_purge(self):
+        self.assertIn("6 cart(s) and 0 session(s) deleted.", self.purge('--chunk-size', '2'))
+        # Active user carts and recent carts are kept, with their items
+        self.assertEqual(set(shop.models.Cart.objects.all()), {self.old_user_cart, self.recent_cart})
+        self.assertEqual(set(shop.models.CartItem.objects.values_list('cart', flat=True)), {self.old_user_cart.pk, self.recent_cart.pk})
+
+    def test_purge_queries(self):
+        # Per chunk: the pks, the savepoint, the items, the carts and the release, whatever the number of carts
+        with self.assertNumQueries(7):
+            self.assertIn("6 cart(s) and 0 session(s) deleted.", self.purge())
+
+    def test_age_cutoff(self):
+        self.assertIn("0 cart(s)", self.purge('--days', '50'))
+        self.assertEqual(shop.models.Cart.objects.count(), 8)
+
+    def test_chunk_boundaries(self):
+        # Chunks of exactly the number of rows to delete, or larger, delete everything once
+        for chunk_size in ('6', '100'):
+            with self.subTest(chunk_size=chunk_size), transaction.atomic():
+                self.assertIn("6 cart(s)", self.purge('--chunk-size', chunk_size))
+                self.assertEqual(shop.models.Cart.objects.count(), 2)
+                transaction.set_rollback(True)
+        self.assertIn("6 cart(s)", self.purge('--chunk-size', '1'))
+
+    def test_expired_sessions(self):
+        session = SessionStore()
+        session['cart_pk'] = self.recent_cart.pk
+        session.set_expiry(-1)
+        session.save()
+        self.assertIn("6 cart(s) and 1 session(s) deleted.", self.purge())
+
+
+class CartUpdateTestCase(TestCase):
+    def setUp(self):
+        self.products = [
+            shop.models.Product.objects.create(name="Product %s" % i, description="Description", price="10.00")
+            for i in range(3)
+        ]
+
+    def post(self, data):
+        return self.client.post(reverse('cart_update'), json.dumps(data), content_type="application/json")
+
+    def test_cart_update(self):
+        response = self.post({'items': [{'product': product.pk, 'quantity': 2} for product in self.products]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['items_count'], 6)
+        self.assertEqual(response.json()['incl_tax'], "72.60")
+
+        response = self.post({'items': [
+            {'product': self.products[0].pk, 'quantity': 0},
+            {'product': self.products[1].pk, 'quantity': 1},
+        ]})
+        self.assertEqual(response.json()['items_count'], 3)
+        self.assertEqual([item['product_quantity'] for item in response.json()['cartitems']], [1, 2])
+
+        response = self.post({'items': [{'product': self.products[2].pk, 'quantity': 3}], 'replace_quantity': False})
+        self.assertEqual(response.json()['items_count'], 6)
+
+    def test_cart_update_errors(self):
+        self.assertEqual(self.post({'items': [{'product': "x"}]}).status_code, 400)
+        self.assertEqual(self.post({'items': [{'product': 0, 'quantity': 1}]}).status_code, 400)
+        # Valid JSON of the wrong shape
+        for data in ([], "items", None, {'items': [[1, 2]]}, {'items': {'product': 1}}, {'items': [None]}):
+            self.assertEqual(self.post(data).status_code, 400)
+        self.assertFalse(shop.models.CartItem.objects.exists())
+        # Rejected and empty updates do not create a cart
+        self.assertEqual(self.post({'items': []}).json()['items_count'], 0)
+        self.assertFalse(shop.models.Cart.objects.exists())
+        self.assertNotIn('cart_key', self.client.session)
+
+
+class ShopPaginationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = [
+            shop.models.Product.objects.create(name="Product %s" % i, description="Description", price=i, vat=6 if i % 2 else 21)
+            for i in range(30)
+        ]
+
+    def get_pages(self, params=None):
+        pages = []
+        url = "%s?%s" % (reverse('shop_json'), urlencode(params or {}))
+        while url:
+            data = self.client.get(url).json()
+            pages.append([product['pk'] for product in data['products']])
+            url = data['next']
+        return pages
+
+    def test_pages(self):
+        pages = self.get_pages()
+        self.assertEqual([len(page) for page in pages], [12, 12, 6])
+        self.assertEqual(sum(pages, []), [product.pk for product in self.products])
+
+    def test_pages_with_filters(self):
+        pages = self.get_pages({'vat': 6, 'price_min': 3, 'price_max': 28})
+        expected = [product.pk for product in self.products if product.vat == 6 and 3 <= product.price <= 28]
+        self.assertEqual([len(page) for page in pages], [12, 1])
+        self.assertEqual(sum(pages, []), expected)
+
+        response = self.client.get(reverse('shop_json'), {'vat': 6, 'price_min': 3, 'price_max': 28, 'after': expected[11]})
+        self.assertEqual([product['pk'] for product in response.json()['products']], expected[12:])
+        self.assertIsNone(response.json()['next'])
+
+    def test_invalid_cursor(self):
+        # An invalid form shows the first page of the unfiltered catalog
+        for after in ("abc", "-1"):
+            response = self.client.get(reverse('shop_json'), {'after': after, 'vat': 6})
+            self.assertEqual([product['pk'] for product in response.json()['products']], [product.pk for product in self.products[:12]])
+
+    def test_context(self):
+        request = RequestFactory().get(reverse('shop'), {'vat': 21, 'after': self.products[0].pk})
+        context = shop.views.ShopView.as_view()(request).context_data
+        self.assertIsNone(context['page_obj'])
+        self.assertIsNone(context['paginator'])
+        self.assertFalse(context['is_paginated'])
+        self.assertEqual(list(context['object_list']), [product for product in self.products[1:25] if product.vat == 21])
+        self.assertFalse(context['keyset_is_first'])
+        self.assertEqual(context['keyset_first_query'], "vat=21")
+        self.assertEqual(context['keyset_next_query'], "vat=21&after=%s" % self.products[24].pk)
+
+
+class ProductSearchTestCase(TestCase):
+    def setUp(self):
+        self.chair = shop.models.Product.objects.create(name="Chaise en chêne", description="Une chaise solide", price="50.00")
+        self.table = shop.models.Product.objects.create(name="Table", description="Table assortie à la chaise", price="150.00")
+        self.lamp = shop.models.Product.objects.create(name="Lampe", description="Lampe de bureau", price="30.00")
+        self.backend = shop.search.get_search_backend()
+
+    def search(self, query):
+        return list(self.backend.search(shop.models.Product.objects.all(), query))
+
+    def test_search(self):
+        # Name matches rank first, accents are ignored
+        self.assertEqual(self.search("chaise"), [self.chair, self.table])
+        self.assertEqual(self.search("CHENE"), [self.chair])
+        self.assertEqual(self.search("chaise table"), [self.table])
+        self.assertEqual(self.search('"*'), [])
+
+    def test_autocomplete(self):
+        response = self.client.get(reverse('shop_search_autocomplete'), {'q': "lam"})
+        self.assertEqual([product['pk'] for product in response.json()['products']], [self.lamp.pk])
+
+    def test_autocomplete_limit(self):
+        # The limit applies after the filters of the queryset
+        lamps = [shop.models.Product.objects.create(name="Lampe %s" % i, description="Lampe", price="10.00") for i in range(3)]
+        queryset = shop.models.Product.objects.exclude(pk=self.lamp.pk)
+        self.assertEqual(list(self.backend.autocomplete(queryset, "lam", limit=3)), lamps)
+
+    def test_search_is_limited_in_sql(self):
+        products = shop.models.Product.objects.bulk_create([
+            shop.models.Product(name="Chaise %s" % i, description="Description", price="10.00") for i in range(200)])
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        with self.assertNumQueries(1) as queries:
+            page = list(self.backend.search(shop.models.Product.objects.all(), "chaise")[10:15])
+        self.assertEqual(len(page), 5)
+        self.assertIn("LIMIT 5 OFFSET 10", queries.captured_queries[0]['sql'])
+        self.assertEqual(self.backend.search(shop.models.Product.objects.all(), "chaise").count(), len(products) + 2)
+
+    def test_index_sync(self):
+        self.lamp.name = "Lanterne"
+        self.lamp.save()
+        self.assertEqual(self.search("lampe"), [self.lamp])  # still in the description
+        self.assertEqual(self.search("lanterne"), [self.lamp])
+        self.chair.delete()
+        self.assertEqual(self.search("chaise"), [self.table])
+
+    def test_rebuild(self):
+        shop.models.Product.objects.filter(pk=self.lamp.pk).update(name="Applique")
+        self.assertEqual(self.search("applique"), [])
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(self.search("applique"), [self.lamp])
+
+
+class RelatedProductsTestCase(TestCase):
+    def setUp(self):
+        self.products = [
+            shop.models.Product.objects.create(name="Product %s" % i, description="Description", price="10.00")
+            for i in range(4)
+        ]
+
+    def create_invoice(self, *products):
+        invoice_instance = shop.models.Invoice.objects.create()
+        shop.models.InvoiceItem.objects.bulk_create([
+            shop.models.InvoiceItem(invoice=invoice_instance, product=product, product_name=product.name,
+                product_description=product.description, product_price=product.price)
+            for product in products
+        ])
+        return invoice_instance
+
+    def test_refresh_related_products(self):
+        p0, p1, p2, p3 = self.products
+        self.create_invoice(p0, p1, p2)
+        self.create_invoice(p0, p2)
+        self.create_invoice(p3)
+        self.assertEqual(shop.models.refresh_related_products(batch_size=2), 3)
+        self.assertEqual(list(p0.get_related_products()), [p2, p1])
+        self.assertEqual(list(p1.get_related_products()), [p0, p2])
+        self.assertEqual(list(p3.get_related_products()), [])
+
+        # Only the new invoices are counted
+        self.create_invoice(p0, p1)
+        self.create_invoice(p0, p1)
+        self.assertEqual(shop.models.refresh_related_products(), 2)
+        self.assertEqual(list(p0.get_related_products()), [p1, p2])
+        self.assertEqual(shop.models.ProductPair.objects.get(product=p0, other_product=p1).invoices_count, 3)
+        self.assertEqual(shop.models.refresh_related_products(), 0)
+
+        call_command('refresh_related_products', '--rebuild', stdout=io.StringIO())
+        self.assertEqual(shop.models.ProductPair.objects.get(product=p1, other_product=p0).invoices_count, 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(p2.get_related_products()), [p0, p1])
+
+
+@override_settings(CART_STORAGE='shop.carts.CacheCartStorage')
+class CacheCartUpdateTestCase(CartUpdateTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_cart_update(self):
+        super().test_cart_update()
+        self.assertFalse(shop.models.Cart.objects.exists())
+
+
+class InvoicePdfTestCase(TransactionTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.user = user.models.User.objects.create_user(email="customer@example.com", password="password")
+        self.product = shop.models.Product.objects.create(name="Chaise (chêne)", description="Description", price="10.00")
+        self.cart = shop.models.Cart.objects.create(customer=self.user, stripe_payment_intent_id="pi_test", contact_first_name="Jean")
+        self.cart.set_product_quantity(self.product.pk, 3)
+        self.invoice = self.cart.payment_succeeded()
+
+    def test_render_invoice_pdf(self):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            path = shop.invoice_pdf.get_invoice_pdf(self.invoice)
+            self.assertTrue(path.startswith(os.path.join(self.media_root, 'invoices')))
+            with open(path, 'rb') as pdf_file:
+                content = pdf_file.read()
+            self.assertTrue(content.startswith(b'%PDF-1.4'))
+            self.assertIn(b'(Chaise \\(ch\xeane\\)) Tj', content)
+            xref = int(content.rsplit(b'startxref\n', 1)[1].split(b'\n')[0])
+            self.assertTrue(content[xref:].startswith(b'xref'))
+
+            # Cached: not rendered again
+            with mock.patch('shop.invoice_pdf.render_invoice_pdf') as render_invoice_pdf:
+                self.assertEqual(shop.invoice_pdf.get_invoice_pdf(self.invoice), path)
+            render_invoice_pdf.assert_not_called()
+
+    def test_invoice_pdf_view(self):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            self.client.force_login(self.user)
+            response = self.client.get(reverse('invoice_pdf', args=[self.invoice.pk]))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/pdf')
+            self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+
+            self.client.force_login(user.models.User.objects.create_user(email="other@example.com", password="password"))
+            self.assertEqual(self.client.get(reverse('invoice_pdf', args=[self.invoice.pk])).status_code, 404)
+
+    def test_render_invoices_command(self):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            call_command('render_invoices', '--month', self.invoice.invoice_date.strftime('%Y-%m'), '--processes', '2',
+                stdout=io.StringIO())
+            self.assertTrue(os.path.exists(shop.invoice_pdf.get_invoice_pdf(self.invoice)))
+            self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'invoices'))), 1)
+
+
+class InvoiceExportTestCase(TestCase):
+    def setUp(self):
+        self.products = [
+            shop.models.Product.objects.create(name="Product 21", description="Description", price="10.00", vat=21),
+            shop.models.Product.objects.create(name="Product 6", description="Description", price="3.33", vat=6),
+        ]
+        self.invoices = []
+        for i in range(3):
+            cart = shop.models.Cart.objects.create(stripe_payment_intent_id="pi_%s" % i, contact_email="customer@example.com")
+            cart.set_products_quantities({self.products[0].pk: i + 1, self.products[1].pk: 3})
+            self.invoices.append(cart.payment_succeeded())
+        shop.models.Invoice.objects.filter(pk=self.invoices[0].pk).update(invoice_date="2022-01-31")
+
+    def export(self, *args):
+        stdout = io.StringIO()
+        call_command('export_invoices', '--chunk-size', '2', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_export_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export('--from', '2022-02-01'))))
+        self.assertEqual([(row['invoice_number'], row['vat_rate']) for row in rows], [
+            (self.invoices[1].invoice_number, '6'), (self.invoices[1].invoice_number, '21'),
+            (self.invoices[2].invoice_number, '6'), (self.invoices[2].invoice_number, '21'),
+        ])
+        for invoice in self.invoices[1:]:
+            prices = invoice.get_prices()
+            invoice_rows = [row for row in rows if row['invoice_number'] == invoice.invoice_number]
+            self.assertEqual({row['vat_rate']: Decimal(row['vat']) for row in invoice_rows}, prices['vat'])
+            self.assertEqual(sum(Decimal(row['excl_tax']) for row in invoice_rows), prices['excl_tax'])
+            self.assertEqual(sum(Decimal(row['incl_tax']) for row in invoice_rows), prices['incl_tax'])
+
+    def test_export_jsonl(self):
+        lines = [json.loads(line) for line in self.export('--format', 'jsonl', '--to', '2022-01-31').splitlines()]
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]['invoice_number'], self.invoices[0].invoice_number)
+        self.assertEqual(lines[0]['incl_tax'], str(self.invoices[0].get_prices()['incl_tax']))
+        self.assertEqual(len(lines[0]['items']), 2)
+
+    def test_export_admin_action(self):
+        self.client.force_login(user.models.User.objects.create_superuser(email="admin@example.com", password="password"))
+        response = self.client.post(reverse('admin:shop_invoice_changelist'), {
+            'action': 'export_csv', '_selected_action': [invoice.pk for invoice in self.invoices]})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(len(b''.join(response.streaming_content).decode().splitlines()), 7)
+
+
+class SalesRollupTestCase(TestCase):
+    def setUp(self):
+        self.products = [
+            shop.models.Product.objects.create(name="Product 21", description="Description", price="10.00", vat=21),
+            shop.models.Product.objects.create(name="Product 6", description="Description", price="3.33", vat=6),
+        ]
+
+    def pay(self, quantities):
+        cart = shop.models.Cart.objects.create(stripe_payment_intent_id="pi_%s" % shop.models.Invoice.objects.count())
+        cart.set_products_quantities(quantities)
+        return cart.payment_succeeded()
+
+    def get_rollups(self):
+        return [
+            sorted(model.objects.values_list(*model.KEY_FIELDS, *model.SUM_FIELDS))
+            for model in shop.models.SalesRollup.MODELS
+        ]
+
+    def test_sales_rollups(self):
+        invoices = [
+            self.pay({self.products[0].pk: 1, self.products[1].pk: 3}),
+            self.pay({self.products[1].pk: 1}),
+        ]
+        day = invoices[0].invoice_date
+        daily_sales, vat_sales, product_sales = self.get_rollups()
+        self.assertEqual(daily_sales, [(day, 2, Decimal("23.32"), Decimal("2.90"), Decimal("26.22"))])
+        self.assertEqual(vat_sales, [
+            (day, 6, 2, Decimal("13.32"), Decimal("0.80"), Decimal("14.12")),
+            (day, 21, 1, Decimal("10.00"), Decimal("2.10"), Decimal("12.10")),
+        ])
+        self.assertEqual(product_sales, [
+            (day, self.products[0].pk, 1, Decimal("10.00")),
+            (day, self.products[1].pk, 4, Decimal("13.32")),
+        ])
+        self.assertEqual(sum(invoice.get_prices()['incl_tax'] for invoice in invoices), daily_sales[0][4])
+
+        # The rebuilt rollups match the incremental ones
+        rollups = self.get_rollups()
+        call_command('rebuild_sales_rollups', stdout=io.StringIO())
+        self.assertEqual(self.get_rollups(), rollups)
+
+    def test_sales_dashboard(self):
+        self.pay({self.products[0].pk: 2})
+        self.client.force_login(user.models.User.objects.create_superuser(email="admin@example.com", password="password"))
+        with self.assertNumQueries(6):  # session, user, months, vat rates, totals, top products
+            response = self.client.get(reverse('admin:shop_dailysales_changelist'))
+        self.assertContains(response, "24,20 €")
+        self.assertContains(response, "Product 21")
+        for year in ("abc", "99999", "-5"):
+            response = self.client.get(reverse('admin:shop_dailysales_changelist'), {'year': year})
+            self.assertEqual(response.context['year'], timezone.localdate().year)
+
+    def test_sales_dashboard_permission(self):
+        self.client.force_login(user.models.User.objects.create_user(
+            email="staff@example.com", password="password", is_staff=True))
+        self.assertEqual(self.client.get(reverse('admin:shop_dailysales_changelist')).status_code, 403)
+
+
+class CountingEmailBackend(locmem.EmailBackend):
+    """ locmem backend counting the connections opened """
+    opened = 0
+    failures = 0
+
+    def open(self):
+        if getattr(self, 'is_open', False):
+            return False
+        CountingEmailBackend.opened += 1
+        self.is_open = True
+        return True
+
+    def close(self):
+        self.is_open = False
+
+    def send_messages(self, messages):
+        if CountingEmailBackend.failures:
+            CountingEmailBackend.failures -= 1
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        return super().send_messages(messages)
+
+
+@override_settings(
+    EMAIL_BACKEND='djangostripe.mail.QueuedEmailBackend',
+    EMAIL_SEND_BACKEND='shop.tests.CountingEmailBackend',
+)
+class QueuedEmailTestCase(TestCase):
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+        CountingEmailBackend.failures = 0
+
+    def send_queued_emails(self):
+        call_command('send_queued_emails', '--once', stdout=io.StringIO())
+
+    def test_queued_emails(self):
+        for i in range(3):
+            send_mail("Subject %s" % i, "Body", "shop@example.com", ["customer%s@example.com" % i])
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(shop.models.QueuedEmail.objects.filter(status='pending').count(), 3)
+
+        self.send_queued_emails()
+        self.assertEqual([message.to for message in mail.outbox], [["customer%s@example.com" % i] for i in range(3)])
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(shop.models.QueuedEmail.objects.filter(status='done').count(), 3)
+
+    def test_queued_email_retry(self):
+        send_mail("Subject", "Body", "shop@example.com", ["customer@example.com"])
+        CountingEmailBackend.failures = 1
+        self.send_queued_emails()
+        queued_email = shop.models.QueuedEmail.objects.get()
+        self.assertEqual((queued_email.status, queued_email.attempts), ('pending', 1))
+        self.assertIn("SMTPServerDisconnected", queued_email.last_error)
+
+        shop.models.QueuedEmail.objects.update(next_attempt_at=timezone.now())
+        self.send_queued_emails()
+        self.assertEqual(shop.models.QueuedEmail.objects.get().status, 'done')
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(DEBUG=True, DEBUG_EMAIL="debug@example.com", EMAIL_SEND_BACKEND='djangostripe.mail.CustomEmailBackend')
+    def test_queued_email_debug_redirection(self):
+        send_mail("Subject", "Body", "shop@example.com", ["customer@example.com"])
+        with mock.patch('smtplib.SMTP') as smtp:
+            self.send_queued_emails()
+        from_email, recipients, message = smtp.return_value.sendmail.call_args[0]
+        self.assertEqual(recipients, ["debug@example.com"])
+        self.assertIn(b"Subject: Subject [customer@example.com]", message)
+
+    def test_order_confirmation(self):
+        product = shop.models.Product.objects.create(name="Product", description="Description", price="10.00")
+        cart = shop.models.Cart.objects.create(stripe_payment_intent_id="pi_test", contact_email="customer@example.com")
+        cart.set_product_quantity(product.pk, 2)
+        invoice = cart.payment_succeeded()
+        self.send_queued_emails()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["customer@example.com"])
+        self.assertIn(invoice.invoice_number, mail.outbox[0].subject)
+        self.assertIn("2 x Product", mail.outbox[0].body)
+
+    def test_queued_email_mime(self):
+        message = EmailMultiAlternatives("Commande n°1 confirmée", "Corps", "shop@example.com",
+            ["customer@example.com"], cc=["cc@example.com"], bcc=["bcc@example.com"])
+        message.attach_alternative("<p>Corps</p>", "text/html")
+        message.send()
+        queued_email = shop.models.QueuedEmail.objects.get()
+        self.assertEqual(queued_email.from_email, "shop@example.com")
+        self.assertEqual(queued_email.recipients, ["customer@example.com", "cc@example.com", "bcc@example.com"])
+        stored = email.message_from_bytes(bytes(queued_email.message))
+        self.assertEqual(stored.get_content_type(), 'multipart/alternative')
+        self.assertNotIn("bcc@example.com", bytes(queued_email.message).decode())
+
+        self.send_queued_emails()
+        sent = mail.outbox[0]
+        self.assertEqual(sent.subject, "Commande n°1 confirmée")
+        self.assertEqual(sent.body, "Corps")
+        self.assertEqual(sent.recipients(), ["customer@example.com", "cc@example.com", "bcc@example.com"])
+        self.assertEqual(sent.message().as_bytes(), bytes(queued_email.message))
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_order_confirmation_not_queued(self):
+        product = shop.models.Product.objects.create(name="Product", description="Description", price="10.00")
+        cart = shop.models.Cart.objects.create(stripe_payment_intent_id="pi_test", contact_email="customer@example.com")
+        cart.set_product_quantity(product.pk, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            invoice = cart.payment_succeeded()
+            self.assertEqual(mail.outbox, [])  # sent once the invoice is committed
+        self.assertFalse(shop.models.QueuedEmail.objects.exists())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(invoice.invoice_number, mail.outbox[0].subject)
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_order_confirmation_send_failure(self):
+        cart = shop.models.Cart.objects.create(stripe_payment_intent_id="pi_test", contact_email="customer@example.com")
+        with mock.patch.object(locmem.EmailBackend, 'send_messages', side_effect=smtplib.SMTPServerDisconnected()):
+            with self.assertLogs('shop.models', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+                invoice = cart.payment_succeeded()
+        self.assertTrue(shop.models.Invoice.objects.filter(pk=invoice.pk).exists())
+
+
+class ProductImageTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.product = shop.models.Product.objects.create(name="Chaise", description="Description", price="10.00")
+
+    def upload_picture(self, size, color=(200, 30, 30)):
+        content = io.BytesIO()
+        Image.new('RGBA', size, color).save(content, 'PNG')
+        self.product.picture = SimpleUploadedFile("chaise.png", content.getvalue())
+        self.product.save()
+        call_command('process_product_images', '--once', stdout=io.StringIO())
+        self.product.refresh_from_db()
+
+    def test_default_picture(self):
+        self.assertFalse(shop.models.ProductImageTask.objects.exists())
+        picture = self.product.get_card_picture()
+        self.assertTrue(picture['src'].endswith("img/product.svg"))
+        self.assertEqual((picture['width'], picture['height']), (450, 300))
+
+    def test_picture_variants(self):
+        self.upload_picture((1000, 800))
+        self.assertEqual(shop.models.ProductImageTask.objects.get().status, 'done')
+        variants = self.product.picture_variants
+        self.assertEqual(variants['source'], self.product.picture.name)
+        self.assertEqual([(v['width'], v['height']) for v in variants['card']['webp']], [(450, 300), (900, 600)])
+        # Too small for the 2x detail variant
+        self.assertEqual([(v['width'], v['height']) for v in variants['detail']['jpeg']], [(600, 700)])
+        path = os.path.join(self.media_root, shop.images.VARIANTS_DIR, variants['card']['webp'][1]['name'])
+        with Image.open(path) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (900, 600)))
+
+        picture = self.product.get_card_picture()
+        self.assertEqual(picture['src'], variants['card']['jpeg'][0]['url'])
+        self.assertEqual(picture['srcset'], "%s 450w, %s 900w" % (
+            variants['card']['jpeg'][0]['url'], variants['card']['jpeg'][1]['url']))
+
+        # Saving the product again does not regenerate the variants
+        self.product.save()
+        self.assertEqual(shop.models.ProductImageTask.objects.count(), 1)
+
+        # A new picture replaces the variants
+        self.upload_picture((500, 400))
+        self.assertNotEqual(self.product.picture_variants['card'], variants['card'])
+        self.assertFalse(os.path.exists(path))
+
+    def test_same_picture_of_two_products(self):
+        other_product = self.product
+        self.upload_picture((500, 400))
+        self.product = shop.models.Product.objects.create(name="Table", description="Description", price="10.00")
+        self.upload_picture((500, 400))
+        # A new picture of a product keeps the variants of the other one
+        self.upload_picture((500, 400), color=(30, 30, 200))
+        other_product.refresh_from_db()
+        for name in shop.images.get_variant_names(other_product.picture_variants):
+            self.assertTrue(os.path.exists(os.path.join(self.media_root, shop.images.VARIANTS_DIR, name)))
+
+    def test_product_image_view(self):
+        self.upload_picture((500, 400))
+        image = self.product.picture_variants['card']['webp'][0]
+        response = self.client.get(image['url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(self.client.get(reverse('product_image', args=["1-0123456789abcdef-1x1.jpg"])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('product_image', args=["..%2Fchaise.png"])).status_code, 404)
+
+
+@override_settings(DATABASE_REPLICA='replica')
+class ReplicaRouterTestCase(SimpleTestCase):
+    databases = {'default'}
+
+    def setUp(self):
+        self.router = djangostripe.routers.ReplicaRouter()
+        token = djangostripe.routers.pinned.set(False)
+        self.addCleanup(djangostripe.routers.pinned.reset, token)
+
+    def test_db_for_read(self):
+        self.assertEqual(self.router.db_for_read(shop.models.Product), 'replica')
+        self.assertEqual(self.router.db_for_read(shop.models.DailySales), 'replica')
+        self.assertEqual(self.router.db_for_read(shop.models.Cart), 'default')
+        # Sessions and last logins are saved by most requests, they do not pin
+        self.assertEqual(self.router.db_for_write(Session), 'default')
+        self.assertEqual(self.router.db_for_write(user.models.User), 'default')
+        self.assertEqual(self.router.db_for_read(shop.models.Product), 'replica')
+        with transaction.atomic():
+            self.assertEqual(self.router.db_for_read(shop.models.Product), 'default')
+
+        # Pinned to the primary after a write
+        self.assertEqual(self.router.db_for_write(shop.models.Cart), 'default')
+        self.assertEqual(self.router.db_for_read(shop.models.Product), 'default')
+        self.assertEqual(djangostripe.routers.get_read_db(), 'default')
+
+        with override_settings(DATABASE_REPLICA=None):
+            djangostripe.routers.pinned.set(False)
+            self.assertEqual(self.router.db_for_read(shop.models.Product), 'default')
+
+    def test_pinning_middleware(self):
+        def write(request):
+            self.router.db_for_write(shop.models.Cart)
+            return HttpResponse()
+
+        def read(request):
+            return HttpResponse(djangostripe.routers.get_read_db())
+
+        response = djangostripe.routers.ReplicaPinningMiddleware(write)(RequestFactory().post('/'))
+        self.assertEqual(response.cookies[djangostripe.routers.PIN_COOKIE]['max-age'], 5)
+        self.assertFalse(djangostripe.routers.pinned.get())
+
+        self.assertEqual(djangostripe.routers.ReplicaPinningMiddleware(read)(RequestFactory().get('/')).content, b'replica')
+        request = RequestFactory().get('/')
+        request.COOKIES[djangostripe.routers.PIN_COOKIE] = '1'
+        self.assertEqual(djangostripe.routers.ReplicaPinningMiddleware(read)(request).content, b'default')
+
+
+class CatalogCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = [
+            shop.models.Product.objects.create(name="Product %s" % i, description="Description", price="10.00")
+            for i in range(3)
+        ]
+
+    def test_catalog_page(self):
+        response = self.client.get(reverse('shop_json'))
+        self.assertEqual(shop.cache.get_stats(), {'hits': 0, 'misses': 1})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(reverse('shop_json')).json(), response.json())
+        self.assertEqual(shop.cache.get_stats(), {'hits': 1, 'misses': 1})
+        self.assertEqual(len(self.client.get(reverse('shop_json'), {'vat': 6}).json()['products']), 0)
+
+        # Saving a product invalidates the catalog once committed
+        self.products[0].name = "Renamed"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].save()
+        self.assertEqual(self.client.get(reverse('shop_json')).json()['products'][0]['name'], "Renamed")
+
+        stdout = io.StringIO()
+        call_command('catalog_cache_stats', '--reset', stdout=stdout)
+        self.assertIn("1 hit(s), 3 miss(es)", stdout.getvalue())
+        self.assertEqual(shop.cache.get_stats(), {'hits': 0, 'misses': 0})
+
+    def test_product(self):
+        product = self.products[0]
+        self.assertEqual(shop.cache.get_product(product.pk), product)
+        with self.assertNumQueries(0):
+            self.assertEqual(shop.cache.get_product(product.pk).name, product.name)
+        # Unknown products are cached too
+        self.assertIsNone(shop.cache.get_product(0))
+        with self.assertNumQueries(0):
+            self.assertIsNone(shop.cache.get_product(0))
+        self.assertEqual(shop.cache.get_related_products(product), self.products[1:])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.assertIsNone(shop.cache.get_product(self.products[0].pk))
+
+    def test_stampede_protection(self):
+        compute = mock.Mock(return_value="computed")
+        # Another process computes the entry
+        cache.add("%s:lock" % shop.cache.get_key("entry"), 1)
+        timer = threading.Timer(0.1, lambda: cache.set(shop.cache.get_key("entry"), ("other", )))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(shop.cache.get_or_compute("entry", compute), "other")
+        compute.assert_not_called()
+
+        shop.cache.bump_version()
+        self.assertEqual(shop.cache.get_or_compute("entry", compute), "computed")
+        self.assertEqual(shop.cache.get_or_compute("entry", compute), "computed")
+        compute.assert_called_once()
@@ -5,13 +5,21 @@ import shop.views
 urlpatterns = [
     # Shop
     path('', shop.views.ShopView.as_view(), name="shop"),
+    path('products.json', shop.views.ShopJsonView.as_view(), name="shop_json"),
+    path('search/', shop.views.SearchView.as_view(), name="shop_search"),
+    path('search/autocomplete/', shop.views.search_autocomplete, name="shop_search_autocomplete"),
+    path('product-images/<str:name>', shop.views.product_image, name="product_image"),
     path('item/<int:pk>/', shop.views.ShopItemView.as_view(), name="shop_item"),
 
     # Payment
     path('cart/', shop.views.CartView.as_view(), name="cart"),
+    path('cart/update/', shop.views.cart_update, name="cart_update"),
     path('checkout/', shop.views.CheckoutView.as_view(), name="checkout"),
     path('payment/', shop.views.PaymentView.as_view(), name="payment"),
 
+    # Invoices
+    path('invoice/<int:pk>/pdf/', shop.views.invoice_pdf, name="invoice_pdf"),
+
     # Stripe
     path('stripe-create-payment-intent', shop.views.stripe_create_payment, name="stripe_create_payment"),
     path('stripe-webhook/', shop.views.stripe_webhook, name="stripe_webhook"),
@@ -1,35 +1,163 @@
+import json
+
 import stripe
 
+from django import forms
 from django.conf import settings
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponse
-from django.urls import reverse_lazy
+from django.contrib.auth.decorators import login_required
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, JsonResponse, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse, reverse_lazy
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.views.generic import DetailView, ListView, UpdateView
 
+import shop.cache
+import shop.images
+import shop.invoice_pdf
 import shop.models
+import shop.search
     
 
 # Shop
+class ProductFilterForm(forms.Form):
+    price_min = forms.DecimalField(label="Min price (HTVA)", required=False, min_value=0)
+    price_max = forms.DecimalField(label="Max price (HTVA)", required=False, min_value=0)
+    vat = forms.IntegerField(label="VAT (%)", required=False, min_value=0)
+    after = forms.IntegerField(required=False, min_value=0, widget=forms.HiddenInput)
+
+
 class ShopView(ListView):
+    """
+    Keyset pagination: a page starts after the last product of the previous page (`after` parameter),
+    so deep pages cost the same query as the first one. The ListView paginator is not used, the
+    pagination links are in the keyset_* context variables.
+    """
     template_name = "shop/shop.html"
     model = shop.models.Product
+    page_size = 12
+
+    def get_queryset(self):
+        queryset = super().get_queryset().order_by('pk')
+        self.filter_form = ProductFilterForm(self.request.GET)
+        if self.filter_form.is_valid():
+            if self.filter_form.cleaned_data['price_min'] is not None:
+                queryset = queryset.filter(price__gte=self.filter_form.cleaned_data['price_min'])
+            if self.filter_form.cleaned_data['price_max'] is not None:
+                queryset = queryset.filter(price__lte=self.filter_form.cleaned_data['price_max'])
+            if self.filter_form.cleaned_data['vat'] is not None:
+                queryset = queryset.filter(vat=self.filter_form.cleaned_data['vat'])
+        return queryset
+
+    def get_keyset_page(self, queryset):
+        """
+        Return the products of the page and whether there is a next page.
+        """
+        filters = self.filter_form.cleaned_data if self.filter_form.is_valid() else {}
+        after = filters.get('after')
+
+        def get_page():
+            page_queryset = queryset.filter(pk__gt=after) if after else queryset
+            object_list = list(page_queryset[:self.page_size + 1])
+            return object_list[:self.page_size], len(object_list) > self.page_size
+
+        return shop.cache.get_or_compute(shop.cache.get_page_name(filters, self.page_size), get_page)
+
+    def get_context_data(self, **kwargs):
+        object_list, has_next = self.get_keyset_page(self.object_list)
+        context = super().get_context_data(object_list=object_list, **kwargs)
+        context['filter_form'] = self.filter_form
+
+        query = self.request.GET.copy()
+        query.pop('after', None)
+        context['keyset_first_query'] = query.urlencode()
+        context['keyset_is_first'] = not (self.filter_form.is_valid() and self.filter_form.cleaned_data['after'])
+        context['keyset_next_query'] = None
+        if has_next:
+            query['after'] = object_list[-1].pk
+            context['keyset_next_query'] = query.urlencode()
+        return context
+
+
+class ShopJsonView(ShopView):
+    def render_to_response(self, context, **response_kwargs):
+        next_query = context['keyset_next_query']
+        return JsonResponse({
+            'products': [{
+                'pk': product_instance.pk,
+                'name': product_instance.name,
+                'get_incl_tax': product_instance.get_incl_tax(),
+                'get_picture_url': product_instance.get_picture_url(),
+                'picture': product_instance.get_card_picture(),
+                'url': reverse('shop_item', args=[product_instance.pk]),
+            } for product_instance in context['object_list']],
+            'next': "%s?%s" % (reverse('shop_json'), next_query) if next_query else None,
+        })
+
+
+class SearchView(ListView):
+    template_name = "shop/search.html"
+    model = shop.models.Product
+    paginate_by = 12
+
+    def get_queryset(self):
+        return shop.search.get_search_backend().search(super().get_queryset(), self.request.GET.get('q', ''))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['q'] = self.request.GET.get('q', '')
+        return context
+
+
+def search_autocomplete(request):
+    products = shop.search.get_search_backend().autocomplete(shop.models.Product.objects.all(), request.GET.get('q', ''))
+    return JsonResponse({
+        'products': [{
+            'pk': product_instance.pk,
+            'name': product_instance.name,
+            'url': reverse('shop_item', args=[product_instance.pk]),
+        } for product_instance in products],
+    })
+
+
+def product_image(request, name):
+    """
+    Serve a product picture variant. Their names change with their content, so they are cached forever.
+    """
+    if not shop.images.VARIANT_NAME_RE.match(name):
+        raise Http404
+    try:
+        image_file = default_storage.open("%s/%s" % (shop.images.VARIANTS_DIR, name), 'rb')
+    except FileNotFoundError:
+        raise Http404
+    response = FileResponse(image_file, content_type=shop.images.CONTENT_TYPES[name.rsplit('.', 1)[1]])
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 
 class ShopItemView(DetailView):
     template_name = "shop/shop_item.html"
     model = shop.models.Product
 
+    def get_object(self, queryset=None):
+        product_instance = shop.cache.get_product(self.kwargs['pk'])
+        if product_instance is None:
+            raise Http404
+        return product_instance
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['related_products'] = shop.models.Product.objects.exclude(pk=self.object.pk)[:4]
+        context['related_products'] = shop.cache.get_related_products(self.object)
         return context
 
     def post(self, request, *args, **kwargs):
         product = request.POST.get('product')
         quantity = int(request.POST.get('quantity', 1))
         # Find or create cart instance
-        cart_instance = shop.models.Cart.get_session_cart(request)
+        cart_instance = request.cart
+        cart_instance.persist(request)
         # Find or create cart item instance
         cart_instance.set_product_quantity(product, quantity)
         # Add message
@@ -43,13 +171,14 @@ class CartView(DetailView):
     model = shop.models.Cart
 
     def get_object(self, queryset=None):
-        return shop.models.Cart.get_session_cart(self.request)
+        return self.request.cart
 
     def post(self, request, *args, **kwargs):
         product = request.POST.get('product')
         quantity = int(request.POST.get('quantity', 1))
         # Find or create cart instance
         cart_instance = self.get_object()
+        cart_instance.persist(request)
         # Find or create cart item instance
         cart_instance.set_product_quantity(product, quantity, replace_quantity=True)
         # Add message
@@ -57,6 +186,41 @@ class CartView(DetailView):
         return self.get(request, *args, **kwargs)
 
 
+@require_POST
+def cart_update(request):
+    """
+    Change the quantity of several products at once.
+    Body: {"items": [{"product": <pk>, "quantity": <int>}, ...], "replace_quantity": true}
+    """
+    try:
+        data = json.loads(request.body)
+        if not isinstance(data, dict) or not isinstance(data['items'], list):
+            raise TypeError
+        replace_quantity = bool(data.get('replace_quantity', True))
+        quantities = {}
+        for item in data['items']:
+            if not isinstance(item, dict):
+                raise TypeError
+            product_pk, quantity = int(item['product']), int(item.get('quantity', 1))
+            quantities[product_pk] = quantity if replace_quantity else quantities.get(product_pk, 0) + quantity
+    except (ValueError, TypeError, KeyError):
+        return JsonResponse({'error': "Invalid cart update."}, status=400)
+
+    # Checked before the cart is saved, so a rejected update does not create an empty cart
+    unknown_pks = set(quantities) - set(shop.models.Product.objects.filter(pk__in=list(quantities)).values_list('pk', flat=True))
+    if unknown_pks:
+        return JsonResponse({'error': "Unknown products: %s" % sorted(unknown_pks)}, status=400)
+
+    cart_instance = request.cart
+    if quantities:
+        cart_instance.persist(request)
+        try:
+            cart_instance.set_products_quantities(quantities, replace_quantity=replace_quantity)
+        except shop.models.Product.DoesNotExist as e:
+            return JsonResponse({'error': str(e)}, status=400)  # deleted meanwhile
+    return JsonResponse(cart_instance.get_billing_informations())
+
+
 class CheckoutView(UpdateView):
     template_name = "shop/checkout.html"
     model = shop.models.Cart
@@ -72,7 +236,12 @@ class CheckoutView(UpdateView):
     success_url = reverse_lazy('payment')
 
     def get_object(self, queryset=None):
-        return shop.models.Cart.get_session_cart(self.request)
+        return self.request.cart
+
+    def form_valid(self, form):
+        # A cart kept in the cache is written to the database at checkout
+        self.object.persist(self.request, database=True)
+        return super().form_valid(form)
 
 
 class PaymentView(DetailView):
@@ -80,7 +249,7 @@ class PaymentView(DetailView):
     model = shop.models.Cart
 
     def get_object(self, queryset=None):
-        return shop.models.Cart.get_session_cart(self.request)
+        return self.request.cart
         
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -88,29 +257,55 @@ class PaymentView(DetailView):
         return context
 
 
+# Invoices
+def invoice_pdf_response(invoice_instance):
+    """
+    Stream the cached PDF of the invoice.
+    """
+    response = FileResponse(open(shop.invoice_pdf.get_invoice_pdf(invoice_instance), 'rb'), as_attachment=True,
+        filename="invoice-%s.pdf" % invoice_instance.invoice_number, content_type='application/pdf')
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
+@login_required
+def invoice_pdf(request, pk):
+    return invoice_pdf_response(get_object_or_404(shop.models.Invoice, pk=pk, customer=request.user))
+
+
 # Stripe
 def stripe_create_payment(request):
     try:
-        cart_instance = shop.models.Cart.get_session_cart(request)
-        # Create a PaymentIntent with the order amount and currency
-        stripe.api_key = settings.STRIPE_SECRET_KEY
+        cart_instance = request.cart
+        amount = int(cart_instance.get_total() * 100)
+        currency = 'eur'
+        if cart_instance.stripe_payment_intent_id and cart_instance.stripe_client_secret \
+                and (cart_instance.stripe_amount, cart_instance.stripe_currency) == (amount, currency):
+            # The PaymentIntent is up to date
+            return JsonResponse({'clientSecret': cart_instance.stripe_client_secret})
+
+        # Create or update the PaymentIntent with the order amount and currency
+        cart_instance.persist(request, database=True)
         if cart_instance.stripe_payment_intent_id:
             intent = stripe.PaymentIntent.modify(
                 cart_instance.stripe_payment_intent_id,
-                amount=int(cart_instance.get_total() * 100),
-                currency='eur',
+                amount=amount,
+                currency=currency,
             )
         else:
             intent = stripe.PaymentIntent.create(
-                amount=int(cart_instance.get_total() * 100),
-                currency='eur',
+                amount=amount,
+                currency=currency,
                 automatic_payment_methods={
                     'enabled': True,
                 },
             )
-            # Save PaymentIntent
-            cart_instance.stripe_payment_intent_id = intent['id']
-            cart_instance.save()
+        # Save PaymentIntent
+        cart_instance.stripe_payment_intent_id = intent['id']
+        cart_instance.stripe_client_secret = intent['client_secret']
+        cart_instance.stripe_amount = amount
+        cart_instance.stripe_currency = currency
+        cart_instance.save(update_fields=['stripe_payment_intent_id', 'stripe_client_secret', 'stripe_amount', 'stripe_currency', 'updated_at'])
         return JsonResponse({'clientSecret': intent['client_secret']})
     except Exception as e:
         return JsonResponse({'error': str(e)})
@@ -118,7 +313,6 @@ def stripe_create_payment(request):
 
 @csrf_exempt
 def stripe_webhook(request):
-    stripe.api_key = settings.STRIPE_SECRET_KEY
     endpoint_secret = settings.STRIPE_SECRET_WEBHOOK
     payload = request.body
     sig_header = request.META['HTTP_STRIPE_SIGNATURE']
@@ -135,9 +329,8 @@ def stripe_webhook(request):
         # Invalid signature
         return HttpResponse(status=400)
 
-    # Handle the checkout.session.completed event
-    if event['type'] == 'charge.succeeded':
-        cart_instance = shop.models.Cart.objects.get(stripe_payment_intent_id=event['data']['object']['payment_intent'])
-        cart_instance.payment_succeeded()
+    # Store the event, it is handled by the process_webhook_events command
+    if event['type'] in shop.models.WebhookEvent.HANDLED_EVENT_TYPES:
+        shop.models.WebhookEvent.store(json.loads(payload))
 
     return HttpResponse(status=200)
\ No newline at end of file
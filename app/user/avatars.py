@@ -0,0 +1,57 @@
+"""
+Avatar thumbnails, generated when the avatar is uploaded.
+
+The thumbnails are square, re-encoded as JPEG and named after their user and their content, so
+the thumbnails of a user can be deleted without checking the other users. Their names, URLs
+and dimensions are stored in User.avatar_thumbnails, so rendering an avatar never opens a file.
+"""
+import hashlib
+import io
+import os
+
+from PIL import Image, ImageOps
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+import shop.images
+
+
+THUMBNAIL_SIZES = {
+    'small': 40,
+    'medium': 128,
+    'large': 256,
+}
+THUMBNAIL_DIR = 'avatar/thumbnails'
+
+
+def generate_thumbnails(avatar_file, owner, storage=default_storage):
+    """
+    Create the thumbnails of an avatar file of the user `owner` (pk) and return their informations.
+    """
+    image = shop.images.open_image(avatar_file)
+    thumbnails = {'source': avatar_file.name}
+    for size_name, size in THUMBNAIL_SIZES.items():
+        thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        content = io.BytesIO()
+        thumbnail.save(content, 'JPEG', quality=85, optimize=True, progressive=True)
+        name = os.path.join(THUMBNAIL_DIR, "%s-%s-%s.jpg" % (owner, hashlib.sha256(content.getvalue()).hexdigest()[:16], size))
+        if not storage.exists(name):
+            name = storage.save(name, ContentFile(content.getvalue()))
+        thumbnails[size_name] = {
+            'name': name,
+            'url': storage.url(name),
+            'width': thumbnail.width,
+            'height': thumbnail.height,
+        }
+    return thumbnails
+
+
+def delete_thumbnails(thumbnails, keep=None, storage=default_storage):
+    """
+    Delete the thumbnail files of `thumbnails`, except the ones also in `keep`.
+    """
+    kept_names = {thumbnail['name'] for size_name, thumbnail in (keep or {}).items() if size_name in THUMBNAIL_SIZES}
+    for size_name, thumbnail in thumbnails.items():
+        if size_name in THUMBNAIL_SIZES and thumbnail['name'] not in kept_names:
+            storage.delete(thumbnail['name'])
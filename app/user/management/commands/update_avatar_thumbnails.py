@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+import user.models
+
+
+class Command(BaseCommand):
+    help = "Generate the thumbnails of the avatars uploaded before they were generated at upload."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Also regenerate the existing thumbnails.")
+
+    def handle(self, *args, **options):
+        updated = 0
+        for user_instance in user.models.User.objects.exclude(avatar='').exclude(avatar__isnull=True).iterator():
+            if not options['all'] and user_instance.avatar_thumbnails.get('source') == user_instance.avatar.name:
+                continue
+            user_instance.update_avatar_thumbnails()
+            updated += 1
+        self.stdout.write(self.style.SUCCESS("Thumbnails of %s avatar(s) updated." % updated))
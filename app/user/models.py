@@ -1,8 +1,15 @@
+import logging
+
 from django.db import models
 from django.contrib.auth.models import BaseUserManager, AbstractUser
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.utils.translation import gettext_lazy as _
 
+import user.avatars
+
+
+logger = logging.getLogger(__name__)
+
 
 # Custom Auth
 # https://docs.djangoproject.com/fr/3.0/topics/auth/customizing/
@@ -51,6 +58,10 @@ class User(AbstractUser):
         upload_to='avatar',
         blank=True, null=True,
     )
+    avatar_thumbnails = models.JSONField(
+        verbose_name=_("Miniatures de l'avatar"),
+        default=dict, blank=True, editable=False,
+    )  # Generated by update_avatar_thumbnails
     first_name = models.CharField(
         verbose_name=_("Prénom"),
         max_length=255,
@@ -76,7 +87,33 @@ class User(AbstractUser):
     def get_fullname(self):
         return "%s %s" % (self.first_name, self.last_name)
 
-    def get_avatar_url(self):
-        if self.avatar and self.avatar.file:
-            return self.avatar.url
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # The thumbnails are generated when a new avatar is uploaded, never when it is displayed
+        if (self.avatar.name or None) != self.avatar_thumbnails.get('source'):
+            self.update_avatar_thumbnails()
+
+    def update_avatar_thumbnails(self):
+        previous_thumbnails = self.avatar_thumbnails
+        self.avatar_thumbnails = {}
+        if self.avatar:
+            try:
+                self.avatar_thumbnails = user.avatars.generate_thumbnails(self.avatar, self.pk)
+            except OSError:
+                # Missing or unreadable file, the default avatar is displayed
+                logger.exception("Unable to generate the avatar thumbnails of %s", self.email)
+                self.avatar_thumbnails = {'source': self.avatar.name}
+        User.objects.filter(pk=self.pk).update(avatar_thumbnails=self.avatar_thumbnails)
+        user.avatars.delete_thumbnails(previous_thumbnails, keep=self.avatar_thumbnails)
+
+    def get_avatar_url(self, size='medium'):
+        thumbnail = self.avatar_thumbnails.get(size)
+        if thumbnail:
+            return thumbnail['url']
         return staticfiles_storage.url('img/avatar.png')
+
+    def get_avatar_size(self, size='medium'):
+        thumbnail = self.avatar_thumbnails.get(size)
+        if thumbnail:
+            return thumbnail['width'], thumbnail['height']
+        return user.avatars.THUMBNAIL_SIZES[size], user.avatars.THUMBNAIL_SIZES[size]
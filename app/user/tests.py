@@ -1,3 +1,73 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
 
-# Create your tests here.
+from PIL import Image
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+import user.models
+
+
+def create_image(size=(300, 200), image_format='PNG', mode='RGBA'):
+    content = io.BytesIO()
+    Image.new(mode, size, (200, 30, 30)).save(content, image_format)
+    return SimpleUploadedFile("avatar.%s" % image_format.lower(), content.getvalue())
+
+
+class AvatarTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = user.models.User.objects.create_user(email="customer@example.com", password="password")
+
+    def test_default_avatar(self):
+        self.assertEqual(self.user.avatar_thumbnails, {})
+        self.assertTrue(self.user.get_avatar_url().endswith("img/avatar.png"))
+
+    def test_avatar_thumbnails(self):
+        self.user.avatar = create_image()
+        self.user.save()
+        thumbnails = user.models.User.objects.get(pk=self.user.pk).avatar_thumbnails
+        self.assertEqual(thumbnails['source'], self.user.avatar.name)
+        self.assertEqual((thumbnails['small']['width'], thumbnails['small']['height']), (40, 40))
+        with Image.open(os.path.join(self.media_root, thumbnails['medium']['name'])) as image:
+            self.assertEqual((image.format, image.size), ('JPEG', (128, 128)))
+
+        # Rendering the avatar does not touch the files
+        user_instance = user.models.User.objects.get(pk=self.user.pk)
+        user_instance.avatar.storage = None
+        self.assertEqual(user_instance.get_avatar_url('small'), thumbnails['small']['url'])
+        self.assertEqual(user_instance.get_avatar_size('large'), (256, 256))
+
+        # A new avatar replaces the thumbnails
+        self.user.avatar = create_image(size=(50, 80), image_format='JPEG', mode='RGB')
+        self.user.save()
+        self.assertNotEqual(self.user.avatar_thumbnails['small']['name'], thumbnails['small']['name'])
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, thumbnails['small']['name'])))
+
+    def test_same_avatar_of_two_users(self):
+        other_user = user.models.User.objects.create_user(email="other@example.com", password="password")
+        other_user.avatar = create_image()
+        other_user.save()
+        self.user.avatar = create_image()
+        self.user.save()
+        # Changing the avatar of a user keeps the thumbnails of the other one
+        self.user.avatar = create_image(size=(50, 80), image_format='JPEG', mode='RGB')
+        self.user.save()
+        for thumbnail in user.models.User.objects.get(pk=other_user.pk).avatar_thumbnails.values():
+            if isinstance(thumbnail, dict):
+                self.assertTrue(os.path.exists(os.path.join(self.media_root, thumbnail['name'])))
+
+    def test_update_avatar_thumbnails_command(self):
+        self.user.avatar = create_image()
+        self.user.save()
+        user.models.User.objects.update(avatar_thumbnails={})
+        call_command('update_avatar_thumbnails', stdout=io.StringIO())
+        self.assertEqual(user.models.User.objects.get(pk=self.user.pk).avatar_thumbnails['source'], self.user.avatar.name)
@@ -38,6 +38,11 @@ class ProfileView(LoginRequiredMixin, UpdateView):
     def get_object(self, queryset=None):
         return self.request.user
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['invoices'] = self.request.user.invoice_set.order_by('-invoice_date', '-pk')
+        return context
+
     def form_valid(self, form):
         messages.add_message(self.request, messages.INFO, 'Profile updated.')
         return super().form_valid(form)